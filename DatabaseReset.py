@@ -1,54 +1,324 @@
 import os
 import asyncio
+import time
+import json
 from models import Base
-from GTFS_Parsing import GTFSParser
+from GTFS_Parsing import GTFSParser, parse_feed, parse_stops, feed_fingerprint, feed_folders, feed_id_of, file_sha256, TABLE_COLUMNS, TABLE_KEYS
 from db_manager import DatabaseManager
 from db_manager import db_manager as Manager
+from config import settings
+from http_client import http_client, GTFS_STATIC_TARGET
+from metrics import gtfs_reload_phase_seconds, gtfs_reloads, gtfs_reload_last_success
+from timetable_snapshot import TimetableSnapshot
 import shutil
-import requests
 import zipfile
+import csv
+import io
+import hashlib
 import urllib.parse
 import subprocess
-import pandas as pd
 from constants import ZIP_URLS, SOURCE, TARGET, ALLOWED_FILES, OSM_FOLDER
 from pathlib import Path
 from sqlalchemy import text
+from concurrent.futures import ProcessPoolExecutor
+
+# Tables that make up one loaded GTFS dataset, in foreign key order
+GTFS_TABLES = ["routes", "service_calendar", "stops", "added_trips", "trips", "shapes", "stop_times",
+               "stop_routes", "route_stop_patterns", "stop_time_predictions", "gtfs_manifest"]
+LIVE_SCHEMA = "public"
+STAGING_SCHEMA = "gtfs_staging"
+RETIRED_SCHEMA = "gtfs_retired"
+
+# Rows of the changed feeds that an incremental reload may delete; every stop is recomputed from all feeds
+DIFF_DELETE_SCOPES = {
+    "stop_times": "trip_id IN (SELECT trip_id FROM trips WHERE feed_id = ANY(CAST(:feeds AS varchar[])))",
+    "shapes": "shape_id IN (SELECT route_id FROM routes WHERE feed_id = ANY(CAST(:feeds AS varchar[])))",
+    "trips": "feed_id = ANY(CAST(:feeds AS varchar[]))",
+    "routes": "feed_id = ANY(CAST(:feeds AS varchar[]))",
+    "service_calendar": "feed_id = ANY(CAST(:feeds AS varchar[]))",
+    "stop_routes": "route_id IN (SELECT route_id FROM routes WHERE feed_id = ANY(CAST(:feeds AS varchar[])))",
+    "route_stop_patterns": "route_id IN (SELECT route_id FROM routes WHERE feed_id = ANY(CAST(:feeds AS varchar[])))",
+    "stops": "TRUE",
+}
+
+CLEAR_ADDED_TRIPS_SQL = [
+    "DELETE FROM trips WHERE trip_id IN (SELECT trip_id FROM added_trips)",
+    "DELETE FROM added_trips",
+]
+# Ids of realtime ADDED trips start above every scheduled trip of the dataset
+RESET_ADDED_TRIP_ID_SQL = "SELECT setval('added_trip_id_seq', (SELECT coalesce(max(trip_id), 0) + 1 FROM trips), false)"
+
+
+def build_manifest(folders: list[str]) -> dict[str, dict]:
+    """feed_id -> file hashes for every feed folder."""
+    return {feed_id_of(folder): feed_fingerprint(folder) for folder in folders}
+
+
+def merge_stops(stops_per_feed) -> list[tuple]:
+    """Stops are shared between operators: keep the first feed's copy of each."""
+    stops = {}
+    for feed_stops in stops_per_feed:
+        for row in feed_stops:
+            stops.setdefault(row[0], row)
+    return list(stops.values())
+
+
+def upsert_changed_rows_sql(table: str) -> str:
+    """Insert the new_<table> rows that are missing from table or differ from it, touching no other row."""
+    keys = TABLE_KEYS[table]
+    columns = TABLE_COLUMNS[table]
+    values = [column for column in columns if column not in keys]
+    if not values:
+        # Key-only tables: a row is either there or not
+        return f"""
+            INSERT INTO {table} ({", ".join(columns)})
+            SELECT {", ".join(f"n.{column}" for column in columns)}
+            FROM new_{table} n
+            ON CONFLICT ({", ".join(keys)}) DO NOTHING
+        """
+    return f"""
+        INSERT INTO {table} ({", ".join(columns)})
+        SELECT {", ".join(f"n.{column}" for column in columns)}
+        FROM new_{table} n
+        LEFT JOIN {table} o USING ({", ".join(keys)})
+        WHERE o.{keys[0]} IS NULL
+        OR ({", ".join(f"o.{column}" for column in values)}) IS DISTINCT FROM ({", ".join(f"n.{column}" for column in values)})
+        ON CONFLICT ({", ".join(keys)}) DO UPDATE
+        SET {", ".join(f"{column} = EXCLUDED.{column}" for column in values)}
+    """
+
+
+def delete_missing_rows_sql(table: str) -> str:
+    keys = TABLE_KEYS[table]
+    return f"""
+        DELETE FROM {table} o
+        WHERE {DIFF_DELETE_SCOPES[table]}
+        AND NOT EXISTS (SELECT 1 FROM new_{table} n WHERE {" AND ".join(f"n.{key} = o.{key}" for key in keys)})
+    """
+
 
 class DatabaseReset:
     def __init__(self, db_manager: DatabaseManager, gtfs_parent_folder: str):
         self.db_manager = db_manager
         self.gtfs_parent_folder = gtfs_parent_folder
+        self.sql_dir = Path(__file__).parent
 
-    async def reset_and_insert(self, gtfs_folder: str):
-        # Insert new data from GTFSParser
-        print(f"Inserting GTFS data for folder {gtfs_folder}...")
-        async for session in self.db_manager.get_session():
-            parser = GTFSParser(session, gtfs_folder)
-            await parser.parse_and_insert()
-            print(f"GTFS data for {gtfs_folder} inserted successfully!")
+    async def _execute_sql_file(self, conn, file_name: str):
+        with open(os.path.join(self.sql_dir, file_name), 'r', encoding='utf-8') as f:
+            raw_sql = f.read()
+        statements = [stmt.strip() for stmt in raw_sql.split(';') if stmt.strip()]
+        for stmt in statements:
+            await conn.execute(text(stmt))
 
-    async def reset_and_insert_all(self):
+    async def has_live_data(self) -> bool:
+        """
+        True if a previously loaded dataset with every table of GTFS_TABLES is already being served. A database
+        from an older schema lacks some of them, and the app cannot load from it until a reload creates them.
+        """
+        async with self.db_manager.engine.connect() as conn:
+            return await self._live_tables_exist(conn)
+
+    @staticmethod
+    async def _live_tables_exist(conn) -> bool:
+        for table in GTFS_TABLES:
+            result = await conn.execute(text(f"SELECT to_regclass('{LIVE_SCHEMA}.{table}') IS NOT NULL"))
+            if not result.scalar():
+                return False
+        return True
+
+    async def reset_and_insert(self, gtfs_folder: str, tables: dict, writers: asyncio.Semaphore) -> dict:
+        # Insert parsed data for one folder into the staging schema
+        async with writers:
+            print(f"Inserting GTFS data for folder {gtfs_folder}...")
+            async with self.db_manager.session_factory() as session:
+                parser = GTFSParser(session, gtfs_folder, schema=STAGING_SCHEMA)
+                await parser.insert_tables(tables)
+                print(f"GTFS data for {gtfs_folder} inserted successfully!")
+        return parser.row_counts
+
+    async def _insert_when_parsed(self, gtfs_folder: str, parse_job, writers: asyncio.Semaphore) -> dict:
+        return await self.reset_and_insert(gtfs_folder, await parse_job, writers)
+
+    async def _create_staging_schema(self):
         async with self.db_manager.engine.begin() as conn:
-            sql_dir = Path(__file__).parent
-
-            print(f"Dropping all tables for folder {self.gtfs_parent_folder}...")
-            drop_path = os.path.join(sql_dir, 'drop_tables.sql')
-            with open(drop_path, 'r', encoding='utf-8') as f:
-                raw_sql = f.read()
-                statements = [stmt.strip() for stmt in raw_sql.split(';') if stmt.strip()]
-                for stmt in statements:
-                    await conn.execute(text(stmt))
-            print("Recreating tables...")
-            create_path = os.path.join(sql_dir, 'create_tables.sql')
-            with open(create_path, 'r', encoding='utf-8') as f:
-                raw_sql = f.read()
-                statements = [stmt.strip() for stmt in raw_sql.split(';') if stmt.strip()]
-                for stmt in statements:
-                    await conn.execute(text(stmt))
-            
-        gtfs_folders = [os.path.join(self.gtfs_parent_folder, folder) for folder in os.listdir(self.gtfs_parent_folder)]
-        for gtfs_folder in gtfs_folders:
-            await self.reset_and_insert(gtfs_folder)
+            print(f"Creating staging schema {STAGING_SCHEMA}...")
+            await conn.execute(text(f"DROP SCHEMA IF EXISTS {STAGING_SCHEMA} CASCADE"))
+            await conn.execute(text(f"CREATE SCHEMA {STAGING_SCHEMA}"))
+            await conn.execute(text(f"SET LOCAL search_path TO {STAGING_SCHEMA}"))
+            await self._execute_sql_file(conn, 'create_tables.sql')
+
+    async def _create_indexes(self):
+        """Build the secondary indexes once the staged tables are full, which is cheaper than maintaining them row by row."""
+        async with self.db_manager.engine.begin() as conn:
+            print(f"Creating indexes in {STAGING_SCHEMA}...")
+            await conn.execute(text(f"SET LOCAL search_path TO {STAGING_SCHEMA}"))
+            await self._execute_sql_file(conn, 'create_indexes.sql')
+            await conn.execute(text(RESET_ADDED_TRIP_ID_SQL))
+
+    async def _validate_staging(self, expected_counts: dict):
+        """Refuse to swap in a dataset whose tables do not hold what the loaders reported."""
+        async with self.db_manager.engine.begin() as conn:
+            for table in GTFS_TABLES:
+                await conn.execute(text(f"ANALYZE {STAGING_SCHEMA}.{table}"))
+                result = await conn.execute(text(f"SELECT count(*) FROM {STAGING_SCHEMA}.{table}"))
+                count = result.scalar()
+                expected = expected_counts.get(table, 0)
+                print(f"Staged {table}: {count} rows")
+                if count != expected:
+                    raise RuntimeError(f"Staged {table} has {count} rows, loaders reported {expected}")
+            # Without any feed the dataset is empty on purpose, e.g. the first start before feeds are in place
+            if expected_counts.get("gtfs_manifest") and not expected_counts.get("stops"):
+                raise RuntimeError("Staged dataset has no stops")
+
+    async def _swap_staging_into_live(self):
+        """Move the staged tables into the live schema in one transaction, so readers see old or new data, never a mix."""
+        async with self.db_manager.engine.begin() as conn:
+            await conn.execute(text("SET LOCAL lock_timeout = '10s'"))
+            await conn.execute(text(f"DROP SCHEMA IF EXISTS {RETIRED_SCHEMA} CASCADE"))
+            await conn.execute(text(f"CREATE SCHEMA {RETIRED_SCHEMA}"))
+            for table in GTFS_TABLES:
+                await conn.execute(text(f"ALTER TABLE IF EXISTS {LIVE_SCHEMA}.{table} SET SCHEMA {RETIRED_SCHEMA}"))
+            for table in GTFS_TABLES:
+                await conn.execute(text(f"ALTER TABLE {STAGING_SCHEMA}.{table} SET SCHEMA {LIVE_SCHEMA}"))
+        print("Swapped staged GTFS data into the live schema.")
+        async with self.db_manager.engine.begin() as conn:
+            await conn.execute(text(f"DROP SCHEMA IF EXISTS {RETIRED_SCHEMA} CASCADE"))
+            await conn.execute(text(f"DROP SCHEMA IF EXISTS {STAGING_SCHEMA} CASCADE"))
+
+    async def reset_and_insert_all(self, gtfs_folders: list[str] = None, manifest: dict = None):
+        """Build the new dataset next to the live one and swap it in once it is complete."""
+        if gtfs_folders is None:
+            gtfs_folders = feed_folders(self.gtfs_parent_folder)
+        if manifest is None:
+            manifest = await asyncio.to_thread(build_manifest, gtfs_folders)
+        with gtfs_reload_phase_seconds.labels("staging_schema").time():
+            await self._create_staging_schema()
+
+        # Parse every feed in its own process and write them concurrently, at most one writer per pooled connection
+        writers = asyncio.Semaphore(self.db_manager.engine.pool.size())
+        loop = asyncio.get_running_loop()
+        pool = ProcessPoolExecutor(max_workers=max(1, min(len(gtfs_folders), os.cpu_count() or 1)))
+        try:
+            with gtfs_reload_phase_seconds.labels("parse_insert").time():
+                stop_jobs = [loop.run_in_executor(pool, parse_stops, folder) for folder in gtfs_folders]
+                feed_jobs = [loop.run_in_executor(pool, parse_feed, folder) for folder in gtfs_folders]
+
+                # Stops go in before any stop_times
+                stops = merge_stops(await asyncio.gather(*stop_jobs))
+                all_row_counts = [await self.reset_and_insert(self.gtfs_parent_folder, {"stops": stops}, writers)]
+                all_row_counts += await asyncio.gather(*(
+                    self._insert_when_parsed(folder, job, writers) for folder, job in zip(gtfs_folders, feed_jobs)
+                ))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        expected_counts = {}
+        for row_counts in all_row_counts:
+            for table, rows in row_counts.items():
+                expected_counts[table] = expected_counts.get(table, 0) + rows
+
+        async with self.db_manager.engine.begin() as conn:
+            await conn.execute(text(f"SET LOCAL search_path TO {STAGING_SCHEMA}"))
+            expected_counts["gtfs_manifest"] = await self._write_manifest(conn, manifest)
+        with gtfs_reload_phase_seconds.labels("indexes").time():
+            await self._create_indexes()
+        with gtfs_reload_phase_seconds.labels("validate").time():
+            await self._validate_staging(expected_counts)
+        with gtfs_reload_phase_seconds.labels("swap").time():
+            await self._swap_staging_into_live()
+
+    async def _read_live_manifest(self):
+        """The manifest of the dataset being served, or None if it was not loaded with one or lacks a table."""
+        async with self.db_manager.engine.connect() as conn:
+            if not await self._live_tables_exist(conn):
+                return None
+            result = await conn.execute(text(f"SELECT feed_id, file_hashes FROM {LIVE_SCHEMA}.gtfs_manifest"))
+            return {feed_id: json.loads(file_hashes) for feed_id, file_hashes in result}
+
+    async def _write_manifest(self, conn, manifest: dict) -> int:
+        await conn.execute(text("DELETE FROM gtfs_manifest"))
+        if manifest:
+            await conn.execute(
+                text("INSERT INTO gtfs_manifest (feed_id, file_hashes) VALUES (:feed_id, :file_hashes)"),
+                [
+                    {"feed_id": feed_id, "file_hashes": json.dumps(file_hashes, sort_keys=True)}
+                    for feed_id, file_hashes in manifest.items()
+                ]
+            )
+        return len(manifest)
+
+    async def reload(self, full: bool = False) -> bool:
+        """
+        Bring the live dataset in line with the feed folders. Feeds whose files match the
+        manifest of the last load are skipped; the rest are diffed row by row against the live tables.
+        A full rebuild runs when forced or when the live dataset has no manifest.
+        Returns False if no feed had changed.
+        """
+        gtfs_folders = feed_folders(self.gtfs_parent_folder)
+        with gtfs_reload_phase_seconds.labels("manifest").time():
+            manifest = await asyncio.to_thread(build_manifest, gtfs_folders)
+        live_manifest = None if full else await self._read_live_manifest()
+        if not gtfs_folders and await self.has_live_data():
+            # More likely a failed download or mount than every feed withdrawn; keep serving what is loaded
+            print(f"No GTFS feeds found in {self.gtfs_parent_folder}, keeping the loaded dataset.")
+            return False
+        if live_manifest is None:
+            await self.reset_and_insert_all(gtfs_folders, manifest)
+            return True
+
+        changed_feeds = sorted(
+            feed_id for feed_id in manifest.keys() | live_manifest.keys()
+            if manifest.get(feed_id) != live_manifest.get(feed_id)
+        )
+        if not changed_feeds:
+            print("All GTFS feeds are unchanged, only clearing added trips.")
+            async with self.db_manager.engine.begin() as conn:
+                for statement in CLEAR_ADDED_TRIPS_SQL + [RESET_ADDED_TRIP_ID_SQL]:
+                    await conn.execute(text(statement))
+            return False
+        await self.apply_changed_feeds(gtfs_folders, changed_feeds, manifest)
+        return True
+
+    async def apply_changed_feeds(self, gtfs_folders: list[str], changed_feeds: list[str], manifest: dict):
+        """Diff the changed feeds against the live tables and apply only the inserts, updates and deletes, in one transaction."""
+        print(f"Reloading changed GTFS feeds: {', '.join(changed_feeds)}")
+        start = time.perf_counter()
+        changed_folders = [folder for folder in gtfs_folders if feed_id_of(folder) in changed_feeds]
+        loop = asyncio.get_running_loop()
+        pool = ProcessPoolExecutor(max_workers=max(1, min(len(gtfs_folders), os.cpu_count() or 1)))
+        try:
+            with gtfs_reload_phase_seconds.labels("diff_parse").time():
+                # Any feed may have changed a shared stop, so stops are recomputed from every feed
+                stop_jobs = [loop.run_in_executor(pool, parse_stops, folder) for folder in gtfs_folders]
+                feed_jobs = [loop.run_in_executor(pool, parse_feed, folder) for folder in changed_folders]
+                new_rows = {"stops": merge_stops(await asyncio.gather(*stop_jobs))}
+                for tables in await asyncio.gather(*feed_jobs):
+                    for table, rows in tables.items():
+                        new_rows.setdefault(table, []).extend(rows)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        with gtfs_reload_phase_seconds.labels("diff_apply").time():
+            async with self.db_manager.engine.begin() as conn:
+                await conn.execute(text("SET LOCAL lock_timeout = '10s'"))
+                raw_connection = await conn.get_raw_connection()
+                # Added trips point at routes that may be deleted below
+                for statement in CLEAR_ADDED_TRIPS_SQL:
+                    await conn.execute(text(statement))
+                for table, columns in TABLE_COLUMNS.items():
+                    await conn.execute(text(f"CREATE TEMP TABLE new_{table} (LIKE {LIVE_SCHEMA}.{table}) ON COMMIT DROP"))
+                    await raw_connection.driver_connection.copy_records_to_table(
+                        f"new_{table}", records=new_rows.get(table, []), columns=columns
+                    )
+                    await conn.execute(text(f"ANALYZE new_{table}"))
+                    result = await conn.execute(text(upsert_changed_rows_sql(table)))
+                    print(f"{table}: {result.rowcount} rows inserted or updated")
+                for table in reversed(TABLE_COLUMNS):
+                    result = await conn.execute(text(delete_missing_rows_sql(table)), {"feeds": changed_feeds})
+                    print(f"{table}: {result.rowcount} rows deleted")
+                await conn.execute(text(RESET_ADDED_TRIP_ID_SQL))
+                await self._write_manifest(conn, manifest)
+        print(f"Applied changed GTFS feeds in {time.perf_counter() - start:.3f}s")
 
 class BaseOperations:
     def __init__(self, folder=SOURCE):
@@ -61,20 +331,29 @@ class BaseOperations:
         os.makedirs(folder_path)
         print(f"Cleared and recreated folder: {folder_path}")
 
-    def unzip_files(self, folder):
-        # unzips all .zip files in the specified folder
-        for item in os.listdir(folder):
-            if item.endswith(".zip"):
-                zip_path = os.path.join(folder, item)
-
-                # Folder name = filename without .zip
-                folder_name = os.path.splitext(item)[0]
-                extract_path = os.path.join(folder, folder_name)
-
-                print(f"Unzipping {zip_path} to {extract_path}...")
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(extract_path)
-                print(f"Unzipped to {extract_path}")
+    def feed_zips(self) -> list[str]:
+        return sorted(
+            os.path.join(self.source_folder, item)
+            for item in os.listdir(self.source_folder)
+            if item.endswith(".zip")
+        )
+
+    def unzip_file(self, zip_path):
+        # extracts the GTFS files of one .zip into a folder named after it, replacing the previous extract
+        extract_path = os.path.splitext(zip_path)[0]
+        staging_path = extract_path + ".tmp"
+        print(f"Unzipping {zip_path} to {extract_path}...")
+        self.clear_folder(staging_path)
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            for member in zip_ref.namelist():
+                file_name = os.path.basename(member)
+                if file_name in ALLOWED_FILES:
+                    with zip_ref.open(member) as source, open(os.path.join(staging_path, file_name), "wb") as target:
+                        shutil.copyfileobj(source, target)
+        if os.path.exists(extract_path):
+            shutil.rmtree(extract_path)
+        os.replace(staging_path, extract_path)
+        print(f"Unzipped to {extract_path}")
 
     def run_command(self, command):
         # runs command using command line
@@ -89,11 +368,16 @@ class BaseOperations:
     
 
 
+def read_csv_member(feed: zipfile.ZipFile, member: str):
+    """csv.reader over a file inside a zip, decoded as it is read."""
+    return csv.reader(io.TextIOWrapper(feed.open(member), encoding="utf-8-sig", newline=""))
+
+
 class GraphBuild(BaseOperations):
     def __init__(self, target_folder=TARGET, osm_folder=OSM_FOLDER):
         """
         source_folder: The folder where GTFS .zip files are originally downloaded.
-        target_folder: The folder where we want to move the .zip files and then build the graph.
+        target_folder: The folder where we want to write the merged GTFS bundle and then build the graph.
         """
         super().__init__()
         self.osm_folder = osm_folder
@@ -110,66 +394,62 @@ class GraphBuild(BaseOperations):
             shutil.copy2(source_path, destination_path)
             print(f"Copied {file_name} from {self.osm_folder} to {self.target_folder}")
 
-    def delete_zip_files(self):
+    def create_merged_gtfs_in_target_folder(self):
         """
-        Deletes all .zip files in the source folder.
+        Prepare GTFS data for OpenTripPlanner (OTP) by merging GTFS files from multiple agencies into a single GTFS bundle.
+        Rows are streamed from the members of the downloaded zips straight into the members of the merged zip,
+        so no file is extracted or held in memory; only a 16-byte digest per row is kept to drop duplicates.
         """
-
-        # Ensure the target folder exists
-        if not os.path.exists(self.target_folder):
-            os.makedirs(self.target_folder)
-            print(f"Created target folder: {self.target_folder}")
-            
-        for item in os.listdir(self.source_folder):
-            if item.endswith(".zip"):
-                source_zip_path = os.path.join(self.source_folder, item)
-                os.remove(source_zip_path)
-                print(f"Deleted original zip: {source_zip_path}")
-    def create_merged_gtfs_in_target_folder(self):
-        #Prepare GTFS data for OpenTripPlanner (OTP) by merging GTFS files from multiple agencies into a single GTFS bundle.
         if not os.path.exists(self.target_folder):
             os.makedirs(self.target_folder)
 
-        # Temporary folder to write merged text files
-        temp_folder = os.path.join(self.target_folder, 'temp')
-        if not os.path.exists(temp_folder):
-            os.makedirs(temp_folder)
-
-        # Find all extracted GTFS feed directories
-        feed_dirs = [
-            os.path.join(self.source_folder, d)
-            for d in os.listdir(self.source_folder)
-            if os.path.isdir(os.path.join(self.source_folder, d))
-        ]
-
-        # Merge each allowed file
-        for filename in ALLOWED_FILES:
-            merged = []
-            for feed_dir in feed_dirs:
-                file_path = os.path.join(feed_dir, filename)
-                if os.path.exists(file_path):
-                    try:
-                        df = pd.read_csv(file_path, dtype=str)
-                        merged.append(df)
-                    except Exception as e:
-                        print(f"Error reading {file_path}: {e}")
-            if merged:
-                merged = pd.concat(merged, ignore_index=True)
-                merged = merged.drop_duplicates()
-                out_path = os.path.join(temp_folder, filename)
-                merged.to_csv(out_path, index=False)
-                print(f"Merged {filename}: {len(merged)} rows written to {out_path}")
-            else:
-                print(f"No {filename} found in any feed directory.")
-
-
-        # Zip the merged GTFS bundle
         output_zip_path = os.path.join(self.target_folder, 'merged_gtfs.zip')
-        with zipfile.ZipFile(output_zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
-            for file in os.listdir(temp_folder):
-                file_path = os.path.join(temp_folder, file)
-                zf.write(file_path, arcname=file)
-                print(f"Added to zip: {file}")
+        feeds = [zipfile.ZipFile(zip_path, 'r') for zip_path in self.feed_zips()]
+        try:
+            with zipfile.ZipFile(output_zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as merged_zip:
+                for filename in sorted(ALLOWED_FILES):
+                    members = [
+                        (feed, member) for feed in feeds for member in feed.namelist()
+                        if os.path.basename(member) == filename
+                    ]
+                    if not members:
+                        print(f"No {filename} found in any feed.")
+                        continue
+                    # Columns of every feed in the order they are first seen, as pandas.concat lines them up
+                    columns = []
+                    for feed, member in members:
+                        for column in next(read_csv_member(feed, member), []):
+                            if column not in columns:
+                                columns.append(column)
+                    seen = set()
+                    rows = 0
+                    with io.TextIOWrapper(merged_zip.open(filename, 'w'), encoding="utf-8", newline="") as merged_file:
+                        writer = csv.writer(merged_file)
+                        writer.writerow(columns)
+                        for feed, member in members:
+                            reader = read_csv_member(feed, member)
+                            header = next(reader, [])
+                            positions = [header.index(column) if column in header else None for column in columns]
+                            # Usually every feed has the same columns and rows are written as read
+                            same_columns = header == columns
+                            for row in reader:
+                                if not row:
+                                    continue
+                                if same_columns and len(row) == len(columns):
+                                    values = row
+                                else:
+                                    values = [row[position] if position is not None and position < len(row) else ""
+                                              for position in positions]
+                                digest = hashlib.blake2b("\x1f".join(values).encode(), digest_size=16).digest()
+                                if digest in seen:
+                                    continue
+                                seen.add(digest)
+                                writer.writerow(values)
+                                rows += 1
+                    print(f"Merged {filename}: {rows} rows written to {output_zip_path}")
+        finally:
+            for feed in feeds:
+                feed.close()
         print(f"Successfully created merged GTFS zip: {output_zip_path}")
 
     
@@ -179,7 +459,6 @@ class GraphBuild(BaseOperations):
         and then runs the OTP build command.
         """
         self.clear_folder(self.target_folder)
-        self.delete_zip_files()
         self.create_merged_gtfs_in_target_folder()
         self.copy_osm_data()
         command = f"java -Xmx2G -jar otp-shaded-2.7.0.jar --build {self.target_folder} --save"
@@ -195,48 +474,125 @@ class Updater(BaseOperations):
         self.zip_urls = zip_urls if zip_urls is not None else []
         self.graph_builder = GraphBuild(target_folder=TARGET)
 
-    def download_files(self):
-        for url in self.zip_urls:
-            parsed_url = urllib.parse.urlparse(url)
-            query_params = urllib.parse.parse_qs(parsed_url.query)
-            file_name = query_params['file'][0].split("\\")[-1]
-            filename = os.path.join(self.source_folder, file_name)
-
-            print(f"Downloading {url}...")
-            response = requests.get(url)
-            response.raise_for_status()
-            with open(filename, "wb") as f:
-                f.write(response.content)
-            print(f"Saved to {filename}")
-
-    def run_all(self):
+    def zip_path(self, url):
+        parsed_url = urllib.parse.urlparse(url)
+        query_params = urllib.parse.parse_qs(parsed_url.query)
+        file_name = query_params['file'][0].split("\\")[-1]
+        return os.path.join(self.source_folder, file_name)
+
+    def replace_if_changed(self, zip_path, downloaded_path) -> bool:
+        """
+        Check the CRC of every member of a downloaded zip and put it in place of zip_path.
+        Returns False, dropping the download, when it is byte for byte the zip already there.
+        """
+        with zipfile.ZipFile(downloaded_path, 'r') as zip_ref:
+            corrupt_member = zip_ref.testzip()
+        if corrupt_member is not None:
+            os.remove(downloaded_path)
+            raise zipfile.BadZipFile(f"{downloaded_path}: {corrupt_member} fails its CRC check")
+        if os.path.exists(zip_path) and file_sha256(zip_path) == file_sha256(downloaded_path):
+            os.remove(downloaded_path)
+            return False
+        os.replace(downloaded_path, zip_path)
+        return True
+
+    async def download_file(self, url) -> bool:
+        """Download one feed and extract it if it changed. Returns whether it changed."""
+        zip_path = self.zip_path(url)
+        print(f"Downloading {url}...")
+        size = await http_client.download(GTFS_STATIC_TARGET, url, zip_path + ".new")
+        print(f"Saved {size} bytes to {zip_path}.new")
+        changed = await asyncio.to_thread(self.replace_if_changed, zip_path, zip_path + ".new")
+        if changed or not os.path.isdir(os.path.splitext(zip_path)[0]):
+            await asyncio.to_thread(self.unzip_file, zip_path)
+        else:
+            print(f"{zip_path} is unchanged.")
+        return changed
+
+    async def download_files(self) -> bool:
+        """Download every feed at once, each one extracted as soon as it arrives. Returns whether any changed."""
+        os.makedirs(self.source_folder, exist_ok=True)
+        changed = await asyncio.gather(*(self.download_file(url) for url in self.zip_urls))
+        return any(changed)
+
+    async def run_all(self) -> bool:
         # Download files into the source folder.
-        self.clear_folder(self.source_folder)
-        self.download_files()
-        self.unzip_files(self.source_folder)
+        with gtfs_reload_phase_seconds.labels("download").time():
+            changed = await self.download_files()
         print("GTFS files downloaded.")
-        self.graph_builder.build_graph()
-        print("All GTFS data updated and graph built.")
+        return changed
 
 class GTFSDataReloader:
-    def __init__(self, db_manager: DatabaseManager, gtfs_folder: str, zip_urls: list[str]):
+    def __init__(self, db_manager: DatabaseManager, gtfs_folder: str, zip_urls: list[str], snapshot_folder: str = None):
+        """snapshot_folder: Where to write the timetable snapshot after a reload that changed the dataset."""
         self.gtfs_folder = gtfs_folder
         self.updater = Updater(zip_urls=zip_urls)
+        self.db_manager = db_manager
         self.db_reset = DatabaseReset(db_manager, gtfs_folder)
+        self.snapshot_folder = snapshot_folder
+        # The startup reload and the nightly job share the staging schema
+        self._lock = asyncio.Lock()
 
-    def update_data_files(self):
+    async def update_data_files(self) -> bool:
         print("Starting GTFS file update...")
-        self.updater.run_all()
+        changed = await self.updater.run_all()
         print("GTFS files updated.")
+        return changed
 
-    async def reload_database(self):
-        print("Starting database reset and insertion...")
-        await self.db_reset.reset_and_insert_all()
+    async def build_graph(self):
+        """Build the OTP graph in a thread; a failed build leaves OTP on its current graph."""
+        try:
+            with gtfs_reload_phase_seconds.labels("graph_build").time():
+                await asyncio.to_thread(self.updater.graph_builder.build_graph)
+            print("OTP graph built.")
+        except Exception as e:
+            print(f"OTP graph build failed: {e}")
+
+    async def reload_database(self, full: bool = False) -> bool:
+        print("Starting database reload...")
+        changed = await self.db_reset.reload(full=full)
         print("Database update complete.")
+        return changed
 
-    async def run_all(self):
-        # self.update_data_files()
-        await self.reload_database()
+    async def has_live_data(self) -> bool:
+        return await self.db_reset.has_live_data()
+
+    async def write_snapshot(self):
+        """Write the new dataset's snapshot now, so no worker has to build it from the database when it reloads."""
+        try:
+            with gtfs_reload_phase_seconds.labels("snapshot").time():
+                async with self.db_manager.session_factory() as session:
+                    path = await TimetableSnapshot.write(session, self.snapshot_folder)
+            if path is not None:
+                print(f"Timetable snapshot written to {path}.")
+        except Exception as e:
+            # The first refresh_static_data without it builds it instead
+            print(f"Timetable snapshot write failed: {e}")
+
+    async def run_all(self, full: bool = False) -> bool:
+        """Returns False if every feed was unchanged and the dataset was left as it was."""
+        async with self._lock:
+            try:
+                with gtfs_reload_phase_seconds.labels("total").time():
+                    changed = await self._run_all(full)
+                    if changed and self.snapshot_folder is not None:
+                        await self.write_snapshot()
+            except Exception:
+                gtfs_reloads.labels("failed").inc()
+                raise
+            gtfs_reloads.labels("changed" if changed else "unchanged").inc()
+            gtfs_reload_last_success.set(time.time())
+            return changed
+
+    async def _run_all(self, full: bool) -> bool:
+        if not settings.gtfs_download_feeds:
+            return await self.reload_database(full=full)
+        files_changed = await self.update_data_files()
+        if not files_changed or not settings.otp_enabled:
+            return await self.reload_database(full=full)
+        # The database load and the OTP graph build read the same files and do not depend on each other
+        changed, _ = await asyncio.gather(self.reload_database(full=full), self.build_graph())
+        return changed
 
 # Usage example
 async def main():
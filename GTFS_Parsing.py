@@ -1,25 +1,23 @@
-import csv
+import hashlib
+import numpy as np
 import time
 import os
 import asyncio
-from models import Route, Trip, Shape, Stop_Time, Stop, Added_Trip
+from models import Route, Stop
 import gtfs_realtime_pb2
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from datetime import datetime
+from sqlalchemy import select, text
+from datetime import date, datetime, timedelta
+from asyncpg import BitString
 import logging
 from db_manager import db_manager
-import requests
+import httpx
+from http_client import http_client, GTFS_RT_TARGET
+from metrics import realtime_phase_seconds, realtime_feed_entities
 
-from constants import CYPRUS_TZ, GTFS_REALTIME_API_PATH
-
-def parse_time(time_str: str) -> int:
-    """ Helper method to convert GTFS time (HH:MM:SS) to number of seconds after 00:00 """
-    if time_str:
-        hours, minutes, seconds = map(int, time_str.split(":"))
-        value = hours * 60 * 60 + minutes * 60 + seconds
-        return value
-    return None
+from config import settings
+from constants import CYPRUS_TZ
+from gtfs_reader import INT, FLOAT, STR, TIME, iter_columns, read_columns, to_records
 
 def timestamp_to_cyprus_time(timestamp: int):
     return datetime.fromtimestamp(timestamp, CYPRUS_TZ)
@@ -27,199 +25,358 @@ def datetime_to_second_from_midnight(date_time: datetime) -> int:
     Time = date_time.time()
     return Time.hour * 3600 + Time.minute * 60 + Time.second
 
+# Columns copied into each table, in the order the tables must be loaded for their foreign keys
+TABLE_COLUMNS = {
+    "routes": ["route_id", "route_short_name", "route_long_name", "feed_id"],
+    "service_calendar": ["service_id", "start_date", "active_days", "feed_id"],
+    "stops": ["stop_id", "stop_name", "stop_lat", "stop_lon", "zone_id"],
+    "trips": ["trip_id", "route_id", "service_id", "direction_id", "trip_headsign", "feed_id"],
+    "shapes": ["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"],
+    "stop_times": ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"],
+    "stop_routes": ["stop_id", "route_id"],
+    "route_stop_patterns": ["route_id", "direction_id", "stop_order", "stop_id"],
+}
+
+
+# Primary key of each table, for diffing a new load against the live rows
+TABLE_KEYS = {
+    "routes": ["route_id"],
+    "service_calendar": ["service_id"],
+    "stops": ["stop_id"],
+    "trips": ["trip_id"],
+    "shapes": ["shape_id", "shape_pt_sequence"],
+    "stop_times": ["trip_id", "stop_sequence"],
+    "stop_routes": ["stop_id", "route_id"],
+    "route_stop_patterns": ["route_id", "direction_id", "stop_order"],
+}
+
+# Files of a feed the loader reads; a feed whose files all hash the same as last time is not reloaded
+FEED_FILES = ["stops.txt", "routes.txt", "trips.txt", "stop_times.txt", "calendar.txt", "calendar_dates.txt", "shapes.txt"]
+
+WEEKDAY_COLUMNS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+# Columns the loader reads from each GTFS file and how to parse them
+FILE_SCHEMAS = {
+    "stops.txt": {"stop_id": INT, "stop_name": STR, "stop_lat": FLOAT, "stop_lon": FLOAT, "zone_id": INT},
+    "routes.txt": {"route_id": INT, "route_short_name": STR, "route_long_name": STR},
+    "trips.txt": {"trip_id": INT, "route_id": INT, "service_id": INT, "direction_id": INT, "trip_headsign": STR},
+    "shapes.txt": {"shape_id": INT, "shape_pt_lat": FLOAT, "shape_pt_lon": FLOAT, "shape_pt_sequence": INT},
+    "stop_times.txt": {"trip_id": INT, "arrival_time": TIME, "departure_time": TIME, "stop_id": INT, "stop_sequence": INT},
+    "calendar.txt": {"service_id": INT, **{day: INT for day in WEEKDAY_COLUMNS}, "start_date": STR, "end_date": STR},
+    "calendar_dates.txt": {"service_id": INT, "date": STR, "exception_type": INT},
+}
+
+
+def feed_id_of(gtfs_folder: str) -> str:
+    return os.path.basename(os.path.normpath(gtfs_folder))
+
+
+def feed_folders(gtfs_parent_folder: str) -> list[str]:
+    """The extracted feed folders, skipping the downloaded zips next to them."""
+    return sorted(
+        os.path.join(gtfs_parent_folder, name)
+        for name in os.listdir(gtfs_parent_folder)
+        if os.path.isdir(os.path.join(gtfs_parent_folder, name))
+    )
+
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def feed_fingerprint(gtfs_folder: str) -> dict[str, str]:
+    """sha256 of the feed's zip (if it was kept next to the folder) and of every file in FEED_FILES."""
+    hashes = {}
+    zip_path = os.path.normpath(gtfs_folder) + ".zip"
+    if os.path.isfile(zip_path):
+        hashes[os.path.basename(zip_path)] = file_sha256(zip_path)
+    for file_name in FEED_FILES:
+        file_path = os.path.join(gtfs_folder, file_name)
+        if os.path.isfile(file_path):
+            hashes[file_name] = file_sha256(file_path)
+    return hashes
+
+
+def parse_gtfs_date(value: str) -> date:
+    """GTFS dates are YYYYMMDD."""
+    return date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+
+
+def parse_service_calendar(gtfs_folder: str) -> list[tuple]:
+    """
+    One row per service_id with the dates it runs on as a bitmap: bit i of active_days is set when the service
+    runs start_date + i days. calendar.txt gives the weekly pattern, calendar_dates.txt adds (exception_type 1)
+    or removes (exception_type 2) single dates; feeds may have either file or both.
+    """
+    feed_id = feed_id_of(gtfs_folder)
+    days: dict[int, set[date]] = {}
+    calendar = read_columns(gtfs_folder, "calendar.txt", FILE_SCHEMAS["calendar.txt"])
+    for i, service_id in enumerate(calendar["service_id"].tolist()):
+        runs_on = [calendar[column][i] == 1 for column in WEEKDAY_COLUMNS]
+        service_days = days.setdefault(service_id, set())
+        day, end_date = parse_gtfs_date(calendar["start_date"][i]), parse_gtfs_date(calendar["end_date"][i])
+        while day <= end_date:
+            if runs_on[day.weekday()]:
+                service_days.add(day)
+            day += timedelta(days=1)
+    calendar_dates = read_columns(gtfs_folder, "calendar_dates.txt", FILE_SCHEMAS["calendar_dates.txt"])
+    for service_id, service_date, exception_type in to_records(calendar_dates, ["service_id", "date", "exception_type"]):
+        service_days = days.setdefault(service_id, set())
+        if exception_type == 1:
+            service_days.add(parse_gtfs_date(service_date))
+        else:
+            service_days.discard(parse_gtfs_date(service_date))
+
+    rows = []
+    for service_id, service_days in days.items():
+        if not service_days:
+            continue
+        start_date = min(service_days)
+        bitmap = 0
+        for day in service_days:
+            bitmap |= 1 << (day - start_date).days
+        rows.append((service_id, start_date, BitString.from_int(bitmap, bitmap.bit_length(), "little"), feed_id))
+    return rows
+
+
+def parse_stops(gtfs_folder: str) -> list[tuple]:
+    stops = read_columns(gtfs_folder, "stops.txt", FILE_SCHEMAS["stops.txt"])
+    return to_records(stops, TABLE_COLUMNS["stops"])
+
+
+def merge_stop_patterns(patterns: list[tuple[int, ...]]) -> list[int]:
+    """
+    One ordered list of unique stops out of the stop sequences of a route's trips, most common sequence first.
+    Stops the first sequence lacks are inserted after the stop that precedes them in their own sequence.
+    """
+    merged = []
+    for pattern in patterns:
+        previous = None
+        for stop_id in pattern:
+            if stop_id not in merged:
+                merged.insert(0 if previous is None else merged.index(previous) + 1, stop_id)
+            previous = stop_id
+    return merged
+
+
+def build_route_adjacency(trips: dict[str, np.ndarray], running: np.ndarray,
+                          stop_times: list[tuple]) -> tuple[list[tuple], list[tuple]]:
+    """stop_routes and route_stop_patterns rows for the running trips and their stop_times rows."""
+    trip_routes = dict(zip(trips["trip_id"][running].tolist(),
+                           zip(trips["route_id"][running].tolist(), trips["direction_id"][running].tolist())))
+    calls: dict[int, list[tuple[int, int]]] = {}
+    for trip_id, _, _, stop_id, stop_sequence in stop_times:
+        calls.setdefault(trip_id, []).append((stop_sequence, stop_id))
+    stop_routes = set()
+    pattern_counts: dict[tuple[int, int], dict[tuple[int, ...], int]] = {}
+    for trip_id, trip_calls in calls.items():
+        route_id, direction_id = trip_routes[trip_id]
+        trip_calls.sort()
+        pattern = tuple(stop_id for _, stop_id in trip_calls)
+        stop_routes.update((stop_id, route_id) for stop_id in pattern)
+        counts = pattern_counts.setdefault((route_id, direction_id), {})
+        counts[pattern] = counts.get(pattern, 0) + 1
+
+    route_stop_patterns = []
+    for (route_id, direction_id), counts in pattern_counts.items():
+        patterns = sorted(counts, key=lambda pattern: (-counts[pattern], -len(pattern), pattern))
+        for stop_order, stop_id in enumerate(merge_stop_patterns(patterns)):
+            route_stop_patterns.append((route_id, direction_id, stop_order, stop_id))
+    return sorted(stop_routes), route_stop_patterns
+
+
+def parse_feed(gtfs_folder: str) -> dict[str, list[tuple]]:
+    """
+    Parse one operator feed into rows ready for COPY: every trip of every service day, with the service
+    calendar that says which days each trip runs on, and the stop/route adjacency derived from them.
+    Stops are left out because they are shared between feeds; see parse_stops.
+    The large files are read in chunks and filtered chunk by chunk, so only the rows that are kept pile up.
+    This is a plain function so it can run in a worker process.
+    """
+    start = time.perf_counter()
+    feed_id = feed_id_of(gtfs_folder)
+    service_calendar = parse_service_calendar(gtfs_folder)
+
+    # Trips whose service never runs would only take up space
+    trips = read_columns(gtfs_folder, "trips.txt", FILE_SCHEMAS["trips.txt"])
+    trips["feed_id"] = np.full(len(trips["trip_id"]), feed_id, dtype=object)
+    running = np.isin(trips["service_id"], [row[0] for row in service_calendar])
+    used_trips = np.unique(trips["trip_id"][running])
+    used_routes = np.unique(trips["route_id"][running])
+
+    routes = read_columns(gtfs_folder, "routes.txt", FILE_SCHEMAS["routes.txt"])
+    routes["feed_id"] = np.full(len(routes["route_id"]), feed_id, dtype=object)
+    shapes = []
+    for columns in iter_columns(gtfs_folder, "shapes.txt", FILE_SCHEMAS["shapes.txt"]):
+        shapes += to_records(columns, TABLE_COLUMNS["shapes"], np.isin(columns["shape_id"], used_routes))
+    stop_times = []
+    for columns in iter_columns(gtfs_folder, "stop_times.txt", FILE_SCHEMAS["stop_times.txt"]):
+        stop_times += to_records(columns, TABLE_COLUMNS["stop_times"], np.isin(columns["trip_id"], used_trips))
+    stop_routes, route_stop_patterns = build_route_adjacency(trips, running, stop_times)
+    print(f"Parsed {gtfs_folder} in {time.perf_counter() - start:.3f}s")
+    return {
+        "routes": to_records(routes, TABLE_COLUMNS["routes"], np.isin(routes["route_id"], used_routes)),
+        "service_calendar": service_calendar,
+        "trips": to_records(trips, TABLE_COLUMNS["trips"], running),
+        "shapes": shapes,
+        "stop_times": stop_times,
+        "stop_routes": stop_routes,
+        "route_stop_patterns": route_stop_patterns,
+    }
+
+
 class GTFSParser:
-    def __init__(self, session: AsyncSession, gtfs_folder: str):
+    def __init__(self, session: AsyncSession, gtfs_folder: str, schema: str = None):
+        """
+        schema: Schema to load into. None means the tables on the session's search_path.
+        """
         self.session = session
         self.gtfs_folder = gtfs_folder
-        self.service_id = -1
-        self.routes_used_today = set()
-        self.trips_used_today = set()
-
-    async def _get_service_id(self):
-        """ Get the service_id for today from calendar_dates.txt using linear search"""
-        file_path = os.path.join(self.gtfs_folder, "calendar_dates.txt")
-        if not os.path.isfile(file_path):
-            print(f"There is no {file_path}")
-            return None
-        today_date = datetime.today().date()
-        today_service_format = "".join(str(today_date).split('-'))
-        service_id = -1
-        with open(file_path, mode="r", encoding="utf-8-sig") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                if row["date"] == today_service_format:
-                    service_id = row["service_id"]
-        self.service_id = int(service_id)
-
+        self.schema = schema
+        self.row_counts = {}
 
     async def parse_and_insert(self):
-        "Parse and insert GTFS data into the database asynchronously"
-        "The order of inserts is very important"
-        await self._get_service_id()
-        await self._insert_trips()
-        await self._insert_routes()
-        await self._insert_shapes()
-        await self._insert_stops()
-        await self._insert_stop_times()
+        "Parse this feed in the current process and stream it into the database with COPY"
+        tables = parse_feed(self.gtfs_folder)
+        # Stops are shared between operators, so skip the ones an earlier feed already inserted
+        result = await self.session.execute(
+            select(Stop.stop_id),
+            execution_options={"schema_translate_map": {None: self.schema}}
+        )
+        existing_stops = set(result.scalars())
+        tables["stops"] = [row for row in parse_stops(self.gtfs_folder) if row[0] not in existing_stops]
+        await self.insert_tables(tables)
+
+    async def insert_tables(self, tables: dict[str, list[tuple]]):
+        "The order of inserts is very important: every table is copied after the tables its foreign keys point to"
+        for table, columns in TABLE_COLUMNS.items():
+            if table in tables:
+                await self._copy_records(table, columns, tables[table])
         await self.session.commit()
         print("Committing changes to the database...")
 
-    async def _insert_routes(self):
-        print("Inserting routes...")
-        file_path = os.path.join(self.gtfs_folder, "routes.txt")
-        if not os.path.isfile(file_path):
-            print(f"There is no {file_path}")
-            return
+    async def _copy_records(self, table: str, columns: list[str], records) -> int:
+        """Stream records into the table with COPY on the session's connection and report rows/sec."""
+        connection = await self.session.connection()
+        raw_connection = await connection.get_raw_connection()
+        start = time.perf_counter()
+        status = await raw_connection.driver_connection.copy_records_to_table(
+            table, records=records, columns=columns, schema_name=self.schema
+        )
+        elapsed = time.perf_counter() - start
+        rows = int(status.split()[-1])
+        self.row_counts[table] = self.row_counts.get(table, 0) + rows
+        print(f"Copied {rows} rows into {table} in {elapsed:.3f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)")
+        return rows
+
+# Finds the trip_id of every ADDED trip in one statement, allocating ids from added_trip_id_seq for the new ones.
+# Trips on routes missing from the dataset are left unresolved.
+RESOLVE_ADDED_TRIPS_QUERY = text("""
+    WITH wanted AS (
+        SELECT *
+        FROM unnest(CAST(:route_ids AS integer[]), CAST(:direction_ids AS integer[]), CAST(:start_times AS varchar[]))
+            AS w(route_id, direction_id, start_time)
+    ),
+    existing AS (
+        SELECT a.route_id, a.direction_id, a.start_time, a.trip_id
+        FROM added_trips a
+        JOIN wanted w USING (route_id, direction_id, start_time)
+    ),
+    new_added_trips AS (
+        INSERT INTO added_trips (trip_id, route_id, start_time, direction_id)
+        SELECT nextval('added_trip_id_seq'), w.route_id, w.start_time, w.direction_id
+        FROM wanted w
+        JOIN routes r USING (route_id)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM existing e
+            WHERE (e.route_id, e.direction_id, e.start_time) = (w.route_id, w.direction_id, w.start_time)
+        )
+        ON CONFLICT DO NOTHING
+        RETURNING route_id, direction_id, start_time, trip_id
+    ),
+    new_trips AS (
+        INSERT INTO trips (trip_id, route_id, service_id, direction_id, trip_headsign)
+        SELECT trip_id, route_id, -1, direction_id, 'Added trip'
+        FROM new_added_trips
+    )
+    SELECT route_id, direction_id, start_time, trip_id FROM existing
+    UNION ALL
+    SELECT route_id, direction_id, start_time, trip_id FROM new_added_trips;
+""")
+
+LOOKUP_ADDED_TRIPS_QUERY = text("""
+    SELECT a.route_id, a.direction_id, a.start_time, a.trip_id
+    FROM added_trips a
+    JOIN unnest(CAST(:route_ids AS integer[]), CAST(:direction_ids AS integer[]), CAST(:start_times AS varchar[]))
+        AS w(route_id, direction_id, start_time) USING (route_id, direction_id, start_time);
+""")
+
+# Its own statement before the upsert: in one statement the DELETE and ON CONFLICT DO UPDATE would both touch a
+# prediction that expired and is back in the feed
+EXPIRE_PREDICTIONS_QUERY = text("""
+    DELETE FROM stop_time_predictions
+    WHERE updated_at < now() - make_interval(secs => :ttl);
+""")
+
+# Mirrors a whole tick of predictions into stop_time_predictions at once.
+# Rows for trips or stops unknown to the dataset are skipped.
+UPSERT_PREDICTIONS_QUERY = text("""
+    INSERT INTO stop_time_predictions (trip_id, stop_sequence, stop_id, arrival_time, departure_time, updated_at)
+    SELECT u.trip_id, u.stop_sequence, u.stop_id, u.arrival_time, u.departure_time, now()
+    FROM unnest(CAST(:trip_ids AS integer[]), CAST(:stop_sequences AS integer[]), CAST(:stop_ids AS integer[]),
+                CAST(:arrival_times AS integer[]), CAST(:departure_times AS integer[]))
+        AS u(trip_id, stop_sequence, stop_id, arrival_time, departure_time)
+    JOIN trips t ON t.trip_id = u.trip_id
+    JOIN stops s ON s.stop_id = u.stop_id
+    ON CONFLICT (trip_id, stop_sequence) DO UPDATE
+    SET stop_id = EXCLUDED.stop_id,
+        arrival_time = EXCLUDED.arrival_time,
+        departure_time = EXCLUDED.departure_time,
+        updated_at = EXCLUDED.updated_at;
+""")
+
+
+def _added_trip_params(keys) -> dict:
+    keys = list(keys)
+    return {
+        "route_ids": [route_id for route_id, _, _ in keys],
+        "direction_ids": [direction_id for _, direction_id, _ in keys],
+        "start_times": [start_time for _, _, start_time in keys],
+    }
 
-        with open(file_path, mode="r", encoding="utf-8-sig") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                if int(row['route_id']) in self.routes_used_today:
-                    # print(row)
-                    route = Route(
-                        route_id=int(row['route_id']),
-                        route_short_name=row['route_short_name'],
-                        route_long_name=row['route_long_name']
-                    )
-                    self.session.add(route)
-
-    async def _insert_trips(self):
-        print("Inserting trips...")
-        file_path = os.path.join(self.gtfs_folder, "trips.txt")
-        if not os.path.isfile(file_path):
-            print(f"There is no {file_path}")
-            return
-        with open(file_path, encoding="utf-8-sig") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                if int(row["service_id"]) == self.service_id:
-                    self.routes_used_today.add(int(row["route_id"]))
-                    self.trips_used_today.add(int(row["trip_id"]))
-                    trip = Trip(
-                        trip_id=int(row['trip_id']),
-                        route_id=int(row['route_id']),
-                        service_id=int(row['service_id']),
-                        direction_id=int(row['direction_id']),
-                        trip_headsign=row['trip_headsign']
-                    )
-                    self.session.add(trip)
-
-    async def _insert_shapes(self):
-        print("Inserting shapes...")
-        file_path = os.path.join(self.gtfs_folder, "shapes.txt")
-        if not os.path.isfile(file_path):
-            print(f"There is no {file_path}")
-            return
-        with open(file_path, mode="r", encoding="utf-8-sig") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                if int(row["shape_id"]) in self.routes_used_today:
-                    shape = Shape(
-                        shape_id=int(row['shape_id']),
-                        shape_pt_lat=float(row['shape_pt_lat']),
-                        shape_pt_lon=float(row['shape_pt_lon']),
-                        shape_pt_sequence=int(row['shape_pt_sequence'])
-                    )
-                    self.session.add(shape)
-
-    async def _insert_stop_times(self):
-        print("Inserting stop times...")
-        file_path = os.path.join(self.gtfs_folder, "stop_times.txt")
-        if not os.path.isfile(file_path):
-            print(f"There is no {file_path}")
-            return
-        
-        lst_of_stop_times = []
-        with open(file_path, mode="r", encoding="utf-8-sig") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                if int(row["trip_id"]) in self.trips_used_today:
-                    stop_time = Stop_Time(
-                        trip_id=int(row['trip_id']),
-                        arrival_time=parse_time(row['arrival_time']),
-                        departure_time=parse_time(row['departure_time']),
-                        stop_id=int(row['stop_id']),
-                        stop_sequence=int(row['stop_sequence'])
-                    )
-                    lst_of_stop_times.append(stop_time)
-                    
-        self.session.add_all(lst_of_stop_times)
-        print(f"Inserted {len(lst_of_stop_times)} stop times.")
-    async def _insert_stops(self):
-        print("Inserting stops...")
-        file_path = os.path.join(self.gtfs_folder, "stops.txt")
-        if not os.path.isfile(file_path):
-            print(f"There is no {file_path}")
-            return
-        existing_stops = set()
-        stmt = select(Stop.stop_id)
-        result = await self.session.execute(stmt)
-        for stop_id in result.scalars():
-            existing_stops.add(stop_id)
-        with open(file_path, mode="r", encoding="utf-8-sig") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                stop_id = int(row['stop_id'])
-                if stop_id in existing_stops:
-                    continue
-                stop = Stop(
-                    stop_id=int(row['stop_id']),
-                    stop_name=str(row['stop_name']),
-                    stop_lat=float(row['stop_lat']),
-                    stop_lon=float(row['stop_lon']),
-                    zone_id=int(row['zone_id'])
-                )
-                self.session.add(stop)
 
 class GTFSRealtimeParser:
     def __init__(self, session: AsyncSession, gtfs_rt_url: str):
         self.session = session
         self.gtfs_rt_url = gtfs_rt_url
         self.feed = None
-
-    async def _generate_new_trip_id(self):
-        """Generate a new trip_id based on the maximum existing trip_id in the trips table."""
-        stmt = select(func.max(Trip.trip_id))
-        result = await self.session.execute(stmt)
-        max_id = result.scalar() or 0
-        return max_id + 1
-
-    async def _check_existence_of_trip_id(self, start_time, route_id, direction_id):
-        """Check if a trip_id already exists in the added_trips table. If exists, the function returns trip_id, otherwise - returns Nonde."""
-        stmt = (
-            select(Added_Trip.trip_id)
-            .where(
-                Added_Trip.start_time == start_time,
-                Added_Trip.route_id == route_id,
-                Added_Trip.direction_id == direction_id,
-            )
-        )
-        result = await self.session.execute(stmt)
-        return result.scalar()
-
-    async def _create_new_trip_id(self, route_id, direction_id, start_time):
-        """Create a new trip_id and insert it into the added_trips and trips tables."""
-        new_trip_id = await self._generate_new_trip_id()
-
-        added_trip = Added_Trip(
-            trip_id=new_trip_id,
-            route_id=route_id,
-            start_time=start_time,
-            direction_id=direction_id
-        ) 
-        self.session.add(added_trip)
-
-        new_trip = Trip(
-            trip_id=new_trip_id,
-            route_id=route_id,
-            service_id=-1,
-            direction_id=direction_id,
-            trip_headsign='Added trip'
-        )
-        self.session.add(new_trip)
-
-        await self.session.commit()
-        return new_trip_id
+        self.not_modified = False
+        # (trip_id, stop_sequence) -> (stop_id, arrival, departure) in seconds after midnight, filled by update_predictions
+        self.predictions = {}
+        # (route_id, direction_id, start_time) -> trip_id of the ADDED trips seen in this feed
+        self.added_trip_ids = {}
+
+    async def _resolve_added_trips(self, keys: set):
+        """Look up or create the trip_id of every (route_id, direction_id, start_time) ADDED trip in one round trip."""
+        keys = keys - self.added_trip_ids.keys()
+        if not keys:
+            return
+        result = await self.session.execute(RESOLVE_ADDED_TRIPS_QUERY, _added_trip_params(keys))
+        for route_id, direction_id, start_time, trip_id in result:
+            self.added_trip_ids[(route_id, direction_id, start_time)] = trip_id
+
+    async def _lookup_added_trips(self, keys: set):
+        """Like _resolve_added_trips, but never creates trips."""
+        keys = keys - self.added_trip_ids.keys()
+        if not keys:
+            return
+        result = await self.session.execute(LOOKUP_ADDED_TRIPS_QUERY, _added_trip_params(keys))
+        for route_id, direction_id, start_time, trip_id in result:
+            self.added_trip_ids[(route_id, direction_id, start_time)] = trip_id
 
     async def get_route_short_name(self, route_id: int) -> str:
         """Fetches the route_short_name for a given route_id."""
@@ -229,20 +386,27 @@ class GTFSRealtimeParser:
         return route_short_name
 
     async def fetch_gtfs_rt_data(self):
-        """Fetch GTFS-RT data from the given URL."""
+        """Fetch GTFS-RT data from the given URL. Sets not_modified if the feed is unchanged since the last fetch."""
+        self.not_modified = False
         try:
-            response = requests.get(self.gtfs_rt_url)
-            response.raise_for_status()
+            with realtime_phase_seconds.labels("fetch").time():
+                content = await http_client.get_if_modified(GTFS_RT_TARGET, self.gtfs_rt_url)
+            if content is None:
+                self.not_modified = True
+                self.feed = None
+                return None
 
-            if not response.content:
+            if not content:
                 logging.warning("GTFS-RT feed is empty.")
                 return None
 
-            feed = gtfs_realtime_pb2.FeedMessage()
-            feed.ParseFromString(response.content)
+            with realtime_phase_seconds.labels("parse").time():
+                feed = gtfs_realtime_pb2.FeedMessage()
+                feed.ParseFromString(content)
             self.feed = feed
+            realtime_feed_entities.set(len(feed.entity))
 
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             logging.error(f"Error fetching GTFS-RT data: {e}")
             self.feed = None
 
@@ -269,6 +433,15 @@ class GTFSRealtimeParser:
             result = await self.session.execute(stmt)
             route_map = dict(result.all())
 
+        # Vehicles on ADDED trips carry no trip_id; resolve them all in one query
+        await self._lookup_added_trips({
+            (int(entity.trip_update.trip.route_id or entity.vehicle.trip.route_id),
+             entity.vehicle.trip.direction_id, entity.vehicle.trip.start_time)
+            for entity in feed.entity
+            if entity.HasField("vehicle") and (entity.trip_update.trip.route_id or entity.vehicle.trip.route_id)
+            and not (entity.vehicle.trip.trip_id or entity.trip_update.trip.trip_id)
+        })
+
         # Build bus position objects
         for entity in feed.entity:
             if entity.HasField("vehicle"):
@@ -281,8 +454,8 @@ class GTFSRealtimeParser:
                 if trip_id:
                     trip_id = int(trip_id)
                 else:
-                    # If trip_id was None, then it is added trip, so we can get its id using _check_existence_of_trip_id
-                    trip_id = await self._check_existence_of_trip_id(vehicle.trip.start_time, route_id, vehicle.trip.direction_id)
+                    # If trip_id was None, then it is an added trip
+                    trip_id = self.added_trip_ids.get((route_id, vehicle.trip.direction_id, vehicle.trip.start_time))
                 # print(trip_id)
                 route_short_name = route_map.get(route_id, "Unknown")
 
@@ -298,61 +471,48 @@ class GTFSRealtimeParser:
 
         return buses
 
-    async def update_stop_times(self):
-        """Update the Stop_Time table using GTFS-RT stop_time_update information."""
+    async def update_predictions(self, mirror_ttl: float = None):
+        """
+        Collect the GTFS-RT stop_time_update predictions of the feed into self.predictions.
+        The scheduled stop_times are left untouched.
+        mirror_ttl: If set, also mirror them into stop_time_predictions, dropping rows older than this many seconds.
+        """
         if not self.feed:
             return
 
-        stop_time_updates = []
+        trip_updates = []
+        added_trips = set()
         for entity in self.feed.entity:
             if entity.HasField("trip_update"):
-                trip_update = entity.trip_update
-                if trip_update.trip.schedule_relationship == gtfs_realtime_pb2.TripDescriptor.ADDED:
-                    start_time = trip_update.trip.start_time
-                    route_id = int(trip_update.trip.route_id)
-                    direction_id = int(trip_update.trip.direction_id)
-                    trip_id = await self._check_existence_of_trip_id(start_time, route_id, direction_id)
-                    if trip_id is None:
-                        trip_id = await self._create_new_trip_id(route_id=route_id, direction_id=direction_id, start_time=start_time)
-                elif trip_update.trip.schedule_relationship == gtfs_realtime_pb2.TripDescriptor.CANCELED:
+                trip = entity.trip_update.trip
+                if trip.schedule_relationship == gtfs_realtime_pb2.TripDescriptor.CANCELED:
                     print("Canceled trip")
                     continue
-                else:
-                    trip_id = int(trip_update.trip.trip_id)
-                for stu in trip_update.stop_time_update:
-                    stop_time_updates.append((trip_id, stu))
-
-        await self._batch_update_stop_times(stop_time_updates)
-        await self.session.commit()
-
-    async def _batch_update_stop_times(self, stop_time_updates):
-        """
-        Optimized version using batched fetch by trip_id to reduce total number of queries.
-        """
-        if not stop_time_updates:
-            return
+                if trip.schedule_relationship == gtfs_realtime_pb2.TripDescriptor.ADDED:
+                    added_trips.add((int(trip.route_id), int(trip.direction_id), trip.start_time))
+                trip_updates.append(entity.trip_update)
+        await self._resolve_added_trips(added_trips)
 
-        # Extract all unique trip_ids
-        trip_ids = list({trip_id for trip_id, _ in stop_time_updates})
-        existing_entries_with_stops = {}
-        existing_entries_with_sequences = {}
-        chunk_size = 500  # To avoid DB parameter limits
+        stop_time_updates = []
+        for trip_update in trip_updates:
+            trip = trip_update.trip
+            if trip.schedule_relationship == gtfs_realtime_pb2.TripDescriptor.ADDED:
+                trip_id = self.added_trip_ids.get((int(trip.route_id), int(trip.direction_id), trip.start_time))
+                if trip_id is None:
+                    continue
+            else:
+                trip_id = int(trip.trip_id)
+            for stu in trip_update.stop_time_update:
+                stop_time_updates.append((trip_id, stu))
 
-        # Fetch all Stop_Time entries for each trip_id in chunks
-        for i in range(0, len(trip_ids), chunk_size):
-            chunk = trip_ids[i:i + chunk_size]
-            stmt = select(Stop_Time).where(Stop_Time.trip_id.in_(chunk))
-            result = await self.session.execute(stmt)
-            for st in result.scalars():
-                existing_entries_with_stops[(st.trip_id, st.stop_id)] = st
-                existing_entries_with_sequences[(st.trip_id, st.stop_sequence)] = st
+        self._collect_predictions(stop_time_updates)
+        if mirror_ttl is not None:
+            await self._mirror_predictions(mirror_ttl)
+        await self.session.commit()
 
-        # Process updates
-        new_entries = []
+    def _collect_predictions(self, stop_time_updates):
+        """One prediction per (trip_id, stop_sequence), the last one in the feed wins."""
         for trip_id, stu in stop_time_updates:
-            stop_id = int(stu.stop_id)
-            stop_sequence = int(stu.stop_sequence)
-
             try:
                 arrival_time_dt = timestamp_to_cyprus_time(stu.arrival.time) if stu.HasField("arrival") else None
                 departure_time_dt = timestamp_to_cyprus_time(stu.departure.time) if stu.HasField("departure") else None
@@ -362,41 +522,31 @@ class GTFSRealtimeParser:
                 print("Error parsing arrival/departure time")
                 continue
 
-            key_stop = (trip_id, stop_id)
-            key_sequence = (trip_id, stop_sequence)
+            if not arrival_time and not departure_time:
+                continue
+            self.predictions[(trip_id, int(stu.stop_sequence))] = (
+                int(stu.stop_id), arrival_time or departure_time, departure_time or arrival_time
+            )
 
-            entry = existing_entries_with_stops.get(key_stop) or existing_entries_with_sequences.get(key_sequence)
-            if entry:
-                if entry.arrival_time != arrival_time:
-                    entry.arrival_time = arrival_time
-                if entry.departure_time != departure_time:
-                    entry.departure_time = departure_time
-            else:
-                entry = Stop_Time(
-                    trip_id=trip_id,
-                    stop_id=stop_id,
-                    stop_sequence=stop_sequence,
-                    arrival_time=arrival_time,
-                    departure_time=departure_time
-                )
-                new_entries.append(entry)
-
-        print(f"Processed {len(stop_time_updates)} stop_time updates.")
-        print(f"Inserted {len(new_entries)} new stop_times.")
-
-        # Bulk insert new entries
-        try:
-            if new_entries:
-                self.session.add_all(new_entries)
-        except Exception as e:
-            print(f"Error during bulk insert: {e}")
+    async def _mirror_predictions(self, ttl: float):
+        """Drop predictions older than ttl seconds, then write self.predictions as one INSERT ... ON CONFLICT DO UPDATE."""
+        predictions = self.predictions
+        await self.session.execute(EXPIRE_PREDICTIONS_QUERY, {"ttl": ttl})
+        result = await self.session.execute(UPSERT_PREDICTIONS_QUERY, {
+            "trip_ids": [trip_id for trip_id, _ in predictions],
+            "stop_sequences": [stop_sequence for _, stop_sequence in predictions],
+            "stop_ids": [stop_id for stop_id, _, _ in predictions.values()],
+            "arrival_times": [arrival_time for _, arrival_time, _ in predictions.values()],
+            "departure_times": [departure_time for _, _, departure_time in predictions.values()],
+        })
+        print(f"Mirrored {result.rowcount} of {len(predictions)} stop_time predictions.")
 
 async def main():
     async for session in db_manager.get_session():
-        rt_parser = GTFSRealtimeParser(session, GTFS_REALTIME_API_PATH)
+        rt_parser = GTFSRealtimeParser(session, settings.gtfs_realtime_url)
         await rt_parser.fetch_gtfs_rt_data()
         await rt_parser.get_bus_positions()
-        await rt_parser.update_stop_times()
+        await rt_parser.update_predictions()
 
 if __name__ == "__main__":
     start_time = time.perf_counter()
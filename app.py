@@ -1,21 +1,44 @@
 from fastapi import FastAPI, Request, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
-from crud import get_trips_within_hour, get_all_stops, update_stop_times_and_get_buses, get_shape_for_bus, get_routes_by_stop_id, stops_on_route
-from fastapi.responses import JSONResponse
+from crud import get_trips_within_hour, get_shape_for_bus, get_routes_by_stop_id, stops_on_route
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
 import uvicorn
 import subprocess
+import asyncio
+from datetime import datetime
+from config import settings
 from db_manager import db_manager
-from make_route import query_graphql
-from constants import GRAPHQL_QUERY
+from realtime_poller import realtime_poller
+from coordination import coordinator
+from delay_overlay import delay_overlay
+from http_client import http_client
+import metrics
+from metrics import RequestMetricsMiddleware, journey_plan_seconds, route_plans
+from timetable import TimetableIndex, seconds_since_midnight
+from shape_cache import ShapeCache, encode_shape
+from shape_snapping import ShapeSnapper
+from stop_index import StopGridIndex
+from route_adjacency import RouteAdjacency
+from responses import cached_response
+from geo import parse_bbox
+from bus_stream import bus_events
+from make_route import route_planner
+from raptor import JourneyPlanner
+from timetable_snapshot import TimetableSnapshot
 from DatabaseReset import GTFSDataReloader
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from constants import TARGET
-from constants import ZIP_URLS, CYPRUS_TZ, SOURCE
-all_stops = []
+from constants import ZIP_URLS, CYPRUS_TZ
+stop_index = None
+timetable_index = None
+shape_cache = None
+journey_planner = None
+route_adjacency = None
+static_data_loaded = asyncio.Event()
 BELOW_NORMAL_PRIORITY_CLASS = 0x00004000
 
 
@@ -23,43 +46,124 @@ def start_otp_low_priority():
     cmd = f'java -Xmx128M -jar otp-shaded-2.7.0.jar --load "{TARGET}" --port 8085'
     return subprocess.Popen(cmd, creationflags=BELOW_NORMAL_PRIORITY_CLASS, shell=True)
 
+async def refresh_static_data():
+    """Re-read the in-memory copies of static GTFS data after the database changed."""
+    async with db_manager.session_factory() as session:
+        # Mapped from the file the reload wrote, or built from the database when there is none yet
+        snapshot = await TimetableSnapshot.load(session, settings.timetable_snapshot_folder)
+    global stop_index, timetable_index, shape_cache, journey_planner, route_adjacency
+    stop_index = StopGridIndex.from_snapshot(snapshot)
+    route_adjacency = RouteAdjacency.from_snapshot(snapshot)
+    timetable_index = TimetableIndex.from_snapshot(snapshot)
+    shape_cache = ShapeCache.from_snapshot(snapshot)
+    realtime_poller.snapper = await ShapeSnapper.from_snapshot(snapshot, timetable_index)
+    journey_planner = await JourneyPlanner.from_snapshot(snapshot, timetable_index)
+    static_data_loaded.set()
+
+async def reload_gtfs_data(reloader: GTFSDataReloader):
+    try:
+        changed = await reloader.run_all()
+    except Exception as e:
+        print(f"GTFS reload failed, keeping the current dataset: {e}")
+        return
+    await coordinator.notify_dataset_changed(changed)
+    await follow_reload(changed)
+
+async def follow_reload(changed: bool):
+    # Added trips are cleared and renumbered by every reload
+    delay_overlay.clear()
+    if changed:
+        await refresh_static_data()
+
+class LeaderDuties:
+    def __init__(self, reloader: GTFSDataReloader):
+        """The work a single worker does for all of them: GTFS reloads and their cron, OTP and GTFS-RT polling."""
+        self.reloader = reloader
+        self.reload_task = None
+        self.otp_process = None
+        self.scheduler = None
+
+    async def start(self):
+        if await self.reloader.has_live_data():
+            # Serve the previous dataset while the new one is built in the staging schema
+            if timetable_index is None:
+                await refresh_static_data()
+            self.reload_task = asyncio.create_task(reload_gtfs_data(self.reloader))
+        else:
+            await self.reloader.run_all()
+            await coordinator.notify_dataset_changed(True)
+            await refresh_static_data()
+        # Start OTP, only needed for journeys the built-in planner cannot answer
+        if settings.otp_enabled:
+            self.otp_process = start_otp_low_priority()
+            print(f"OTP server PID {self.otp_process.pid} started.")
+        # Schedule the GTFS data reload job
+        self.scheduler = AsyncIOScheduler()
+        trigger = CronTrigger(
+            hour=3,
+            minute=0,
+            timezone=CYPRUS_TZ
+        )
+        self.scheduler.add_job(reload_gtfs_data, trigger, args=[self.reloader], id="daily_gtfs_reload")
+        self.scheduler.start()
+        # One shared GTFS-RT poll loop instead of one fetch per /api/get_buses request, handed on to the followers
+        realtime_poller.share = coordinator.publish_realtime
+        realtime_poller.start()
+
+    async def stop(self):
+        if self.reload_task is not None and not self.reload_task.done():
+            self.reload_task.cancel()
+        await realtime_poller.stop()
+        realtime_poller.share = None
+        if self.scheduler is not None:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+            print("Scheduler shut down.")
+        if self.otp_process is not None:
+            self.otp_process.terminate()
+            self.otp_process = None
+            print("OTP server terminated.")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     reloader = GTFSDataReloader(
         db_manager=db_manager,
-        gtfs_folder=SOURCE,
-        zip_urls=ZIP_URLS
+        gtfs_folder=settings.gtfs_source_folder,
+        zip_urls=ZIP_URLS,
+        snapshot_folder=settings.timetable_snapshot_folder
     )
     "Upload GTFS data to the database when the app starts"
-    await reloader.run_all()
-    async with db_manager.session_factory() as session:
-        global all_stops
-        all_stops = await get_all_stops(session)
-    # Start OTP
-    otp_process = start_otp_low_priority()
-    print(f"OTP server PID {otp_process.pid} started.")
-    # Schedule the GTFS data reload job
-    scheduler = AsyncIOScheduler()
-    trigger = CronTrigger(
-        hour=3,
-        minute=0,
-        timezone=CYPRUS_TZ
+    await http_client.start()
+    leader_duties = LeaderDuties(reloader)
+    # With several uvicorn workers only the one holding the advisory lock reloads, polls and runs OTP
+    is_leader = await coordinator.start(
+        on_promoted=leader_duties.start,
+        on_demoted=leader_duties.stop,
+        on_dataset_changed=follow_reload,
+        on_realtime=realtime_poller.apply_shared
     )
-    scheduler.add_job(reloader.run_all, trigger, id="daily_gtfs_reload")
-    scheduler.start()
+    if is_leader:
+        await leader_duties.start()
+    else:
+        if await reloader.has_live_data():
+            await refresh_static_data()
+        # Otherwise the leader is loading the first dataset; its notification, or a takeover, loads it here
+        await static_data_loaded.wait()
+        await coordinator.load_realtime()
 
     try:
         yield
     finally:
         # Shutdown scheduler and OTP on app exit
-        scheduler.shutdown(wait=False)
-        print("Scheduler shut down.")
-        otp_process.terminate()
-        print("OTP server terminated.")
-        await db_manager.engine.dispose
+        await leader_duties.stop()
+        await coordinator.stop()
+        metrics.mark_process_dead()
+        await http_client.close()
+        await db_manager.engine.dispose()
         print("Database sessions closed.")
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware)
 
 # Set up templates
 templates = Jinja2Templates(directory="templates")
@@ -68,39 +172,71 @@ templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 @app.get("/")
-async def home(request: Request, session: AsyncSession = Depends(db_manager.scoped_session_dependency)):
-    #buses = await update_stop_times_and_get_buses(session)
-    return templates.TemplateResponse("map.html", {"request": request, "stops": all_stops, "buses": []})
+async def home(request: Request):
+    # Stops are fetched per viewport from /api/stops, so the page does not grow with the network
+    return templates.TemplateResponse("map.html", {"request": request, "buses": []})
+
+@app.get("/metrics")
+async def get_metrics():
+    """Every metric of this process in the Prometheus text format."""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/api/stops")
+async def get_stops(bbox: str, zoom: int = None):
+    """Stops inside bbox (min_lon,min_lat,max_lon,max_lat); below STOP_MIN_ZOOM they come as clusters with a count."""
+    if stop_index is None:
+        raise HTTPException(status_code=503, detail="Stops are not loaded yet.")
+    visible = parse_bbox(bbox)
+    if visible is None:
+        raise HTTPException(status_code=400, detail="bbox is required.")
+    return Response(content=stop_index.query(visible, zoom), media_type="application/json")
 
 @app.get("/stops/{stop_id}")
 async def trips_within_hour(stop_id: int, session: AsyncSession = Depends(db_manager.scoped_session_dependency)):
-    routes = await get_trips_within_hour(session, stop_id)
-    return routes
+    if timetable_index is None:
+        return ORJSONResponse(content=await get_trips_within_hour(session, stop_id))
+    now = datetime.now(CYPRUS_TZ)
+    return ORJSONResponse(content=timetable_index.next_departures(
+        stop_id, seconds_since_midnight(now), overlay=delay_overlay, service_date=now.date()))
 
 @app.get("/stops/routes_stopping_at/{stop_id}")
-async def routes_stopping_at(stop_id: int, session: AsyncSession = Depends(db_manager.scoped_session_dependency)):
+async def routes_stopping_at(request: Request, stop_id: int, session: AsyncSession = Depends(db_manager.scoped_session_dependency)):
+    if route_adjacency is not None:
+        return cached_response(request, route_adjacency.routes_at_body(stop_id))
     routes = await get_routes_by_stop_id(session, stop_id)
-    return routes
+    return ORJSONResponse(content=routes)
 
 @app.get("/api/get_buses")
-async def get_buses(session: AsyncSession = Depends(db_manager.scoped_session_dependency)):
-    buses = []
-    try:
-        buses = await update_stop_times_and_get_buses(session)
-        # print(buses)
-    except Exception as e:
-        print(e)                         
-    return JSONResponse(content=buses)
+async def get_buses():
+    snapshot = realtime_poller.get_snapshot()
+    if snapshot is None:
+        return ORJSONResponse(content=[])
+    return Response(content=snapshot.body, media_type="application/json")
+
+@app.get("/api/buses/stream")
+async def stream_buses(request: Request, bbox: str = None):
+    """Server-Sent Events with the buses in bbox (min_lon,min_lat,max_lon,max_lat): a snapshot, then deltas."""
+    return StreamingResponse(
+        bus_events(request, realtime_poller, parse_bbox(bbox)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.get("/buses/get_stops_on_route/{route_id}")
-async def get_stops_on_route(route_id: int, session: AsyncSession = Depends(db_manager.scoped_session_dependency)):
+async def get_stops_on_route(request: Request, route_id: int, session: AsyncSession = Depends(db_manager.scoped_session_dependency)):
+    if route_adjacency is not None:
+        return cached_response(request, route_adjacency.stops_on_body(route_id))
     stops = await stops_on_route(session, route_id)
-    return JSONResponse(content=stops)
+    return ORJSONResponse(content=stops)
 
 @app.get("/api/get_shape/{route_id}")
-async def get_shape(route_id: int, session: AsyncSession = Depends(db_manager.scoped_session_dependency)):
-    shape = await get_shape_for_bus(session, route_id)
-    return JSONResponse(content=shape)
+async def get_shape(request: Request, route_id: int, zoom: int = None, session: AsyncSession = Depends(db_manager.scoped_session_dependency)):
+    """The route's shape as an encoded polyline, simplified for the given map zoom if one is passed."""
+    shape = shape_cache.get(route_id, zoom) if shape_cache is not None else None
+    if shape is None:
+        points = await get_shape_for_bus(session, route_id)
+        shape = encode_shape(route_id, [(point["lat"], point["lon"]) for point in points])
+    return cached_response(request, shape)
 
 @app.post("/api/make_route")
 async def make_route_endpoint(request: Request):
@@ -125,10 +261,19 @@ async def make_route_endpoint(request: Request):
         raise HTTPException(status_code=400,
                             detail="Coordinates must be provided as numbers.")
 
+    result = []
+    if journey_planner is not None:
+        with journey_plan_seconds.time():
+            result = await asyncio.to_thread(
+                journey_planner.plan, (origin_lat, origin_lng), (dest_lat, dest_lng), overlay=delay_overlay.frozen()
+            )
+    if result or not settings.otp_enabled:
+        route_plans.labels("raptor" if result else "none").inc()
+        return ORJSONResponse(content=result)
+
+    # Nothing within walking distance of a stop: OTP routes over the street network
     try:
-        # Call the synchronous function that queries OTP.
-        result = query_graphql(
-            GRAPHQL_QUERY,
+        result = await route_planner.plan(
             coord_from=(origin_lat, origin_lng),
             coord_to=(dest_lat, dest_lng)
         )
@@ -136,7 +281,8 @@ async def make_route_endpoint(request: Request):
         raise HTTPException(status_code=500,
                             detail=f"Error querying OTP: {str(e)}") from e
 
-    return JSONResponse(content=result)
+    route_plans.labels("otp").inc()
+    return ORJSONResponse(content=result)
 
 if __name__ == "__main__":
     uvicorn.run("app:app", host="127.0.0.1", port=8000, reload=True)
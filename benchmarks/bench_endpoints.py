@@ -0,0 +1,217 @@
+"""
+p50/p99 latency of every app.py endpoint. The app runs under uvicorn in a subprocess, loading the given feeds
+into the database at DB_URL and polling the local GTFS-RT stand-in; OTP is off, so /api/make_route is answered by
+the built-in planner. The OTP client path (query_graphql and RoutePlanner) is timed in-process against the
+GraphQL stand-in.
+
+    python benchmarks/bench_endpoints.py <gtfs_parent_folder> [--requests 200] [--concurrency 1]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, time as day_time
+from pathlib import Path
+
+import httpx
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.results import REPO, summarize, write_results
+from benchmarks.stand_ins import StandIns, SyntheticRealtimeFeed, feed_folders
+from config import settings
+from constants import CYPRUS_TZ, GRAPHQL_QUERY
+from gtfs_reader import FLOAT, INT, read_columns
+
+SERVICE_START = day_time(8, 0)
+# Seconds the app gets to load the feeds and publish its first realtime snapshot
+STARTUP_TIMEOUT = 600
+WARMUP_REQUESTS = 10
+# Half the side of the map viewports asked for, in degrees, at street level and zoomed out
+STREET_VIEW, CITY_VIEW = 0.01, 0.1
+
+
+def sample_requests(gtfs_parent_folder: str, count: int, seed: int) -> dict[str, list[tuple]]:
+    """endpoint name -> count (method, path, json body) requests on random stops and routes of the feeds."""
+    rng = np.random.default_rng(seed)
+    folders = feed_folders(gtfs_parent_folder)
+    stops = [read_columns(folder, "stops.txt", {"stop_id": INT, "stop_lat": FLOAT, "stop_lon": FLOAT})
+             for folder in folders]
+    stop_ids = np.concatenate([s["stop_id"] for s in stops])
+    lats, lons = np.concatenate([s["stop_lat"] for s in stops]), np.concatenate([s["stop_lon"] for s in stops])
+    route_ids = np.concatenate([read_columns(folder, "routes.txt", {"route_id": INT})["route_id"]
+                                for folder in folders])
+
+    def stops_sample():
+        picked = rng.integers(len(stop_ids), size=count)
+        return zip(stop_ids[picked].tolist(), lats[picked].tolist(), lons[picked].tolist())
+
+    def bbox(lat, lon, half):
+        return f"{lon - half},{lat - half},{lon + half},{lat + half}"
+
+    routes = rng.choice(route_ids, size=count).tolist()
+    origins, destinations = list(stops_sample()), list(stops_sample())
+    return {
+        "GET /": [("GET", "/", None)] * count,
+        "GET /api/stops street": [("GET", f"/api/stops?bbox={bbox(lat, lon, STREET_VIEW)}&zoom=16", None)
+                                  for _, lat, lon in stops_sample()],
+        "GET /api/stops city": [("GET", f"/api/stops?bbox={bbox(lat, lon, CITY_VIEW)}&zoom=12", None)
+                                for _, lat, lon in stops_sample()],
+        "GET /stops/{stop_id}": [("GET", f"/stops/{stop_id}", None) for stop_id, _, _ in stops_sample()],
+        "GET /stops/routes_stopping_at/{stop_id}": [("GET", f"/stops/routes_stopping_at/{stop_id}", None)
+                                                    for stop_id, _, _ in stops_sample()],
+        "GET /api/get_buses": [("GET", "/api/get_buses", None)] * count,
+        "GET /metrics": [("GET", "/metrics", None)] * count,
+        "GET /api/buses/stream": [("STREAM", "/api/buses/stream", None)] * count,
+        "GET /buses/get_stops_on_route/{route_id}": [("GET", f"/buses/get_stops_on_route/{route_id}", None)
+                                                     for route_id in routes],
+        "GET /api/get_shape/{route_id}": [("GET", f"/api/get_shape/{route_id}?zoom=14", None) for route_id in routes],
+        "POST /api/make_route": [
+            ("POST", "/api/make_route", {"origin": {"lat": origin[1], "lng": origin[2]},
+                                         "destination": {"lat": destination[1], "lng": destination[2]}})
+            for origin, destination in zip(origins, destinations)
+        ],
+    }
+
+
+async def timed_request(client: httpx.AsyncClient, method: str, path: str, body) -> tuple[float, bool]:
+    start = time.perf_counter()
+    try:
+        if method == "STREAM":
+            # Until the first event, the snapshot every new subscriber gets
+            async with client.stream("GET", path) as response:
+                async for line in response.aiter_lines():
+                    if not line:
+                        break
+        else:
+            response = await client.request(method, path, json=body)
+    except httpx.HTTPError:
+        return time.perf_counter() - start, False
+    return time.perf_counter() - start, response.status_code == 200
+
+
+async def time_endpoints(base_url: str, requests: dict[str, list[tuple]], concurrency: int) -> dict:
+    metrics = {}
+    slots = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=30.0) as client:
+        async def one(request):
+            async with slots:
+                return await timed_request(client, *request)
+
+        for name, endpoint_requests in requests.items():
+            for request in endpoint_requests[:WARMUP_REQUESTS]:
+                await one(request)
+            results = await asyncio.gather(*(one(request) for request in endpoint_requests))
+            metrics[name] = summarize([seconds for seconds, _ in results])
+            metrics[name]["errors"] = sum(1 for _, ok in results if not ok)
+            print(f"{name}: p50 {metrics[name]['p50'] * 1000:.2f}ms, p99 {metrics[name]['p99'] * 1000:.2f}ms, "
+                  f"{metrics[name]['errors']} errors")
+    return metrics
+
+
+async def time_otp_client(graphql_url: str, requests: list[tuple]) -> dict:
+    """query_graphql on every request, then RoutePlanner.plan twice per request (a miss, then a cached hit)."""
+    from http_client import http_client
+    from make_route import RoutePlanner, query_graphql
+
+    settings.otp_graphql_url = graphql_url
+    planner = RoutePlanner(cache_size=settings.route_cache_size, ttl=settings.route_cache_ttl,
+                           max_concurrency=settings.otp_max_concurrency)
+    await http_client.start()
+    samples = {"query_graphql": [], "plan_miss": [], "plan_hit": []}
+    for _, _, body in requests:
+        origin = (body["origin"]["lat"], body["origin"]["lng"])
+        destination = (body["destination"]["lat"], body["destination"]["lng"])
+        start = time.perf_counter()
+        await query_graphql(GRAPHQL_QUERY, origin, destination)
+        samples["query_graphql"].append(time.perf_counter() - start)
+        for name in ("plan_miss", "plan_hit"):
+            start = time.perf_counter()
+            await planner.plan(origin, destination)
+            samples[name].append(time.perf_counter() - start)
+    await http_client.close()
+    return {f"otp.{name}": summarize(values) for name, values in samples.items()}
+
+
+def wait_until_ready(base_url: str, app_process: subprocess.Popen):
+    """The app is ready once it serves a realtime snapshot, which needs the static data loaded first."""
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if app_process.poll() is not None:
+            raise RuntimeError(f"The app exited with status {app_process.returncode}")
+        try:
+            if httpx.get(base_url + "/api/get_buses", timeout=5.0).json():
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(1.0)
+    raise RuntimeError(f"The app was not ready within {STARTUP_TIMEOUT}s")
+
+
+def keep_advancing(stand_ins: StandIns, interval: float, stop: threading.Event):
+    while not stop.wait(interval):
+        stand_ins.advance(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("gtfs_parent_folder", help="Feeds the app loads and the requests are drawn from")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight at once")
+    parser.add_argument("--vehicles", type=int, default=300, help="Trips reported per synthetic message")
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Folder for the results file")
+    args = parser.parse_args()
+
+    folders = feed_folders(args.gtfs_parent_folder)
+    service_time = datetime.combine(datetime.now(CYPRUS_TZ).date(), SERVICE_START, tzinfo=CYPRUS_TZ)
+    feed = SyntheticRealtimeFeed(folders, vehicles=args.vehicles, seed=args.seed)
+    requests = sample_requests(args.gtfs_parent_folder, args.requests, args.seed)
+    base_url = f"http://127.0.0.1:{args.port}"
+    with StandIns(feed, service_time=service_time) as stand_ins, \
+            tempfile.NamedTemporaryFile("w", prefix="bench_app_", suffix=".log", delete=False) as log:
+        env = {
+            **os.environ,
+            "GTFS_SOURCE_FOLDER": os.path.abspath(args.gtfs_parent_folder),
+            "GTFS_REALTIME_URL": stand_ins.realtime_url,
+            "OTP_GRAPHQL_URL": stand_ins.graphql_url,
+            "OTP_ENABLED": "false",
+            "GTFS_DOWNLOAD_FEEDS": "false",
+        }
+        app_process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(args.port),
+             "--log-level", "warning"],
+            cwd=REPO, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+        stop = threading.Event()
+        advancer = threading.Thread(target=keep_advancing, args=(stand_ins, settings.realtime_poll_interval, stop),
+                                    daemon=True)
+        try:
+            start = time.perf_counter()
+            wait_until_ready(base_url, app_process)
+            print(f"App ready in {time.perf_counter() - start:.1f}s (log: {log.name})")
+            advancer.start()
+            metrics = asyncio.run(time_endpoints(base_url, requests, args.concurrency))
+            otp_metrics = asyncio.run(time_otp_client(stand_ins.graphql_url, requests["POST /api/make_route"]))
+            for name, values in otp_metrics.items():
+                print(f"{name}: p50 {values['p50'] * 1000:.2f}ms, p99 {values['p99'] * 1000:.2f}ms")
+            metrics.update(otp_metrics)
+        finally:
+            stop.set()
+            app_process.terminate()
+            app_process.wait()
+
+    write_results("endpoints", {
+        "feeds": sorted(os.path.basename(folder) for folder in folders), "requests": args.requests,
+        "concurrency": args.concurrency, "vehicles": args.vehicles, "seed": args.seed,
+    }, metrics, args.output)
+
+
+if __name__ == "__main__":
+    main()
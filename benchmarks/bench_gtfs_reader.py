@@ -0,0 +1,74 @@
+"""
+Parse throughput of the GTFS loader: csv.DictReader with per-field int()/float()/parse_time (the old path)
+against the typed column reader in gtfs_reader.py, on the largest files of every feed.
+
+    python benchmarks/bench_gtfs_reader.py [gtfs_parent_folder]
+"""
+import csv
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.results import write_results
+from constants import SOURCE
+from gtfs_reader import INT, FLOAT, TIME, iter_columns, parse_time, to_records
+
+REPEATS = 3
+
+SCHEMAS = {
+    "stop_times.txt": {"trip_id": INT, "arrival_time": TIME, "departure_time": TIME, "stop_id": INT, "stop_sequence": INT},
+    "shapes.txt": {"shape_id": INT, "shape_pt_lat": FLOAT, "shape_pt_lon": FLOAT, "shape_pt_sequence": INT},
+}
+PARSERS = {INT: int, FLOAT: float, TIME: parse_time}
+
+
+def dict_reader_rows(file_path: str, schema: dict[str, str]) -> list[tuple]:
+    parsers = [(column, PARSERS[kind]) for column, kind in schema.items()]
+    with open(file_path, mode="r", encoding="utf-8-sig") as file:
+        return [tuple(parse(row[column]) for column, parse in parsers) for row in csv.DictReader(file)]
+
+
+def column_reader_rows(file_path: str, schema: dict[str, str]) -> list[tuple]:
+    folder, file_name = os.path.split(file_path)
+    rows = []
+    for columns in iter_columns(folder, file_name, schema):
+        rows += to_records(columns, list(schema))
+    return rows
+
+
+def best_time(function, *args) -> tuple[float, list]:
+    best, result = float("inf"), None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(gtfs_parent_folder: str):
+    totals = {"DictReader": [0, 0.0], "gtfs_reader": [0, 0.0]}
+    for feed in sorted(os.listdir(gtfs_parent_folder)):
+        for file_name, schema in SCHEMAS.items():
+            file_path = os.path.join(gtfs_parent_folder, feed, file_name)
+            if not os.path.isfile(file_path):
+                continue
+            old_seconds, old_rows = best_time(dict_reader_rows, file_path, schema)
+            new_seconds, new_rows = best_time(column_reader_rows, file_path, schema)
+            if old_rows != new_rows:
+                print(f"MISMATCH {feed}/{file_name}: the two readers returned different rows")
+            for name, seconds in (("DictReader", old_seconds), ("gtfs_reader", new_seconds)):
+                totals[name][0] += len(new_rows)
+                totals[name][1] += seconds
+            print(f"{feed}/{file_name}: {len(new_rows)} rows, DictReader {old_seconds:.3f}s, "
+                  f"gtfs_reader {new_seconds:.3f}s ({old_seconds / max(new_seconds, 1e-9):.1f}x)")
+    for name, (rows, seconds) in totals.items():
+        print(f"{name}: {rows} rows in {seconds:.3f}s ({rows / max(seconds, 1e-9):.0f} rows/s)")
+    write_results("gtfs_reader", {"gtfs_parent_folder": os.path.abspath(gtfs_parent_folder), "repeats": REPEATS},
+                  {name: {"seconds": seconds, "rows": rows} for name, (rows, seconds) in totals.items()})
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else SOURCE)
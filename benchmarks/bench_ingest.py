@@ -0,0 +1,116 @@
+"""
+Static GTFS ingest on synthetic feeds: parse_feed per feed (the CPU side of GTFSParser), and with --load the
+database side too: a full reload, a reload with nothing changed and a reload after one feed changed, and
+writing and mapping the timetable snapshot.
+--load replaces the dataset in the database DB_URL points to, so point it at a scratch database.
+
+    python benchmarks/bench_ingest.py [--scale 1] [--seed 0] [--repeats 1] [--load] [--keep <folder>]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.results import write_results
+from benchmarks.synthetic_gtfs import generate_feeds
+
+# The feed whose files are swapped for another seed's to time an incremental reload
+CHANGED_FEED = "2_google_transit"
+
+
+def time_parse(folders: list[str], repeats: int) -> tuple[dict, dict]:
+    from GTFS_Parsing import parse_feed, parse_stops
+
+    seconds, rows = {}, {}
+    for folder in folders:
+        feed = os.path.basename(folder)
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            tables = parse_feed(folder)
+            tables["stops"] = parse_stops(folder)
+            best = min(best, time.perf_counter() - start)
+        seconds[feed] = best
+        for table, records in tables.items():
+            rows[table] = rows.get(table, 0) + len(records)
+    seconds["total"] = sum(seconds.values())
+    return seconds, rows
+
+
+async def time_reloads(gtfs_parent_folder: str, scale: float, seed: int) -> dict:
+    from DatabaseReset import DatabaseReset
+    from db_manager import db_manager
+    from timetable import TimetableIndex
+    from timetable_snapshot import TimetableSnapshot
+
+    db_reset = DatabaseReset(db_manager, gtfs_parent_folder)
+    seconds = {}
+    start = time.perf_counter()
+    await db_reset.reload(full=True)
+    seconds["full"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await db_reset.reload()
+    seconds["unchanged"] = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as snapshot_folder:
+        async with db_manager.session_factory() as session:
+            start = time.perf_counter()
+            await TimetableSnapshot.write(session, snapshot_folder)
+            seconds["snapshot_write"] = time.perf_counter() - start
+            start = time.perf_counter()
+            snapshot = await TimetableSnapshot.load(session, snapshot_folder)
+            TimetableIndex.from_snapshot(snapshot)
+            seconds["snapshot_map"] = time.perf_counter() - start
+        del snapshot
+
+    with tempfile.TemporaryDirectory() as other_folder:
+        generate_feeds(other_folder, scale, seed + 1)
+        changed_folder = os.path.join(gtfs_parent_folder, CHANGED_FEED)
+        shutil.rmtree(changed_folder)
+        shutil.copytree(os.path.join(other_folder, CHANGED_FEED), changed_folder)
+    start = time.perf_counter()
+    await db_reset.reload()
+    seconds["one_feed_changed"] = time.perf_counter() - start
+    await db_manager.engine.dispose()
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=float, default=1.0, help="Size of the feeds, 1 is about today's")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=1, help="Parse every feed this often and keep the best")
+    parser.add_argument("--load", action="store_true", help="Also time reloads into the database at DB_URL")
+    parser.add_argument("--keep", help="Generate the feeds into this folder and leave them there")
+    parser.add_argument("--output", help="Folder for the results file")
+    args = parser.parse_args()
+
+    gtfs_parent_folder = args.keep or tempfile.mkdtemp(prefix="synthetic_gtfs_")
+    try:
+        start = time.perf_counter()
+        folders = generate_feeds(gtfs_parent_folder, args.scale, args.seed)
+        print(f"Generated {len(folders)} feeds at scale {args.scale} in {time.perf_counter() - start:.1f}s")
+        parse_seconds, rows = time_parse(folders, args.repeats)
+        metrics = {"parse": parse_seconds, "rows": rows}
+        if args.load:
+            metrics["reload"] = asyncio.run(time_reloads(gtfs_parent_folder, args.scale, args.seed))
+    finally:
+        if not args.keep:
+            shutil.rmtree(gtfs_parent_folder, ignore_errors=True)
+
+    for group, values in metrics.items():
+        for name, value in values.items():
+            print(f"{group}.{name}: {value:.3f}s" if isinstance(value, float) else f"{group}.{name}: {value}")
+    write_results("ingest", {"scale": args.scale, "seed": args.seed, "repeats": args.repeats, "load": args.load},
+                  metrics, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Per-tick cost of the realtime path against the local GTFS-RT stand-in: GTFSRealtimeParser's fetch,
+update_predictions and get_bus_positions one by one, then RealtimePoller.poll_once as the app runs it
+(with shape snapping and the delay overlay). The database at DB_URL must hold the same feeds, e.g. after
+`bench_ingest.py --load --keep <folder>`.
+
+    python benchmarks/bench_realtime.py <gtfs_parent_folder> [--ticks 50] [--vehicles 300] [--recorded a.pb ...]
+"""
+import argparse
+import asyncio
+import sys
+from datetime import datetime, time as day_time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.results import Stopwatch, summarize, write_results
+from benchmarks.stand_ins import RecordedRealtimeFeed, StandIns, SyntheticRealtimeFeed, feed_folders
+from config import settings
+from constants import CYPRUS_TZ
+from db_manager import db_manager
+from delay_overlay import DelayOverlay
+from GTFS_Parsing import GTFSRealtimeParser
+from http_client import http_client
+from realtime_poller import RealtimePoller
+from shape_cache import load_shape_points
+from shape_snapping import ShapeSnapper
+from timetable import TimetableIndex
+
+# Simulated time of the first tick, a busy weekday-morning hour whatever time the benchmark runs at
+SERVICE_START = day_time(8, 0)
+
+
+async def run(stand_ins: StandIns, ticks: int, interval: float, mirror: bool) -> dict:
+    await http_client.start()
+    async with db_manager.session_factory() as session:
+        timetable = await TimetableIndex.load(session)
+        shapes = await load_shape_points(session)
+        snapper = await ShapeSnapper.load(session, timetable, shapes)
+    overlay = DelayOverlay(settings.realtime_prediction_ttl)
+    poller = RealtimePoller(db_manager, stand_ins.realtime_url, interval, settings.realtime_max_staleness,
+                            overlay, mirror_predictions=mirror)
+    poller.snapper = snapper
+    mirror_ttl = overlay.ttl if mirror else None
+
+    stopwatches = {name: Stopwatch() for name in ("fetch", "update_predictions", "get_bus_positions", "poll_once")}
+    entities = vehicles = 0
+    for _ in range(ticks):
+        stand_ins.advance(interval)
+        async with db_manager.session_factory() as session:
+            rt_parser = GTFSRealtimeParser(session, stand_ins.realtime_url)
+            with stopwatches["fetch"]:
+                await rt_parser.fetch_gtfs_rt_data()
+            with stopwatches["update_predictions"]:
+                await rt_parser.update_predictions(mirror_ttl)
+            with stopwatches["get_bus_positions"]:
+                buses = await rt_parser.get_bus_positions()
+        entities, vehicles = len(rt_parser.feed.entity), len(buses)
+
+        stand_ins.advance(interval)
+        with stopwatches["poll_once"]:
+            await poller.poll_once()
+    await http_client.close()
+    await db_manager.engine.dispose()
+
+    metrics = {name: summarize(stopwatch.samples) for name, stopwatch in stopwatches.items()}
+    metrics["feed"] = {"entities": entities, "vehicles": vehicles, "overlay_predictions": len(overlay)}
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("gtfs_parent_folder", help="The feeds loaded into the database")
+    parser.add_argument("--ticks", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=settings.realtime_poll_interval,
+                        help="Simulated seconds between two ticks")
+    parser.add_argument("--vehicles", type=int, default=300, help="Trips reported per synthetic message")
+    parser.add_argument("--recorded", nargs="+", help="Replay these recordings instead of synthetic messages")
+    parser.add_argument("--no-mirror", action="store_true", help="Do not mirror predictions into the database")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Folder for the results file")
+    args = parser.parse_args()
+
+    if args.recorded:
+        feed = RecordedRealtimeFeed(args.recorded)
+    else:
+        feed = SyntheticRealtimeFeed(feed_folders(args.gtfs_parent_folder), vehicles=args.vehicles, seed=args.seed)
+    service_time = datetime.combine(datetime.now(CYPRUS_TZ).date(), SERVICE_START, tzinfo=CYPRUS_TZ)
+    with StandIns(feed, service_time=service_time) as stand_ins:
+        metrics = asyncio.run(run(stand_ins, args.ticks, args.interval, not args.no_mirror))
+
+    for name, values in metrics.items():
+        print(f"{name}: " + ", ".join(
+            f"{key} {value * 1000:.2f}ms" if isinstance(value, float) else f"{key} {value}"
+            for key, value in values.items()
+        ))
+    write_results("realtime", {
+        "ticks": args.ticks, "interval": args.interval, "vehicles": args.vehicles, "seed": args.seed,
+        "recorded": [Path(path).name for path in args.recorded or []], "mirror": not args.no_mirror,
+    }, metrics, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Compare two results files of the same benchmark, typically the last run on main against a branch.
+Timings that got slower by more than the threshold are flagged, and the exit status is 1 if any were.
+
+    python benchmarks/compare.py <baseline.json> <candidate.json> [threshold, default 0.10]
+"""
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.results import flatten
+
+DEFAULT_THRESHOLD = 0.10
+# Metric name parts that mark counts rather than durations
+NOT_TIMINGS = {"count", "rows", "feed", "requests", "errors"}
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def compare(baseline: dict, candidate: dict, threshold: float) -> list[str]:
+    """Print every metric side by side and return the names of the regressed ones."""
+    if baseline["benchmark"] != candidate["benchmark"]:
+        raise ValueError(f"Cannot compare {baseline['benchmark']} with {candidate['benchmark']}")
+    if baseline["parameters"] != candidate["parameters"]:
+        print(f"Warning: the parameters differ: {baseline['parameters']} vs {candidate['parameters']}")
+    old, new = flatten(baseline["metrics"]), flatten(candidate["metrics"])
+    regressions = []
+    print(f"{'metric':<50} {baseline['commit']:>14} {candidate['commit']:>14}   change")
+    for name in sorted(old.keys() | new.keys()):
+        if name not in old or name not in new:
+            print(f"{name:<50} {old.get(name, '-'):>14} {new.get(name, '-'):>14}")
+            continue
+        change = (new[name] - old[name]) / old[name] if old[name] else 0.0
+        is_timing = not NOT_TIMINGS & set(name.split("."))
+        flag = "  REGRESSION" if is_timing and change > threshold else ""
+        if flag:
+            regressions.append(name)
+        print(f"{name:<50} {old[name]:>14.6g} {new[name]:>14.6g} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main(baseline_path: str, candidate_path: str, threshold: float) -> int:
+    regressions = compare(load(baseline_path), load(candidate_path), threshold)
+    print(f"{len(regressions)} regression(s) above {threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(2)
+    sys.exit(main(sys.argv[1], sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_THRESHOLD))
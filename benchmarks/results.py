@@ -0,0 +1,87 @@
+"""
+Timing helpers and the results files every benchmark writes, so two commits can be compared with compare.py.
+A results file is JSON: the benchmark name, the commit, when and where it ran, its parameters and a flat
+{metric: seconds} map.
+"""
+import json
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+REPO = Path(__file__).resolve().parent.parent
+RESULTS_FOLDER = REPO / "benchmarks" / "results"
+
+
+def git_commit() -> str:
+    """Short hash of HEAD, with -dirty appended when the tree has uncommitted changes."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + "-dirty" if dirty else commit
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    """p50, p99, mean and max of a list of durations in seconds."""
+    values = np.asarray(samples, dtype=float)
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(values.mean()),
+        "max": float(values.max()),
+        "count": len(values),
+    }
+
+
+class Stopwatch:
+    """Collects the duration of every `with stopwatch:` block."""
+    def __init__(self):
+        self.samples = []
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.samples.append(time.perf_counter() - self._start)
+
+
+def write_results(name: str, parameters: dict, metrics: dict, output_folder: str = None) -> str:
+    """Write one results file named <name>-<utc time>-<commit>.json and return its path."""
+    now = datetime.now(timezone.utc)
+    commit = git_commit()
+    document = {
+        "benchmark": name,
+        "commit": commit,
+        "timestamp": now.isoformat(timespec="seconds"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "parameters": parameters,
+        "metrics": metrics,
+    }
+    folder = Path(output_folder) if output_folder else RESULTS_FOLDER
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder / f"{name}-{now:%Y%m%dT%H%M%SZ}-{commit}.json"
+    path.write_text(json.dumps(document, indent=2, sort_keys=True), encoding="utf-8")
+    print(f"Results written to {path}")
+    return str(path)
+
+
+def flatten(metrics: dict, prefix: str = "") -> dict[str, float]:
+    """{"a": {"p50": 1}} -> {"a.p50": 1}, skipping anything that is not a number."""
+    flat = {}
+    for key, value in metrics.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
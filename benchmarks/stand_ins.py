@@ -0,0 +1,343 @@
+"""
+Local stand-ins for the two upstreams the app talks to at request time, so benchmarks never touch the network:
+the GTFS-RT feed (synthetic FeedMessages built from a set of GTFS folders, or recorded ones replayed in a loop)
+and the OTP GraphQL endpoint (canned planConnection answers in the shape query_graphql expects).
+
+    python benchmarks/stand_ins.py serve <gtfs_parent_folder> [port]    # run both until Ctrl+C
+    python benchmarks/stand_ins.py record <output.pb> [count] [interval]  # save live feeds for replaying
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import polyline
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import gtfs_realtime_pb2
+from constants import CYPRUS_TZ
+from gtfs_reader import FLOAT, INT, STR, TIME, read_columns
+
+REALTIME_PATH = "/gtfs-rt"
+GRAPHQL_PATH = "/otp/gtfs/v1"
+DEFAULT_VEHICLES = 300
+# Vehicles that are reported on ADDED trips, which carry no trip_id
+DEFAULT_ADDED_TRIPS = 5
+# Delays drawn for the vehicles, in seconds
+MIN_DELAY, MAX_DELAY = -60, 420
+STUB_ITINERARIES = 3
+STUB_BUS_SPEED = 7.0
+STUB_WALK_SPEED = 1.2
+METRES_PER_DEGREE = 111_320
+
+
+def feed_folders(gtfs_parent_folder: str) -> list[str]:
+    # Same as GTFS_Parsing.feed_folders, which cannot be imported without a database to connect to
+    return sorted(os.path.join(gtfs_parent_folder, name) for name in os.listdir(gtfs_parent_folder)
+                  if os.path.isdir(os.path.join(gtfs_parent_folder, name)))
+
+
+class SyntheticRealtimeFeed:
+    def __init__(self, gtfs_folders: list[str], vehicles: int = DEFAULT_VEHICLES,
+                 added_trips: int = DEFAULT_ADDED_TRIPS, seed: int = 0):
+        """
+        FeedMessages with a vehicle position and the remaining stop time updates of trips running at the
+        simulated time, the way the Cyprus feed sends them: both in the same entity.
+        vehicles: Trips reported per message, fewer if fewer are running.
+        added_trips: How many of them are reported as ADDED trips without a trip_id.
+        """
+        self.vehicles = vehicles
+        self.added_trips = added_trips
+        self.rng = np.random.default_rng(seed)
+        stops = [read_columns(folder, "stops.txt", {"stop_id": INT, "stop_lat": FLOAT, "stop_lon": FLOAT})
+                 for folder in gtfs_folders]
+        stop_ids, first = np.unique(np.concatenate([s["stop_id"] for s in stops]), return_index=True)
+        self._stop_lats = np.concatenate([s["stop_lat"] for s in stops])[first]
+        self._stop_lons = np.concatenate([s["stop_lon"] for s in stops])[first]
+        self._stop_ids = stop_ids
+
+        trips = [read_columns(folder, "trips.txt", {"trip_id": INT, "route_id": INT, "service_id": INT,
+                                                    "direction_id": INT}) for folder in gtfs_folders]
+        self._trips = {column: np.concatenate([t[column] for t in trips]) for column in trips[0]}
+        self._calendar = [read_columns(folder, "calendar_dates.txt", {"service_id": INT, "date": STR,
+                                                                      "exception_type": INT})
+                          for folder in gtfs_folders]
+        calls = [read_columns(folder, "stop_times.txt", {"trip_id": INT, "arrival_time": TIME, "stop_id": INT,
+                                                         "stop_sequence": INT}) for folder in gtfs_folders]
+        calls = {column: np.concatenate([c[column] for c in calls]) for column in calls[0]}
+        order = np.lexsort((calls["stop_sequence"], calls["trip_id"]))
+        self._calls = {column: values[order] for column, values in calls.items()}
+        # Calls of trip i are _calls[...][_starts[i]:_ends[i]]
+        self._call_trips, self._starts = np.unique(self._calls["trip_id"], return_index=True)
+        self._ends = np.append(self._starts[1:], len(self._calls["trip_id"]))
+        self._first_times = self._calls["arrival_time"][self._starts]
+        self._last_times = self._calls["arrival_time"][self._ends - 1]
+        self._trip_index = {trip_id: i for i, trip_id in enumerate(self._trips["trip_id"].tolist())}
+
+    def _running_services(self, service_date) -> np.ndarray:
+        day = service_date.strftime("%Y%m%d")
+        services = [c["service_id"][(c["date"] == day) & (c["exception_type"] == 1)] for c in self._calendar]
+        return np.concatenate(services) if services else np.empty(0, dtype=np.int64)
+
+    def _stop_position(self, stop_id: int) -> tuple[float, float]:
+        i = np.searchsorted(self._stop_ids, stop_id)
+        return float(self._stop_lats[i]), float(self._stop_lons[i])
+
+    def message(self, now: datetime) -> bytes:
+        """A serialized FeedMessage for the trips of now's service day that are on the road at now."""
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        seconds = int((now - midnight).total_seconds())
+        running_trips = self._trips["trip_id"][np.isin(self._trips["service_id"], self._running_services(now.date()))]
+        active = np.flatnonzero(np.isin(self._call_trips, running_trips)
+                                & (self._first_times <= seconds) & (self._last_times > seconds))
+        if len(active) > self.vehicles:
+            active = np.sort(self.rng.choice(active, self.vehicles, replace=False))
+
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = "2.0"
+        feed.header.timestamp = int(now.timestamp())
+        for n, i in enumerate(active.tolist()):
+            trip_id = int(self._call_trips[i])
+            t = self._trip_index[trip_id]
+            route_id, direction_id = int(self._trips["route_id"][t]), int(self._trips["direction_id"][t])
+            start, end = int(self._starts[i]), int(self._ends[i])
+            times = self._calls["arrival_time"][start:end]
+            delay = int(self.rng.integers(MIN_DELAY, MAX_DELAY))
+            # The bus is between the last stop it passed and the next one, shifted by its delay
+            next_call = min(max(int(np.searchsorted(times, seconds - delay, side="right")), 1), len(times) - 1)
+            previous_time, next_time = int(times[next_call - 1]), int(times[next_call])
+            share = min(max((seconds - delay - previous_time) / max(next_time - previous_time, 1), 0.0), 1.0)
+            previous_lat, previous_lon = self._stop_position(int(self._calls["stop_id"][start + next_call - 1]))
+            next_lat, next_lon = self._stop_position(int(self._calls["stop_id"][start + next_call]))
+
+            entity = feed.entity.add()
+            entity.id = str(n)
+            for trip in (entity.trip_update.trip, entity.vehicle.trip):
+                trip.route_id = str(route_id)
+                trip.direction_id = direction_id
+                trip.start_time = f"{int(times[0]) // 3600:02d}:{int(times[0]) // 60 % 60:02d}:00"
+                trip.start_date = now.strftime("%Y%m%d")
+                if n < self.added_trips:
+                    trip.schedule_relationship = gtfs_realtime_pb2.TripDescriptor.ADDED
+                else:
+                    trip.trip_id = str(trip_id)
+            entity.vehicle.position.latitude = previous_lat + (next_lat - previous_lat) * share
+            entity.vehicle.position.longitude = previous_lon + (next_lon - previous_lon) * share
+            entity.vehicle.position.bearing = float(self.rng.uniform(0, 360))
+            entity.vehicle.position.speed = float(self.rng.uniform(0, 15))
+            entity.vehicle.timestamp = int(now.timestamp())
+            for call in range(start + next_call, end):
+                update = entity.trip_update.stop_time_update.add()
+                update.stop_sequence = int(self._calls["stop_sequence"][call])
+                update.stop_id = str(int(self._calls["stop_id"][call]))
+                update.arrival.time = int((midnight + timedelta(seconds=int(self._calls["arrival_time"][call])
+                                                                + delay)).timestamp())
+                update.arrival.delay = delay
+        return feed.SerializeToString()
+
+
+class RecordedRealtimeFeed:
+    def __init__(self, paths: list[str]):
+        """Replays FeedMessages saved with `stand_ins.py record`, one per tick, starting over after the last."""
+        self.messages = []
+        for path in paths:
+            self.messages += read_recording(path)
+        self._next = 0
+
+    def message(self, now: datetime) -> bytes:
+        message = self.messages[self._next % len(self.messages)]
+        self._next += 1
+        return message
+
+
+def read_recording(path: str) -> list[bytes]:
+    """A recording is a sequence of 4 byte big-endian lengths each followed by a serialized FeedMessage."""
+    data, messages, offset = Path(path).read_bytes(), [], 0
+    while offset < len(data):
+        size = int.from_bytes(data[offset:offset + 4], "big")
+        messages.append(data[offset + 4:offset + 4 + size])
+        offset += 4 + size
+    return messages
+
+
+def stub_plan(variables: dict) -> dict:
+    """
+    A planConnection answer with STUB_ITINERARIES walk - bus - walk itineraries between the requested points,
+    leaving a few minutes apart, in the shape OTP returns them (legGeometry still polyline encoded).
+    """
+    origin = (float(variables["latFrom"]), float(variables["lonFrom"]))
+    destination = (float(variables["latTo"]), float(variables["lonTo"]))
+    departure = datetime.fromisoformat(variables["departure"])
+    middle = ((origin[0] + destination[0]) / 2, (origin[1] + destination[1]) / 2)
+    boarding = (origin[0] + (middle[0] - origin[0]) * 0.1, origin[1] + (middle[1] - origin[1]) * 0.1)
+    alighting = (destination[0] + (middle[0] - destination[0]) * 0.1,
+                 destination[1] + (middle[1] - destination[1]) * 0.1)
+    edges = []
+    for n in range(STUB_ITINERARIES):
+        legs, clock = [], departure + timedelta(minutes=5 * n)
+        for mode, start, end, speed in (("WALK", origin, boarding, STUB_WALK_SPEED),
+                                        ("BUS", boarding, alighting, STUB_BUS_SPEED),
+                                        ("WALK", alighting, destination, STUB_WALK_SPEED)):
+            metres = float(np.hypot(end[0] - start[0], end[1] - start[1])) * METRES_PER_DEGREE
+            arrival = clock + timedelta(seconds=int(metres / speed))
+            points = [(start[0] + (end[0] - start[0]) * k / 10, start[1] + (end[1] - start[1]) * k / 10)
+                      for k in range(11)]
+            legs.append({
+                "mode": mode,
+                "from": {"name": "Origin" if not legs else f"Stop {n}", "lat": start[0], "lon": start[1],
+                         "departure": {"scheduledTime": clock.isoformat(), "estimated": None}},
+                "to": {"name": f"Stop {n}" if mode == "WALK" and not legs else "Destination", "lat": end[0],
+                       "lon": end[1], "arrival": {"scheduledTime": arrival.isoformat(), "estimated": None}},
+                "route": {"gtfsId": "1:0", "longName": "Stub route", "shortName": "0"} if mode == "BUS" else None,
+                "legGeometry": {"points": polyline.encode(points)},
+            })
+            clock = arrival
+        edges.append({"node": {"start": legs[0]["from"]["departure"]["scheduledTime"],
+                               "end": legs[-1]["to"]["arrival"]["scheduledTime"], "legs": legs}})
+    return {"data": {"planConnection": {"edges": edges}}}
+
+
+class StandIns:
+    def __init__(self, realtime_feed, port: int = 0, service_time: datetime = None, otp_latency: float = 0.0):
+        """
+        Both upstreams on one local HTTP server, started and stopped with `with StandIns(...) as stand_ins:`.
+        realtime_feed: A SyntheticRealtimeFeed or RecordedRealtimeFeed.
+        service_time: Simulated time of the first message, now by default; pin it to get the same messages
+            whatever time the benchmark runs at.
+        otp_latency: Seconds every GraphQL answer is held back, to stand in for OTP's planning time.
+        """
+        self.realtime_feed = realtime_feed
+        self.service_time = service_time
+        self.otp_latency = otp_latency
+        self.graphql_requests = 0
+        self._version = 0
+        self._message = b""
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+        self.advance(0)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def realtime_url(self) -> str:
+        return self.base_url + REALTIME_PATH
+
+    @property
+    def graphql_url(self) -> str:
+        return self.base_url + GRAPHQL_PATH
+
+    def advance(self, seconds: float):
+        """Move the simulated clock on and publish the next FeedMessage; until then GETs answer 304."""
+        if self.service_time is None:
+            now = datetime.now(CYPRUS_TZ)
+        else:
+            self.service_time += timedelta(seconds=seconds)
+            now = self.service_time
+        message = self.realtime_feed.message(now)
+        with self._lock:
+            self._message = message
+            self._version += 1
+
+    def _current(self) -> tuple[int, bytes]:
+        with self._lock:
+            return self._version, self._message
+
+    def _handler(self):
+        stand_ins = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; without this every answer waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status: int, body: bytes = b"", content_type: str = None, headers: dict = None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                if content_type:
+                    self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != REALTIME_PATH:
+                    return self._reply(404)
+                version, message = stand_ins._current()
+                etag = f'"{version}"'
+                if self.headers.get("If-None-Match") == etag:
+                    return self._reply(304, headers={"ETag": etag})
+                self._reply(200, message, "application/x-protobuf", {"ETag": etag})
+
+            def do_POST(self):
+                if self.path != GRAPHQL_PATH:
+                    return self._reply(404)
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                stand_ins.graphql_requests += 1
+                if stand_ins.otp_latency:
+                    time.sleep(stand_ins.otp_latency)
+                self._reply(200, json.dumps(stub_plan(request["variables"])).encode(), "application/json")
+
+        return Handler
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+async def record(output_path: str, count: int, interval: float):
+    """Append count live FeedMessages, interval seconds apart, to output_path."""
+    from config import settings
+    from http_client import http_client, GTFS_RT_TARGET
+
+    with open(output_path, "ab") as file:
+        for n in range(count):
+            response = await http_client.request(GTFS_RT_TARGET, "GET", settings.gtfs_realtime_url)
+            response.raise_for_status()
+            file.write(len(response.content).to_bytes(4, "big") + response.content)
+            print(f"Recorded message {n + 1}/{count}: {len(response.content)} bytes")
+            if n + 1 < count:
+                await asyncio.sleep(interval)
+    await http_client.close()
+
+
+def serve(gtfs_parent_folder: str, port: int):
+    with StandIns(SyntheticRealtimeFeed(feed_folders(gtfs_parent_folder)), port=port) as stand_ins:
+        print(f"GTFS-RT: {stand_ins.realtime_url}\nGraphQL: {stand_ins.graphql_url}")
+        try:
+            while True:
+                time.sleep(30)
+                stand_ins.advance(30)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "serve":
+        serve(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 8090)
+    elif len(sys.argv) > 2 and sys.argv[1] == "record":
+        asyncio.run(record(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 10,
+                           float(sys.argv[4]) if len(sys.argv) > 4 else 30.0))
+    else:
+        print(__doc__)
@@ -0,0 +1,193 @@
+"""
+Synthetic GTFS feeds shaped like the seven Cyprus feeds, for benchmarks that must not depend on today's download.
+At scale 1 every feed has about the stops, routes, trips, stop_times and shape points of its real counterpart;
+scale multiplies all of them. The same seed, scale and start date always give the same files.
+
+    python benchmarks/synthetic_gtfs.py <output_folder> [scale] [seed]
+"""
+import csv
+import math
+import os
+import sys
+from datetime import date, timedelta
+
+import numpy as np
+
+# feed number -> (stops, routes, trips, stop_times, shape points) of the real feed at scale 1
+FEED_PROFILES = {
+    2: (865, 110, 3301, 60699, 41311),
+    4: (440, 53, 1817, 104432, 33968),
+    5: (121, 66, 560, 7790, 45909),
+    6: (1395, 248, 6517, 0, 60445),
+    9: (1712, 226, 10312, 0, 48955),
+    10: (1054, 154, 2790, 86525, 38429),
+    11: (21, 3, 80, 920, 298),
+}
+# Rough centre of the area every feed serves
+FEED_CENTRES = {
+    2: (34.77, 32.42), 4: (35.02, 33.99), 5: (34.92, 33.62), 6: (35.16, 33.36),
+    9: (34.69, 33.04), 10: (35.10, 33.40), 11: (35.02, 33.80),
+}
+# Half the side of the square the stops of a feed are scattered over, in degrees
+FEED_RADIUS = 0.12
+# Stops of the previous feed every feed also lists, like the stops shared between operators
+SHARED_STOP_FRACTION = 0.05
+# Days from the start date the services run on
+SERVICE_DAYS = 60
+FIRST_DEPARTURE = 5 * 3600
+# Trips leave until this time, the last ones past midnight
+LAST_DEPARTURE = 24 * 3600 + 30 * 60
+BUS_SPEED = 7.0
+DWELL_SECONDS = 20
+# Every fourth trip of a route runs on weekends instead of weekdays
+WEEKEND_TRIP_EVERY = 4
+METRES_PER_DEGREE = 111_320
+
+HEADERS = {
+    "agency.txt": ["agency_id", "agency_name", "agency_url", "agency_timezone", "agency_lang", "agency_phone"],
+    "stops.txt": ["stop_id", "stop_code", "stop_name", "stop_desc", "stop_lat", "stop_lon", "zone_id"],
+    "routes.txt": ["route_id", "agency_id", "route_short_name", "route_long_name", "route_desc", "route_type",
+                   "route_color", "route_text_color"],
+    "trips.txt": ["route_id", "service_id", "trip_id", "trip_headsign", "shape_id", "direction_id"],
+    "stop_times.txt": ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence", "pickup_type",
+                       "drop_off_type"],
+    "shapes.txt": ["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"],
+    "calendar_dates.txt": ["service_id", "date", "exception_type"],
+}
+
+
+def format_time(seconds: int) -> str:
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def write_file(folder: str, file_name: str, rows):
+    # The real feeds start every file with a BOM
+    with open(os.path.join(folder, file_name), "w", encoding="utf-8-sig", newline="") as file:
+        writer = csv.writer(file, lineterminator="\r\n")
+        writer.writerow(HEADERS[file_name])
+        writer.writerows(rows)
+
+
+def stop_ids_of(feed: int, count: int) -> np.ndarray:
+    return feed * 1_000_000 + np.arange(count)
+
+
+def make_stops(rng: np.random.Generator, feed: int, count: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    centre_lat, centre_lon = FEED_CENTRES[feed]
+    lats = centre_lat + rng.uniform(-FEED_RADIUS, FEED_RADIUS, count)
+    lons = centre_lon + rng.uniform(-FEED_RADIUS, FEED_RADIUS, count)
+    return stop_ids_of(feed, count), lats, lons
+
+
+def make_pattern(rng: np.random.Generator, lats: np.ndarray, lons: np.ndarray, length: int) -> np.ndarray:
+    """Indexes of length stops near a random spot, ordered along a random heading so the route runs roughly straight."""
+    length = min(length, len(lats))
+    anchor = rng.integers(len(lats))
+    distances = (lats - lats[anchor]) ** 2 + (lons - lons[anchor]) ** 2
+    nearest = np.argpartition(distances, min(3 * length, len(lats)) - 1)[:3 * length]
+    chosen = rng.choice(nearest, length, replace=False)
+    heading = rng.uniform(0, 2 * math.pi)
+    return chosen[np.argsort(lats[chosen] * math.cos(heading) + lons[chosen] * math.sin(heading))]
+
+
+def leg_seconds(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Running time between consecutive stops of a pattern."""
+    dy = np.diff(lats) * METRES_PER_DEGREE
+    dx = np.diff(lons) * METRES_PER_DEGREE * math.cos(math.radians(float(lats[0])))
+    return (np.hypot(dx, dy) / BUS_SPEED).astype(np.int64) + DWELL_SECONDS
+
+
+def shape_points(lats: np.ndarray, lons: np.ndarray, count: int) -> tuple[np.ndarray, np.ndarray]:
+    """count points along the stops of a pattern, evenly spaced by stop index."""
+    positions = np.linspace(0, len(lats) - 1, max(count, len(lats)))
+    return np.interp(positions, np.arange(len(lats)), lats), np.interp(positions, np.arange(len(lons)), lons)
+
+
+def generate_feed(folder: str, feed: int, scale: float, rng: np.random.Generator, start_date: date,
+                  shared_stops: list[tuple]) -> list[tuple]:
+    """Write one feed folder and return its stops rows, for the next feed to share some of them."""
+    stop_count, route_count, trip_count, stop_time_count, shape_count = (
+        max(int(round(value * scale)), 2 if value else 0) for value in FEED_PROFILES[feed]
+    )
+    os.makedirs(folder, exist_ok=True)
+    stop_ids, lats, lons = make_stops(rng, feed, stop_count)
+    stop_rows = [
+        (stop_id, stop_id % 1_000_000, f"Stop {stop_id}", f"S{stop_id}", f"{lat:.7f}", f"{lon:.7f}", stop_id)
+        for stop_id, lat, lon in zip(stop_ids.tolist(), lats.tolist(), lons.tolist())
+    ]
+    write_file(folder, "agency.txt", [(feed, f"Operator {feed}", "http://example.com/", "Asia/Nicosia", "en", "")])
+    write_file(folder, "stops.txt", stop_rows + shared_stops)
+
+    weekday_service, weekend_service = feed * 100 + 1, feed * 100 + 2
+    calendar_rows = []
+    for offset in range(SERVICE_DAYS):
+        day = start_date + timedelta(days=offset)
+        service_id = weekend_service if day.weekday() >= 5 else weekday_service
+        calendar_rows.append((service_id, day.strftime("%Y%m%d"), 1))
+    write_file(folder, "calendar_dates.txt", calendar_rows)
+
+    # Routes come in pairs, one per direction over the same stops
+    pair_count = max(route_count // 2, 1)
+    trips_per_route = max(trip_count // (2 * pair_count), 1)
+    stops_per_trip = max(stop_time_count // trip_count, 2) if stop_time_count else 0
+    points_per_route = max(shape_count // (2 * pair_count), 2)
+    headway = (LAST_DEPARTURE - FIRST_DEPARTURE) // trips_per_route
+    route_rows, trip_rows, stop_time_rows, shape_rows = [], [], [], []
+    trip_id = feed * 10_000_000
+    for pair in range(pair_count):
+        pattern = make_pattern(rng, lats, lons, stops_per_trip or 10)
+        short_name = str(feed * 100 + pair)
+        for direction_id in (0, 1):
+            route_id = feed * 1_000_000 + pair * 2 + direction_id
+            stops = pattern if direction_id == 0 else pattern[::-1]
+            first, last = stops[0], stops[-1]
+            route_rows.append((route_id, feed, short_name, f"Stop {stop_ids[first]} - Stop {stop_ids[last]}", "", 3,
+                               "408080", "FFFFFF"))
+            shape_lats, shape_lons = shape_points(lats[stops], lons[stops], points_per_route)
+            shape_rows += [(route_id, f"{lat:.7f}", f"{lon:.7f}", sequence)
+                           for sequence, (lat, lon) in enumerate(zip(shape_lats.tolist(), shape_lons.tolist()))]
+            offsets = np.concatenate(([0], np.cumsum(leg_seconds(lats[stops], lons[stops])))).tolist()
+            route_stop_ids = stop_ids[stops].tolist()
+            # Both directions of a pair start half a headway apart
+            first_departure = FIRST_DEPARTURE + direction_id * headway // 2
+            for i in range(trips_per_route):
+                trip_id += 1
+                service_id = weekend_service if i % WEEKEND_TRIP_EVERY == WEEKEND_TRIP_EVERY - 1 else weekday_service
+                trip_rows.append((route_id, service_id, trip_id, f"STOP {stop_ids[last]}", route_id, direction_id))
+                if not stops_per_trip:
+                    continue
+                departure = first_departure + i * headway + int(rng.integers(0, 60))
+                stop_time_rows += [
+                    (trip_id, format_time(departure + offset), format_time(departure + offset), stop_id, sequence, 0, 0)
+                    for sequence, (stop_id, offset) in enumerate(zip(route_stop_ids, offsets))
+                ]
+    write_file(folder, "routes.txt", route_rows)
+    write_file(folder, "trips.txt", trip_rows)
+    write_file(folder, "shapes.txt", shape_rows)
+    # Like two of the real feeds, one without stop times leaves stop_times.txt out
+    if stop_time_rows:
+        write_file(folder, "stop_times.txt", stop_time_rows)
+    return stop_rows
+
+
+def generate_feeds(output_folder: str, scale: float = 1.0, seed: int = 0, start_date: date = None) -> list[str]:
+    """
+    Write <feed>_google_transit folders for all seven feeds into output_folder and return their paths.
+    start_date: First day the services run on, a week ago by default so today is always covered.
+    """
+    if start_date is None:
+        start_date = date.today() - timedelta(days=7)
+    rng = np.random.default_rng(seed)
+    folders, shared_stops = [], []
+    for feed in FEED_PROFILES:
+        folder = os.path.join(output_folder, f"{feed}_google_transit")
+        stop_rows = generate_feed(folder, feed, scale, rng, start_date, shared_stops)
+        shared_stops = stop_rows[:int(len(stop_rows) * SHARED_STOP_FRACTION)]
+        folders.append(folder)
+    return folders
+
+
+if __name__ == "__main__":
+    folders = generate_feeds(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1.0,
+                             int(sys.argv[3]) if len(sys.argv) > 3 else 0)
+    print(f"Wrote {len(folders)} feeds into {sys.argv[1]}")
@@ -0,0 +1,63 @@
+from typing import Optional
+
+import orjson
+from fastapi import Request
+
+from geo import BBox, in_bbox
+from realtime_poller import RealtimePoller
+
+HEARTBEAT_INTERVAL = 15.0
+
+
+def format_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+async def bus_events(request: Request, poller: RealtimePoller, bbox: Optional[BBox]):
+    """
+    Server-Sent Events for the buses inside bbox: one "snapshot" event with the full list,
+    then one "delta" event per realtime tick with only the buses that moved, appeared or left.
+    """
+    version = 0
+    known = set()
+    snapshot = poller.get_snapshot()
+    while not await request.is_disconnected():
+        if snapshot is None:
+            snapshot = await poller.wait_for_update(version, HEARTBEAT_INTERVAL)
+            if snapshot is None:
+                if known and poller.get_snapshot() is None:
+                    # Polls are failing: take the buses off the map, as /api/get_buses stops serving them too
+                    yield format_event("delta", {"changed": [], "removed": list(known)})
+                    known = set()
+                    # So the next fresh snapshot is resent in full, even the same one refreshed by a 304
+                    version = -1
+                else:
+                    yield ": heartbeat\n\n"
+            continue
+
+        if version == 0 or snapshot.version != version + 1:
+            # First event, or this client missed a tick: resend everything it can see
+            buses = [bus for bus in snapshot.by_id.values() if in_bbox(bus["lat"], bus["lon"], bbox)]
+            visible = {bus["id"] for bus in buses}
+            removed = [bus_id for bus_id in known if bus_id not in visible]
+            known = visible
+            yield format_event("snapshot", buses) if version == 0 else format_event("delta", {"changed": buses, "removed": removed})
+        else:
+            changed = []
+            removed = []
+            for bus in snapshot.changed:
+                if in_bbox(bus["lat"], bus["lon"], bbox):
+                    changed.append(bus)
+                    known.add(bus["id"])
+                elif bus["id"] in known:
+                    removed.append(bus["id"])
+                    known.discard(bus["id"])
+            for bus_id in snapshot.removed:
+                if bus_id in known:
+                    removed.append(bus_id)
+                    known.discard(bus_id)
+            if changed or removed:
+                yield format_event("delta", {"changed": changed, "removed": removed})
+
+        version = snapshot.version
+        snapshot = None
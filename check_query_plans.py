@@ -0,0 +1,81 @@
+import asyncio
+import json
+import sys
+from datetime import date
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_manager import db_manager
+from crud import SHAPE_FOR_ROUTE_QUERY, STOPS_ON_ROUTE_QUERY, ROUTES_BY_STOP_QUERY, TRIPS_WITHIN_HOUR_QUERY
+from timetable import REALTIME_DELAY_MARGIN
+
+
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def index_scanned_tables(plan: dict) -> set[str]:
+    """Tables the plan reads through an index (a bitmap heap scan is always fed by a bitmap index scan)."""
+    return {
+        node["Relation Name"]
+        for node in plan_nodes(plan)
+        if node["Node Type"] in ("Index Scan", "Index Only Scan", "Bitmap Heap Scan")
+    }
+
+
+def result_plan(result) -> dict:
+    value = result.scalar()
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value[0]["Plan"]
+
+
+async def sample_params(session: AsyncSession) -> tuple[int, int]:
+    """Pick the busiest stop and route so the planner sees a realistic selectivity."""
+    stop_id = (await session.execute(text(
+        "SELECT stop_id FROM stop_times GROUP BY stop_id ORDER BY count(*) DESC LIMIT 1"
+    ))).scalar()
+    route_id = (await session.execute(text(
+        "SELECT route_id FROM trips GROUP BY route_id ORDER BY count(*) DESC LIMIT 1"
+    ))).scalar()
+    return stop_id, route_id
+
+
+async def check_query_plans() -> bool:
+    """EXPLAIN every API query and check that its filtered table is read through an index."""
+    async with db_manager.session_factory() as session:
+        stop_id, route_id = await sample_params(session)
+        if stop_id is None or route_id is None:
+            print("No stop_times loaded, nothing to check.")
+            return False
+        checks = [
+            ("get_trips_within_hour", TRIPS_WITHIN_HOUR_QUERY,
+             {"stop_id": stop_id, "current_time_seconds": 8 * 3600, "one_hour_later_seconds": 9 * 3600,
+              "service_date": date.today(), "margin": REALTIME_DELAY_MARGIN, "ttl": 300}, "stop_times"),
+            ("get_routes_by_stop_id", ROUTES_BY_STOP_QUERY, {"stop_id": stop_id}, "stop_routes"),
+            ("stops_on_route", STOPS_ON_ROUTE_QUERY, {"route_id": route_id}, "route_stop_patterns"),
+            ("get_shape_for_bus", SHAPE_FOR_ROUTE_QUERY, {"route_id": route_id}, "shapes"),
+        ]
+        all_ok = True
+        for name, query, params, table in checks:
+            result = await session.execute(text(f"EXPLAIN (FORMAT JSON) {query.text}"), params)
+            plan = result_plan(result)
+            ok = table in index_scanned_tables(plan)
+            all_ok = all_ok and ok
+            print(f"{'OK  ' if ok else 'FAIL'} {name}: {table} {'uses' if ok else 'does not use'} an index")
+            if not ok:
+                print(json.dumps(plan, indent=2))
+    return all_ok
+
+
+async def main():
+    ok = await check_query_plans()
+    await db_manager.engine.dispose()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
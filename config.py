@@ -1,7 +1,28 @@
 from pydantic_settings import BaseSettings
 
+from constants import GTFS_REALTIME_API_PATH, OTP_GRAPHQL_URL, SOURCE
+
 class Settings(BaseSettings):
     db_url: str = "your_db_url_here"
     db_echo: bool = False
+    # Upstreams and the feed folder; overridden by the benchmarks to point at local stand-ins
+    gtfs_realtime_url: str = GTFS_REALTIME_API_PATH
+    otp_graphql_url: str = OTP_GRAPHQL_URL
+    gtfs_source_folder: str = SOURCE
+    realtime_poll_interval: float = 8.0
+    realtime_max_staleness: float = 30.0
+    realtime_prediction_ttl: float = 300.0
+    realtime_mirror_predictions: bool = True
+    route_cache_size: int = 512
+    route_cache_ttl: float = 300.0
+    otp_max_concurrency: int = 2
+    # Run OTP next to the app as the fallback of the built-in journey planner
+    otp_enabled: bool = True
+    # Download the GTFS zips before every reload; off reloads the feeds already on disk
+    gtfs_download_feeds: bool = False
+    # Where the reload writes the timetable snapshot every worker maps at startup
+    timetable_snapshot_folder: str = "snapshots"
+    # How often a follower worker tries to take over as leader, and the leader checks it still holds the lock
+    leader_retry_interval: float = 5.0
 
 settings = Settings()
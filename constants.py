@@ -10,67 +10,87 @@ ZIP_URLS = ["https://www.motionbuscard.org.cy/opendata/downloadfile?file=GTFS%5C
             "https://www.motionbuscard.org.cy/opendata/downloadfile?file=GTFS%5C11_google_transit.zip&rel=True"]
 SOURCE = "google_transit_files"
 TARGET = "otp_data"
-ALLOWED_FILES = {"stops.txt", "routes.txt", "trips.txt", "stop_times.txt", "calendar_dates.txt", "agency.txt", "shapes.txt"}
+ALLOWED_FILES = {"stops.txt", "routes.txt", "trips.txt", "stop_times.txt", "calendar.txt", "calendar_dates.txt", "agency.txt", "shapes.txt"}
 OSM_FOLDER = "osm_data"
 
 GTFS_REALTIME_API_PATH = 'http://20.19.98.194:8328/Api/api/gtfs-realtime'
+OTP_GRAPHQL_URL = "http://localhost:8080/otp/gtfs/v1"
+# Douglas-Peucker tolerances for /api/get_shape: (max zoom, tolerance in degrees). Higher zooms get the full shape.
+SHAPE_SIMPLIFY_TOLERANCES = [(11, 0.0003), (14, 0.00005)]
+# /api/stops: single stops from STOP_MIN_ZOOM up, clusters of about STOP_CLUSTER_PIXELS square below it
+STOP_GRID_CELL_SIZE = 0.01
+STOP_MIN_ZOOM = 16
+STOP_CLUSTER_MIN_ZOOM = 8
+STOP_CLUSTER_PIXELS = 64
 
+# Sent with GraphQL variables (latFrom, lonFrom, latTo, lonTo, departure), never formatted
 GRAPHQL_QUERY = """
-query GtfsExampleQuery {{
+query GtfsExampleQuery(
+  $latFrom: CoordinateValue!
+  $lonFrom: CoordinateValue!
+  $latTo: CoordinateValue!
+  $lonTo: CoordinateValue!
+  $departure: OffsetDateTime!
+) {
   planConnection(
-    origin: {{
-      location: {{ coordinate: {{ latitude: {lat_from}, longitude: {lon_from} }} }}
-    }}
-    destination: {{
-      location: {{ coordinate: {{ latitude: {lat_to}, longitude: {lon_to} }} }}
-    }}
-    dateTime: {{ earliestDeparture: "{time_value}" }}
-    modes: {{
+    origin: {
+      location: { coordinate: { latitude: $latFrom, longitude: $lonFrom } }
+    }
+    destination: {
+      location: { coordinate: { latitude: $latTo, longitude: $lonTo } }
+    }
+    dateTime: { earliestDeparture: $departure }
+    modes: {
       direct: [WALK]
-      transit: {{ transit: [{{ mode: BUS }}, {{ mode: RAIL }}] }}
-    }}
-  ) {{
-    edges {{
-      node {{
+      transit: { transit: [{ mode: BUS }, { mode: RAIL }] }
+    }
+  ) {
+    edges {
+      node {
         start
         end
-        legs {{
+        legs {
           mode
-          from {{
+          from {
             name
             lat
             lon
-            departure {{
+            departure {
               scheduledTime
-              estimated {{
+              estimated {
                 time
                 delay
-              }}
-            }}
-          }}
-          to {{
+              }
+            }
+          }
+          to {
             name
             lat
             lon
-            arrival {{
+            arrival {
               scheduledTime
-              estimated {{
+              estimated {
                 time
                 delay
-              }}
-            }}
-          }}
-          route {{
+              }
+            }
+          }
+          route {
             gtfsId
             longName
             shortName
-          }}
-          legGeometry {{
+          }
+          legGeometry {
             points
-          }}
-        }}
-      }}
-    }}
-  }}
-}}
+          }
+        }
+      }
+    }
+  }
+}
 """
+
+# /api/make_route cache: origins and destinations are snapped to cells of this many degrees (about 100 m)
+# and departure times to buckets of this many seconds
+ROUTE_CACHE_CELL_SIZE = 0.001
+ROUTE_CACHE_TIME_BUCKET = 300
@@ -0,0 +1,224 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+import asyncpg
+from sqlalchemy.engine import make_url
+
+from config import settings
+from metrics import worker_is_leader
+
+# Session advisory lock held by the leader, the same key in every worker sharing the database
+LEADER_LOCK_KEY = 0x43425553
+DATASET_CHANNEL = "gtfs_dataset"
+REALTIME_CHANNEL = "gtfs_realtime"
+
+# Outside the GTFS tables, so the staging swap of a reload leaves it alone; unlogged as it is rebuilt every tick
+CREATE_SNAPSHOT_TABLE_SQL = """
+CREATE UNLOGGED TABLE IF NOT EXISTS realtime_snapshot (
+    id integer PRIMARY KEY,
+    version bigint NOT NULL,
+    payload bytea NOT NULL
+)"""
+# The version lives in the row, so it keeps increasing across leaders
+UPSERT_SNAPSHOT_SQL = """
+INSERT INTO realtime_snapshot (id, version, payload) VALUES (1, 1, $1)
+ON CONFLICT (id) DO UPDATE SET version = realtime_snapshot.version + 1, payload = excluded.payload
+RETURNING version"""
+SELECT_SNAPSHOT_SQL = "SELECT version, payload FROM realtime_snapshot WHERE id = 1"
+CONNECTION_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError)
+
+
+def asyncpg_dsn(db_url: str) -> str:
+    """The SQLAlchemy URL of the app as a plain postgresql:// DSN for asyncpg."""
+    return make_url(db_url).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+class WorkerCoordinator:
+    def __init__(self, db_url: str, retry_interval: float):
+        """
+        Elects one leader among the app's workers with a Postgres session advisory lock. The leader reloads GTFS,
+        polls GTFS-RT and runs OTP; the followers only serve, and NOTIFYs from the leader tell them when the
+        dataset changed and when a realtime tick was written to the realtime_snapshot row.
+        retry_interval: Seconds between two attempts of a follower to take the lock over, and between two
+            checks of the leader that its connection, and so the lock, is still there.
+        """
+        self.dsn = asyncpg_dsn(db_url)
+        self.retry_interval = retry_interval
+        self.is_leader = False
+        self._connection: Optional[asyncpg.Connection] = None
+        # asyncpg runs one query at a time per connection
+        self._query_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        # Version of the realtime_snapshot row last written (leader) or applied (follower)
+        self._realtime_version = 0
+        self._realtime_stale = False
+        self._realtime_task: Optional[asyncio.Task] = None
+        self._dataset_lock = asyncio.Lock()
+        self._handlers: set[asyncio.Task] = set()
+        self.on_promoted: Optional[Callable[[], Awaitable[None]]] = None
+        self.on_demoted: Optional[Callable[[], Awaitable[None]]] = None
+        self.on_dataset_changed: Optional[Callable[[bool], Awaitable[None]]] = None
+        self.on_realtime: Optional[Callable[[Optional[bytes]], None]] = None
+
+    async def start(self, on_promoted: Callable[[], Awaitable[None]], on_demoted: Callable[[], Awaitable[None]],
+                    on_dataset_changed: Callable[[bool], Awaitable[None]],
+                    on_realtime: Callable[[Optional[bytes]], None]) -> bool:
+        """
+        Connect, listen to the leader and try once to become it. Returns whether this worker leads; later
+        promotions and demotions call on_promoted and on_demoted.
+        on_dataset_changed: Called on followers after every reload, with whether it changed the dataset.
+        on_realtime: Called on followers with every realtime tick, None when the last one is still current.
+        """
+        self.on_promoted, self.on_demoted = on_promoted, on_demoted
+        self.on_dataset_changed, self.on_realtime = on_dataset_changed, on_realtime
+        await self._connect()
+        await self._try_lead()
+        print(f"Worker coordination started as {'leader' if self.is_leader else 'follower'}.")
+        self._task = asyncio.create_task(self._run())
+        return self.is_leader
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._handlers):
+            task.cancel()
+        if self._connection is not None:
+            # Closing the session releases the lock; a follower takes over within retry_interval
+            await self._connection.close()
+            self._connection = None
+        self.is_leader = False
+        worker_is_leader.set(0)
+
+    async def _connect(self):
+        self._connection = await asyncpg.connect(self.dsn)
+        await self._connection.add_listener(DATASET_CHANNEL, self._notified)
+        await self._connection.add_listener(REALTIME_CHANNEL, self._notified)
+
+    async def _try_lead(self) -> bool:
+        async with self._query_lock:
+            if not await self._connection.fetchval("SELECT pg_try_advisory_lock($1)", LEADER_LOCK_KEY):
+                return False
+            await self._connection.execute(CREATE_SNAPSHOT_TABLE_SQL)
+        self.is_leader = True
+        worker_is_leader.set(1)
+        return True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.retry_interval)
+            try:
+                if self._connection is None or self._connection.is_closed():
+                    await self._lose_connection()
+                    await self._reconnect()
+                elif self.is_leader:
+                    # The lock lives as long as the session; a round trip notices a dropped one
+                    async with self._query_lock:
+                        await self._connection.fetchval("SELECT 1")
+                elif await self._try_lead():
+                    print("This worker took over as leader.")
+                    await self.on_promoted()
+            except CONNECTION_ERRORS as e:
+                print(f"Worker coordination lost its connection: {e}")
+                await self._lose_connection()
+
+    async def _lose_connection(self):
+        if self._connection is not None:
+            self._connection.terminate()
+            self._connection = None
+        if self.is_leader:
+            # Another worker may hold the lock by now
+            self.is_leader = False
+            worker_is_leader.set(0)
+            print("This worker is no longer the leader.")
+            await self.on_demoted()
+
+    async def _reconnect(self):
+        await self._connect()
+        if await self._try_lead():
+            print("This worker took over as leader.")
+            await self.on_promoted()
+            return
+        # Notifications sent while disconnected are lost; catch up on both
+        self._spawn(self._refresh_dataset(True))
+        await self.load_realtime()
+
+    def _notified(self, connection, pid: int, channel: str, payload: str):
+        if self.is_leader:
+            # The leader hears its own NOTIFYs too
+            return
+        if channel == DATASET_CHANNEL:
+            self._spawn(self._refresh_dataset(payload == "changed"))
+        elif int(payload) == self._realtime_version:
+            self.on_realtime(None)
+        else:
+            self._realtime_stale = True
+            if self._realtime_task is None or self._realtime_task.done():
+                self._realtime_task = self._spawn(self._follow_realtime())
+
+    def _spawn(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self._handlers.add(task)
+        task.add_done_callback(self._handlers.discard)
+        return task
+
+    async def _refresh_dataset(self, changed: bool):
+        async with self._dataset_lock:
+            try:
+                await self.on_dataset_changed(changed)
+            except Exception as e:
+                print(f"Refreshing the static data after the leader's reload failed: {e}")
+
+    async def _follow_realtime(self):
+        # Ticks notified while one is read are coalesced into a single read of the latest row
+        while self._realtime_stale:
+            self._realtime_stale = False
+            try:
+                await self.load_realtime()
+            except CONNECTION_ERRORS as e:
+                print(f"Reading the leader's realtime snapshot failed: {e}")
+
+    async def load_realtime(self):
+        """Apply the leader's latest realtime tick, if there is one this worker has not applied yet."""
+        try:
+            async with self._query_lock:
+                row = await self._connection.fetchrow(SELECT_SNAPSHOT_SQL)
+        except asyncpg.UndefinedTableError:
+            # No leader has written a tick yet
+            return
+        if row is None or row["version"] == self._realtime_version:
+            return
+        self._realtime_version = row["version"]
+        self.on_realtime(bytes(row["payload"]))
+
+    async def publish_realtime(self, payload: Optional[bytes]):
+        """Hand a realtime tick to the followers; None tells them the last one is still current."""
+        if not self.is_leader or self._connection is None:
+            return
+        try:
+            async with self._query_lock, self._connection.transaction():
+                if payload is not None:
+                    self._realtime_version = await self._connection.fetchval(UPSERT_SNAPSHOT_SQL, payload)
+                # Delivered on commit, when the row is visible to the followers
+                await self._connection.execute(
+                    "SELECT pg_notify($1, $2)", REALTIME_CHANNEL, str(self._realtime_version))
+        except CONNECTION_ERRORS as e:
+            print(f"Sharing the realtime tick with the followers failed: {e}")
+
+    async def notify_dataset_changed(self, changed: bool):
+        """Tell the followers a reload finished, and whether it changed the dataset."""
+        if not self.is_leader or self._connection is None:
+            return
+        try:
+            async with self._query_lock:
+                await self._connection.execute(
+                    "SELECT pg_notify($1, $2)", DATASET_CHANNEL, "changed" if changed else "unchanged")
+        except CONNECTION_ERRORS as e:
+            print(f"Notifying the followers of the reload failed: {e}")
+
+
+coordinator = WorkerCoordinator(db_url=settings.db_url, retry_interval=settings.leader_retry_interval)
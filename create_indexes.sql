@@ -0,0 +1,15 @@
+CREATE INDEX stop_times_stop_id_arrival_time_idx
+        ON stop_times (stop_id, arrival_time)
+        INCLUDE (trip_id);
+
+
+CREATE INDEX trips_route_id_idx
+        ON trips (route_id);
+
+
+CREATE INDEX routes_feed_id_idx
+        ON routes (feed_id);
+
+
+CREATE INDEX trips_feed_id_idx
+        ON trips (feed_id);
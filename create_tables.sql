@@ -2,11 +2,22 @@ CREATE TABLE routes (
         route_id INTEGER NOT NULL,
         route_short_name VARCHAR(200) NOT NULL,
         route_long_name VARCHAR(200) NOT NULL,
+        feed_id VARCHAR(100),
         PRIMARY KEY (route_id),
         UNIQUE (route_id)
 );
 
 
+-- Days each service runs on: bit i of active_days is set when it runs start_date + i days
+CREATE TABLE service_calendar (
+        service_id INTEGER NOT NULL,
+        start_date DATE NOT NULL,
+        active_days BIT VARYING NOT NULL,
+        feed_id VARCHAR(100),
+        PRIMARY KEY (service_id)
+);
+
+
 CREATE TABLE stops (
         stop_id INTEGER NOT NULL,
         stop_name VARCHAR(100) NOT NULL,
@@ -25,6 +36,8 @@ CREATE TABLE added_trips (
         PRIMARY KEY (route_id, start_time, direction_id)
 );
 
+CREATE SEQUENCE added_trip_id_seq OWNED BY added_trips.trip_id;
+
 
 CREATE TABLE trips (
         trip_id INTEGER NOT NULL,
@@ -32,6 +45,7 @@ CREATE TABLE trips (
         service_id INTEGER NOT NULL,
         direction_id INTEGER NOT NULL,
         trip_headsign VARCHAR(200) NOT NULL,
+        feed_id VARCHAR(100),
         PRIMARY KEY (trip_id),
         UNIQUE (trip_id),
         FOREIGN KEY(route_id) REFERENCES routes (route_id)
@@ -55,4 +69,43 @@ CREATE TABLE stop_times (
         PRIMARY KEY (trip_id, stop_sequence),
         FOREIGN KEY(trip_id) REFERENCES trips (trip_id) ON DELETE CASCADE,
         FOREIGN KEY(stop_id) REFERENCES stops (stop_id)
-);
\ No newline at end of file
+);
+
+-- Distinct routes calling at each stop, derived from trips and stop_times when a feed is loaded
+CREATE TABLE stop_routes (
+        stop_id INTEGER NOT NULL,
+        route_id INTEGER NOT NULL,
+        PRIMARY KEY (stop_id, route_id),
+        FOREIGN KEY(stop_id) REFERENCES stops (stop_id),
+        FOREIGN KEY(route_id) REFERENCES routes (route_id)
+);
+
+-- Stops of each route and direction in order: the stop sequences of all its trips merged, every stop once
+CREATE TABLE route_stop_patterns (
+        route_id INTEGER NOT NULL,
+        direction_id INTEGER NOT NULL,
+        stop_order INTEGER NOT NULL,
+        stop_id INTEGER NOT NULL,
+        PRIMARY KEY (route_id, direction_id, stop_order),
+        FOREIGN KEY(route_id) REFERENCES routes (route_id),
+        FOREIGN KEY(stop_id) REFERENCES stops (stop_id)
+);
+
+-- Realtime predictions, rewritten every tick and rebuilt from the feed after a restart, so not WAL-logged
+CREATE UNLOGGED TABLE stop_time_predictions (
+        trip_id INTEGER NOT NULL,
+        stop_sequence INTEGER NOT NULL,
+        stop_id INTEGER NOT NULL,
+        arrival_time INTEGER NOT NULL,
+        departure_time INTEGER NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (trip_id, stop_sequence)
+);
+
+-- What each feed looked like when it was last loaded, so unchanged feeds can be skipped
+CREATE TABLE gtfs_manifest (
+        feed_id VARCHAR(100) NOT NULL,
+        file_hashes TEXT NOT NULL,
+        loaded_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (feed_id)
+);
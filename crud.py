@@ -2,8 +2,10 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from zoneinfo import ZoneInfo
 from datetime import datetime
 from sqlalchemy import text
-from GTFS_Parsing import GTFSRealtimeParser
-from constants import GTFS_REALTIME_API_PATH
+
+from config import settings
+from metrics import instrument_query
+from timetable import REALTIME_DELAY_MARGIN
 
 CYPRUS_TZ = ZoneInfo("Asia/Nicosia")
 
@@ -36,79 +38,131 @@ def merge_sort(arr):
     return merge(left, right)
 
 
+ALL_STOPS_QUERY = text("""
+    SELECT stop_id, stop_name, stop_lat, stop_lon
+    FROM stops;
+""")
+
+SHAPE_FOR_ROUTE_QUERY = text("""
+    SELECT shape_pt_lat, shape_pt_lon
+    FROM shapes
+    WHERE shape_id = :route_id
+    ORDER BY shape_pt_sequence;
+""")
+
+# Every stop of the route once, in pattern order: the first direction, then the other direction's new stops
+STOPS_ON_ROUTE_QUERY = text("""
+    SELECT
+    s.stop_id,
+    s.stop_lat,
+    s.stop_lon
+    FROM (
+        SELECT DISTINCT ON (stop_id) stop_id, direction_id, stop_order
+        FROM route_stop_patterns
+        WHERE route_id = :route_id
+        ORDER BY stop_id, direction_id, stop_order
+    ) p
+    JOIN stops s ON s.stop_id = p.stop_id
+    ORDER BY p.direction_id, p.stop_order;
+""")
+
+ROUTES_BY_STOP_QUERY = text("""
+    SELECT DISTINCT ON (r.route_short_name)
+    r.route_id,
+    r.route_short_name
+    FROM stop_routes sr
+    JOIN routes r ON r.route_id = sr.route_id
+    WHERE sr.stop_id = :stop_id
+    ORDER BY r.route_short_name, r.route_id;
+""")
+
+# Includes routes.route_short_name and routes.route_long_name for the popup.
+# Each service day (yesterday, today, tomorrow) is looked up on its own clock, shifted by :shift seconds, and only
+# trips whose service runs that day are kept.
+# Realtime predictions younger than :ttl seconds replace the scheduled time, which is still
+# filtered on (widened by :margin) so the stop_times index can be used; ADDED trips only have predictions.
+TRIPS_WITHIN_HOUR_QUERY = text("""
+    SELECT
+        coalesce(p.arrival_time, stop_times.arrival_time - days.shift) AS arrival_time,
+        trips.route_id,
+        routes.route_short_name,
+        routes.route_long_name,
+        stop_times.trip_id,
+        stop_times.arrival_time - days.shift AS scheduled_arrival_time,
+        p.arrival_time AS estimated_arrival_time
+    FROM (
+        VALUES (86400, CAST(:service_date AS date) - 1), (0, CAST(:service_date AS date)), (-86400, CAST(:service_date AS date) + 1)
+    ) AS days(shift, service_date)
+    JOIN stop_times
+        ON stop_times.stop_id = :stop_id
+        AND stop_times.arrival_time >= :current_time_seconds + days.shift - CAST(:margin AS integer)
+        AND stop_times.arrival_time <= :one_hour_later_seconds + days.shift + CAST(:margin AS integer)
+    JOIN trips ON trips.trip_id = stop_times.trip_id
+    JOIN service_calendar
+        ON service_calendar.service_id = trips.service_id
+        AND substring(service_calendar.active_days FROM days.service_date - service_calendar.start_date + 1 FOR 1) = B'1'
+    JOIN routes ON routes.route_id = trips.route_id
+    LEFT JOIN stop_time_predictions p
+        ON p.trip_id = stop_times.trip_id
+        AND p.stop_sequence = stop_times.stop_sequence
+        AND p.updated_at >= now() - make_interval(secs => :ttl)
+    WHERE coalesce(p.arrival_time, stop_times.arrival_time - days.shift) BETWEEN :current_time_seconds AND :one_hour_later_seconds
+    UNION ALL
+    SELECT
+        p.arrival_time,
+        trips.route_id,
+        routes.route_short_name,
+        routes.route_long_name,
+        p.trip_id,
+        NULL,
+        p.arrival_time
+    FROM stop_time_predictions p
+    JOIN added_trips ON added_trips.trip_id = p.trip_id
+    JOIN trips ON trips.trip_id = p.trip_id
+    JOIN routes ON routes.route_id = trips.route_id
+    WHERE p.stop_id = :stop_id
+    AND p.updated_at >= now() - make_interval(secs => :ttl)
+    AND p.arrival_time BETWEEN :current_time_seconds AND :one_hour_later_seconds;
+""")
+
+@instrument_query
 async def get_all_stops(session: AsyncSession):
-    print("entered_stops")
-    query = text("""
-        SELECT stop_id, stop_name, stop_lat, stop_lon
-        FROM stops;
-    """)
-    stops = await session.execute(query)
+    stops = await session.execute(ALL_STOPS_QUERY)
     return [{"stop_id": s.stop_id, "stop_name": s.stop_name, "stop_lat": s.stop_lat, "stop_lon": s.stop_lon} for s in stops]
 
-async def update_stop_times_and_get_buses(session: AsyncSession):
-    rt_parser = GTFSRealtimeParser(session, GTFS_REALTIME_API_PATH)
-    await rt_parser.fetch_gtfs_rt_data()
-    await rt_parser.update_stop_times()
-    bus_positions = await rt_parser.get_bus_positions()
-    return bus_positions
-
+@instrument_query
 async def get_shape_for_bus(session: AsyncSession, route_id: int):
     """Fetches the shape points for a given route_id."""
-    query = text("""
-        SELECT shape_pt_lat, shape_pt_lon
-        FROM shapes
-        WHERE shape_id = :route_id
-        ORDER BY shape_pt_sequence;
-    """)
-    result = await session.execute(query, {"route_id": route_id})
+    result = await session.execute(SHAPE_FOR_ROUTE_QUERY, {"route_id": route_id})
     shape_points = result.all()
-    # print(shape_points)
     return [{"lat": point.shape_pt_lat, "lon": point.shape_pt_lon} for point in shape_points]
 
+@instrument_query
 async def stops_on_route(session: AsyncSession, route_id: int):
     """
-    Returns all distinct routes that stop at the given stop_id using pure SQL.
+    Returns every stop of the route once, in order, using pure SQL.
     """
-    query = text("""
-        SELECT
-        s.stop_lat, 
-        s.stop_lon
-        FROM stops s
-        JOIN stop_times st ON s.stop_id = st.stop_id
-        JOIN trips t ON st.trip_id = t.trip_id
-        WHERE t.route_id = :route_id;
-    """)
-
-    result = await session.execute(query, {"route_id": route_id})
+    result = await session.execute(STOPS_ON_ROUTE_QUERY, {"route_id": route_id})
     rows = result.all()
 
     # Convert to list of dicts for easy handling
     stops = [
         {
-            "stop_lat": row[0],
-            "stop_lon": row[1]
+            "stop_id": row.stop_id,
+            "stop_lat": row.stop_lat,
+            "stop_lon": row.stop_lon
         }
         for row in rows
     ]
 
     return stops
 
+@instrument_query
 async def get_routes_by_stop_id(session: AsyncSession, stop_id: int):
     """
     Returns all distinct routes that stop at the given stop_id using pure SQL.
     """
-    query = text("""
-        SELECT DISTINCT ON (r.route_short_name)
-        r.route_id,
-        r.route_short_name
-        FROM routes r
-        JOIN trips t ON r.route_id = t.route_id
-        JOIN stop_times st ON t.trip_id = st.trip_id
-        WHERE st.stop_id = :stop_id
-        ORDER BY r.route_short_name, r.route_id;
-    """)
-
-    result = await session.execute(query, {"stop_id": stop_id})
+    result = await session.execute(ROUTES_BY_STOP_QUERY, {"stop_id": stop_id})
     rows = result.fetchall()
 
     # Convert to list of dicts for easy handling
@@ -124,38 +178,25 @@ async def get_routes_by_stop_id(session: AsyncSession, stop_id: int):
 
 def seconds_to_minutes(seconds: int):
     return round(seconds / 60)
+
+@instrument_query
 async def get_trips_within_hour(session: AsyncSession, stop_id: int, range_within: int = 3600):
     # Get current time and convert to seconds since midnight
     now = datetime.now(CYPRUS_TZ)
     current_time_seconds = now.hour * 3600 + now.minute * 60 + now.second  # Adjust for timezone offset
     one_hour_later_seconds = current_time_seconds + range_within
 
-    # Build the query with an additional join on Route to fetch route_short_name and route_long_name
-    query = text("""
-        SELECT 
-            stop_times.arrival_time,
-            trips.route_id,
-            routes.route_short_name,
-            routes.route_long_name,
-            stop_times.trip_id
-        FROM stop_times
-        JOIN trips ON trips.trip_id = stop_times.trip_id
-        JOIN routes ON routes.route_id = trips.route_id
-        WHERE stop_times.stop_id = :stop_id
-        AND stop_times.arrival_time >= :current_time_seconds
-        AND stop_times.arrival_time <= :one_hour_later_seconds;
-    """)
-
     # Execute the query
-    result = await session.execute(query, {"stop_id": stop_id, "current_time_seconds": current_time_seconds, "one_hour_later_seconds": one_hour_later_seconds})
+    result = await session.execute(TRIPS_WITHIN_HOUR_QUERY, {"stop_id": stop_id, "current_time_seconds": current_time_seconds, "one_hour_later_seconds": one_hour_later_seconds,
+                                                             "service_date": now.date(), "margin": REALTIME_DELAY_MARGIN, "ttl": settings.realtime_prediction_ttl})
     trips = result.all()
-    print(trips)
-    # return trips
-    # print(trips)
     # Group trips by route_id and limit to max 3 per route
     list_of_trips_with_times = []
     trips = merge_sort(trips)
     for el in trips:
-        val = {"arrival_time": seconds_to_minutes(el[0] - current_time_seconds), "route_id": el[1], "route_short_name": el[2], "route_long_name": el[3].split(" - ")[-1], "trip_id": el[4]}
+        val = {"arrival_time": seconds_to_minutes(el[0] - current_time_seconds),
+               "scheduled_arrival_time": None if el[5] is None else seconds_to_minutes(el[5] - current_time_seconds),
+               "estimated_arrival_time": None if el[6] is None else seconds_to_minutes(el[6] - current_time_seconds),
+               "route_id": el[1], "route_short_name": el[2], "route_long_name": el[3].split(" - ")[-1], "trip_id": el[4]}
         list_of_trips_with_times.append(val)
     return list_of_trips_with_times
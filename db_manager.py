@@ -1,6 +1,9 @@
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, async_scoped_session
 from asyncio import current_task
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
 from config import settings
+from metrics import db_pool_connections
 class DatabaseManager:
     def __init__(self, url: str, echo: bool = False):
         self.engine = create_async_engine(
@@ -13,6 +16,35 @@ class DatabaseManager:
             autocommit=False,
             expire_on_commit=False
         )
+        self._register_pool_metrics()
+
+    def _register_pool_metrics(self):
+        """Track the pool's state as connections come and go; in_use reaching limit means requests queue for one."""
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool):
+            return
+        db_pool_connections.labels("size").set(pool.size())
+        db_pool_connections.labels("limit").set(pool.size() + pool._max_overflow)
+        in_use, idle, overflow = (db_pool_connections.labels(state) for state in ("in_use", "idle", "overflow"))
+
+        def checked_out(*args):
+            in_use.set(pool.checkedout())
+            idle.set(pool.checkedin())
+            overflow.set(max(pool.overflow(), 0))
+
+        def checked_in(*args):
+            # Fires just before the pool takes the connection back, or closes it if the pool is full
+            in_use.set(pool.checkedout() - 1)
+            if pool.checkedin() < pool.size():
+                idle.set(pool.checkedin() + 1)
+                overflow.set(max(pool.overflow(), 0))
+            else:
+                idle.set(pool.checkedin())
+                overflow.set(max(pool.overflow() - 1, 0))
+
+        event.listen(self.engine.sync_engine, "checkout", checked_out)
+        event.listen(self.engine.sync_engine, "checkin", checked_in)
+        checked_out()
     def get_scoped_session(self):
         session = async_scoped_session(session_factory=self.session_factory, scopefunc=current_task)
         return session
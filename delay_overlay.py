@@ -0,0 +1,112 @@
+import time
+from typing import Iterator, Mapping, NamedTuple, Optional
+
+from config import settings
+
+
+class Prediction(NamedTuple):
+    """Realtime estimate for one call of a trip at a stop."""
+    stop_id: int
+    arrival_time: int
+    departure_time: int
+    # Only set for ADDED trips, which have no scheduled stop_times to hang the prediction on
+    route_id: Optional[int]
+    expires_at: float
+
+
+class DelayOverlay:
+    def __init__(self, ttl: float):
+        """
+        Realtime predictions kept next to the static timetable instead of written into stop_times.
+        ttl: Seconds a prediction stays valid after the last feed that mentioned it.
+        """
+        self.ttl = ttl
+        # Bumped on every change, so derived data can be cached until the next tick
+        self.version = 0
+        self._predictions: dict[tuple[int, int], Prediction] = {}
+        # stop_id -> (trip_id, stop_sequence) of ADDED trips calling there
+        self._added_by_stop: dict[int, set[tuple[int, int]]] = {}
+        # Copy handed out by frozen(), reused while the version stays the same
+        self._frozen: Optional["DelayOverlay"] = None
+
+    def __len__(self) -> int:
+        return len(self._predictions)
+
+    def update(self, predictions: Mapping[tuple[int, int], tuple[int, int, int]],
+               added_trip_routes: Mapping[int, int], now: float = None):
+        """
+        predictions: (trip_id, stop_sequence) -> (stop_id, arrival_time, departure_time)
+        added_trip_routes: trip_id -> route_id for the ADDED trips among them
+        """
+        if now is None:
+            now = time.monotonic()
+        expires_at = now + self.ttl
+        self.version += 1
+        for key, (stop_id, arrival_time, departure_time) in predictions.items():
+            self._forget_added(key)
+            route_id = added_trip_routes.get(key[0])
+            self._predictions[key] = Prediction(stop_id, arrival_time, departure_time, route_id, expires_at)
+            if route_id is not None:
+                self._added_by_stop.setdefault(stop_id, set()).add(key)
+        self.expire(now)
+
+    def expire(self, now: float = None):
+        if now is None:
+            now = time.monotonic()
+        expired = [key for key, prediction in self._predictions.items() if prediction.expires_at <= now]
+        if expired:
+            self.version += 1
+        for key in expired:
+            self._forget_added(key)
+            del self._predictions[key]
+
+    def clear(self):
+        """Drop everything, e.g. after a reload renumbered the trips."""
+        self.version += 1
+        self._predictions.clear()
+        self._added_by_stop.clear()
+
+    def frozen(self) -> "DelayOverlay":
+        """
+        A copy that later ticks leave alone, for readers on another thread such as the journey planner: the event
+        loop changes this overlay on every tick, and iterating it meanwhile fails. Take it on the event loop.
+        """
+        if self._frozen is None or self._frozen.version != self.version:
+            copy = DelayOverlay(self.ttl)
+            copy.version = self.version
+            copy._predictions = dict(self._predictions)
+            copy._added_by_stop = {stop_id: set(keys) for stop_id, keys in self._added_by_stop.items()}
+            self._frozen = copy
+        return self._frozen
+
+    def get(self, trip_id: int, stop_sequence: int) -> Optional[Prediction]:
+        prediction = self._predictions.get((trip_id, stop_sequence))
+        if prediction is None or prediction.expires_at <= time.monotonic():
+            return None
+        return prediction
+
+    def items(self) -> Iterator[tuple[tuple[int, int], Prediction]]:
+        """((trip_id, stop_sequence), prediction) for every prediction still valid."""
+        now = time.monotonic()
+        return ((key, prediction) for key, prediction in self._predictions.items() if prediction.expires_at > now)
+
+    def added_at_stop(self, stop_id: int) -> list[tuple[int, Prediction]]:
+        """(trip_id, prediction) for every ADDED trip predicted at the stop."""
+        now = time.monotonic()
+        return [
+            (trip_id, self._predictions[(trip_id, stop_sequence)])
+            for trip_id, stop_sequence in self._added_by_stop.get(stop_id, ())
+            if self._predictions[(trip_id, stop_sequence)].expires_at > now
+        ]
+
+    def _forget_added(self, key: tuple[int, int]):
+        previous = self._predictions.get(key)
+        if previous is not None and previous.route_id is not None:
+            keys = self._added_by_stop.get(previous.stop_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._added_by_stop[previous.stop_id]
+
+
+delay_overlay = DelayOverlay(ttl=settings.realtime_prediction_ttl)
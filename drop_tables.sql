@@ -1,7 +1,13 @@
+DROP TABLE IF EXISTS gtfs_manifest CASCADE;
+DROP TABLE IF EXISTS stop_time_predictions CASCADE;
+DROP TABLE IF EXISTS route_stop_patterns CASCADE;
+DROP TABLE IF EXISTS stop_routes CASCADE;
 
 DROP TABLE IF EXISTS stop_times CASCADE;
 DROP TABLE IF EXISTS shapes CASCADE;
 DROP TABLE IF EXISTS trips CASCADE;
+DROP SEQUENCE IF EXISTS added_trip_id_seq CASCADE;
 DROP TABLE IF EXISTS added_trips CASCADE;
 DROP TABLE IF EXISTS stops CASCADE;
+DROP TABLE IF EXISTS service_calendar CASCADE;
 DROP TABLE IF EXISTS routes CASCADE;
\ No newline at end of file
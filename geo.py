@@ -0,0 +1,24 @@
+from typing import Optional
+
+from fastapi import HTTPException
+
+BBox = tuple[float, float, float, float]
+
+
+def parse_bbox(bbox: Optional[str]) -> Optional[BBox]:
+    """Parse "min_lon,min_lat,max_lon,max_lat" into floats. None means the whole map."""
+    if not bbox:
+        return None
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400,
+                            detail="bbox must be 'min_lon,min_lat,max_lon,max_lat'.")
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def in_bbox(lat: float, lon: float, bbox: Optional[BBox]) -> bool:
+    if bbox is None:
+        return True
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
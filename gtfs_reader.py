@@ -0,0 +1,86 @@
+import os
+from typing import Iterator, Optional
+
+import numpy as np
+import pandas as pd
+
+# Column types a schema can ask for. TIME is a GTFS HH:MM:SS time, parsed to seconds after midnight.
+INT = "int"
+FLOAT = "float"
+STR = "str"
+TIME = "time"
+
+# Rows parsed at a time, so reading a feed never holds more than one chunk of a file's text columns
+READ_CHUNK_ROWS = 100_000
+
+_READ_DTYPES = {INT: np.int64, FLOAT: np.float64, STR: object, TIME: object}
+_ZERO = ord("0")
+
+
+def parse_time(time_str: str) -> Optional[int]:
+    """ Helper method to convert GTFS time (HH:MM:SS) to number of seconds after 00:00 """
+    if time_str:
+        hours, minutes, seconds = map(int, time_str.split(":"))
+        return hours * 60 * 60 + minutes * 60 + seconds
+    return None
+
+
+def parse_times(values: np.ndarray) -> np.ndarray:
+    """
+    Seconds after midnight for an array of GTFS HH:MM:SS strings.
+    When every value is exactly HH:MM:SS the digits are read straight from the bytes in one vectorized pass;
+    otherwise (H:MM:SS, empty times) each value is parsed on its own and empty ones become None.
+    """
+    if not len(values):
+        return np.empty(0, dtype=np.int64)
+    text = "".join(values)
+    if len(text) == 8 * len(values) and text.isascii():
+        digits = np.frombuffer(text.encode("ascii"), dtype=np.uint8).reshape(-1, 8)
+        if (digits[:, 2] == ord(":")).all() and (digits[:, 5] == ord(":")).all():
+            digits = digits.astype(np.int64) - _ZERO
+            return (digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 3] * 10 + digits[:, 4]) * 60 \
+                + digits[:, 6] * 10 + digits[:, 7]
+    return np.array([parse_time(value) for value in values], dtype=object)
+
+
+def iter_columns(gtfs_folder: str, file_name: str, schema: dict[str, str],
+                 chunk_rows: int = READ_CHUNK_ROWS) -> Iterator[dict[str, np.ndarray]]:
+    """
+    Read only the columns named in schema (column -> INT, FLOAT, STR or TIME) of a GTFS file and yield them
+    as typed arrays, chunk_rows rows at a time. Yields nothing if the feed does not have the file.
+    """
+    file_path = os.path.join(gtfs_folder, file_name)
+    if not os.path.isfile(file_path):
+        print(f"There is no {file_path}")
+        return
+    with pd.read_csv(
+        file_path,
+        usecols=list(schema),
+        dtype={column: _READ_DTYPES[kind] for column, kind in schema.items()},
+        encoding="utf-8-sig",
+        keep_default_na=False,
+        # Same floats as Python's float(), so a reparsed feed compares equal to the rows already loaded
+        float_precision="round_trip",
+        chunksize=chunk_rows,
+    ) as chunks:
+        for chunk in chunks:
+            columns = {}
+            for column, kind in schema.items():
+                values = chunk[column].to_numpy()
+                columns[column] = parse_times(values) if kind == TIME else values
+            yield columns
+
+
+def read_columns(gtfs_folder: str, file_name: str, schema: dict[str, str]) -> dict[str, np.ndarray]:
+    """The schema's columns of a whole GTFS file; empty if the feed does not have it."""
+    chunks = list(iter_columns(gtfs_folder, file_name, schema))
+    if not chunks:
+        return {column: np.empty(0, dtype=np.int64 if kind == TIME else _READ_DTYPES[kind]) for column, kind in schema.items()}
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in schema}
+
+
+def to_records(columns: dict[str, np.ndarray], names: list[str], mask: np.ndarray = None) -> list[tuple]:
+    """Rows of the named columns as tuples of Python values, as COPY wants them; mask picks rows."""
+    if mask is not None:
+        return list(zip(*(columns[name][mask].tolist() for name in names)))
+    return list(zip(*(columns[name].tolist() for name in names)))
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import re
+from typing import NamedTuple, Optional
+
+import httpx
+
+
+class HttpTarget(NamedTuple):
+    """Per-upstream request policy."""
+    name: str
+    timeout: float
+    retries: int
+    backoff: float
+
+
+GTFS_RT_TARGET = HttpTarget(name="gtfs_rt", timeout=10.0, retries=2, backoff=0.5)
+OTP_TARGET = HttpTarget(name="otp", timeout=30.0, retries=1, backoff=0.5)
+# Static GTFS zips: the timeout applies between chunks, a dropped transfer is resumed rather than restarted
+GTFS_STATIC_TARGET = HttpTarget(name="gtfs_static", timeout=60.0, retries=3, backoff=1.0)
+
+RETRY_STATUS_CODES = {502, 503, 504}
+DOWNLOAD_CHUNK_BYTES = 1 << 16
+CONTENT_RANGE_TOTAL = re.compile(r"bytes \d+-\d+/(\d+)")
+
+
+class IncompleteDownload(Exception):
+    """The transfer ended before the size the server announced."""
+
+
+class HttpClientManager:
+    def __init__(self, max_connections: int = 20, max_keepalive_connections: int = 10):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections
+        )
+        self._client: Optional[httpx.AsyncClient] = None
+        # url -> (ETag, Last-Modified) of the last 200 response
+        self._validators: dict[str, tuple[Optional[str], Optional[str]]] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The shared keep-alive client. Created lazily so scripts work without the app lifespan."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(limits=self.limits)
+        return self._client
+
+    async def start(self):
+        _ = self.client
+        print("HTTP client pool started.")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            print("HTTP client pool closed.")
+
+    async def request(self, target: HttpTarget, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request with the target's timeout, retrying transport errors and 5xx gateway errors."""
+        timeout = httpx.Timeout(target.timeout, connect=min(5.0, target.timeout))
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.request(method, url, timeout=timeout, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= target.retries:
+                    return response
+            except httpx.TransportError:
+                if attempt >= target.retries:
+                    raise
+            attempt += 1
+            await asyncio.sleep(target.backoff * 2 ** (attempt - 1))
+
+    async def get_if_modified(self, target: HttpTarget, url: str) -> Optional[bytes]:
+        """
+        GET the url with If-None-Match / If-Modified-Since from the previous response.
+        Returns None when the server answers 304 Not Modified.
+        """
+        headers = {}
+        etag, last_modified = self._validators.get(url, (None, None))
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        response = await self.request(target, "GET", url, headers=headers)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        self._validators[url] = (response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return response.content
+
+    async def download(self, target: HttpTarget, url: str, path: str) -> int:
+        """
+        Stream url into path without holding it in memory. Bytes arrive in path + ".part"; after a dropped
+        transfer the next attempt asks only for the rest with a Range request. path is written only once the
+        size matches what the server announced. Returns the size.
+        """
+        part_path = path + ".part"
+        attempt = 0
+        while True:
+            try:
+                size = await self._download_part(target, url, part_path)
+                os.replace(part_path, path)
+                return size
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in RETRY_STATUS_CODES or attempt >= target.retries:
+                    raise
+            except (httpx.TransportError, IncompleteDownload):
+                if attempt >= target.retries:
+                    raise
+            attempt += 1
+            await asyncio.sleep(target.backoff * 2 ** (attempt - 1))
+
+    async def _download_part(self, target: HttpTarget, url: str, part_path: str) -> int:
+        timeout = httpx.Timeout(target.timeout, connect=min(5.0, target.timeout))
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        # Unencoded, so the byte counts of Content-Length and Range are those of the file
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        async with self.client.stream("GET", url, headers=headers, timeout=timeout) as response:
+            if response.status_code == 416:
+                # The partial file does not fit what the server has now, start over
+                os.remove(part_path)
+                raise IncompleteDownload(f"{url}: range {offset}- not satisfiable")
+            response.raise_for_status()
+            expected = None
+            if response.status_code == 206:
+                match = CONTENT_RANGE_TOTAL.match(response.headers.get("Content-Range", ""))
+                expected = int(match.group(1)) if match else None
+            else:
+                # The server ignored the Range header and sends the whole file
+                offset = 0
+                if "Content-Length" in response.headers:
+                    expected = int(response.headers["Content-Length"])
+            with open(part_path, "ab" if offset else "wb") as file:
+                async for chunk in response.aiter_raw(DOWNLOAD_CHUNK_BYTES):
+                    file.write(chunk)
+        size = os.path.getsize(part_path)
+        if expected is not None and size != expected:
+            raise IncompleteDownload(f"{url}: got {size} of {expected} bytes")
+        return size
+
+    async def post_json(self, target: HttpTarget, url: str, payload: dict) -> dict:
+        response = await self.request(target, "POST", url, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+
+http_client = HttpClientManager()
@@ -1,14 +1,23 @@
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
+from typing import NamedTuple, Optional
 from zoneinfo import ZoneInfo
-import requests
+import asyncio
+import math
+import time
+import httpx
 import json
 import polyline
 
+from config import settings
 from constants import GRAPHQL_QUERY
-from constants import CYPRUS_TZ
+from constants import CYPRUS_TZ, ROUTE_CACHE_CELL_SIZE, ROUTE_CACHE_TIME_BUCKET
+from http_client import http_client, OTP_TARGET
+from metrics import otp_request_seconds, route_plan_cache
 
-def get_current_time_iso_format():
-    now = datetime.now(CYPRUS_TZ)
+def get_current_time_iso_format(now: datetime = None):
+    if now is None:
+        now = datetime.now(CYPRUS_TZ)
     return now.isoformat(timespec='minutes')
 
 def parse_iso(s):
@@ -20,24 +29,25 @@ def decode_leg_geometry(leg):
         return polyline.decode(encoded_points)
     except (KeyError, TypeError):
         return []
-    
-def query_graphql(query, coord_from, coord_to):
-    url = "http://localhost:8080/otp/gtfs/v1"
-    headers = {"Content-Type": "application/json"}
-
-    time_value = get_current_time_iso_format()
-    query = query.format(
-        lat_from=coord_from[0],
-        lon_from=coord_from[1],
-        lat_to=coord_to[0],
-        lon_to=coord_to[1],
-        time_value=time_value
-    )
-    
-    payload = {"query": query}
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_data = response.json()
+
+async def query_graphql(query, coord_from, coord_to, departure: datetime = None):
+    payload = {
+        "query": query,
+        "variables": {
+            "latFrom": coord_from[0],
+            "lonFrom": coord_from[1],
+            "latTo": coord_to[0],
+            "lonTo": coord_to[1],
+            "departure": get_current_time_iso_format(departure)
+        }
+    }
+    start = time.perf_counter()
+    try:
+        response_data = await http_client.post_json(OTP_TARGET, settings.otp_graphql_url, payload)
+    except Exception:
+        otp_request_seconds.labels("error").observe(time.perf_counter() - start)
+        raise
+    otp_request_seconds.labels("ok").observe(time.perf_counter() - start)
     response_data = sorted(response_data['data']['planConnection']['edges'], key=lambda e: parse_iso(e['node']['end']))
     for edge in response_data:
       node = edge['node']
@@ -47,10 +57,140 @@ def query_graphql(query, coord_from, coord_to):
           leg['legGeometry']['points'] = geometry
     return response_data
 
+
+class PlanKey(NamedTuple):
+    """Origin and destination grid cells and departure time bucket; requests with the same key share a plan."""
+    from_cell: tuple[int, int]
+    to_cell: tuple[int, int]
+    time_bucket: int
+
+
+def snap_to_cell(coord: tuple[float, float]) -> tuple[int, int]:
+    return math.floor(coord[0] / ROUTE_CACHE_CELL_SIZE), math.floor(coord[1] / ROUTE_CACHE_CELL_SIZE)
+
+
+def cell_center(cell: tuple[int, int]) -> tuple[float, float]:
+    return round((cell[0] + 0.5) * ROUTE_CACHE_CELL_SIZE, 6), round((cell[1] + 0.5) * ROUTE_CACHE_CELL_SIZE, 6)
+
+
+def still_catchable(edge: dict, now: datetime) -> bool:
+    """A cached itinerary is kept while its start is ahead; walking-only ones can start any time."""
+    node = edge['node']
+    if all(leg['mode'] == "WALK" for leg in node['legs']):
+        return True
+    return parse_iso(node['start']) >= now
+
+
+def _anchor_leg(leg: dict, end: str, coord: tuple[float, float]) -> dict:
+    """A copy of the walking leg with its start ("from") or finish ("to") moved to coord."""
+    points = leg['legGeometry']['points']
+    point = [coord[0], coord[1]]
+    if end == "from":
+        points = [point] + points[1:]
+    else:
+        points = points[:-1] + [point]
+    return {**leg, end: {**leg[end], "lat": coord[0], "lon": coord[1]}, "legGeometry": {**leg['legGeometry'], "points": points}}
+
+
+def anchor_to_request(edges: list, coord_from: tuple[float, float], coord_to: tuple[float, float]) -> list:
+    """
+    Itineraries planned between cell centres, with the first and last walking legs starting and ending where the
+    caller asked instead, up to half a cell away. Walking times stay those of the centres. The cached edges are
+    shared by every caller of the cell, so they are copied, not changed.
+    """
+    anchored = []
+    for edge in edges:
+        legs = list(edge['node']['legs'])
+        if legs and legs[0]['mode'] == "WALK":
+            legs[0] = _anchor_leg(legs[0], "from", coord_from)
+        if legs and legs[-1]['mode'] == "WALK":
+            legs[-1] = _anchor_leg(legs[-1], "to", coord_to)
+        anchored.append({**edge, 'node': {**edge['node'], 'legs': legs}})
+    return anchored
+
+
+def _retrieve_exception(task: asyncio.Task):
+    # Every caller may have been cancelled before the shielded request failed; nobody else reads its exception
+    if not task.cancelled():
+        task.exception()
+
+
+class RoutePlanner:
+    def __init__(self, cache_size: int, ttl: float, max_concurrency: int):
+        """
+        Trip planning through OTP with a shared cache.
+        cache_size: Plans kept, least recently used ones are dropped first.
+        ttl: Seconds a plan is served from the cache.
+        max_concurrency: OTP requests in flight at once, the JVM only has a small heap.
+        """
+        self.cache_size = cache_size
+        self.ttl = ttl
+        # PlanKey -> (expires_at, edges)
+        self._cache: OrderedDict[PlanKey, tuple[float, list]] = OrderedDict()
+        # PlanKey -> the OTP request every concurrent caller with that key waits on
+        self._in_flight: dict[PlanKey, asyncio.Task] = {}
+        self._otp_slots = asyncio.Semaphore(max_concurrency)
+
+    def _cached(self, key: PlanKey) -> Optional[list]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires_at, edges = entry
+        if expires_at <= time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return edges
+
+    def _store(self, key: PlanKey, edges: list):
+        self._cache[key] = (time.monotonic() + self.ttl, edges)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _fetch(self, key: PlanKey, departure: datetime) -> list:
+        try:
+            async with self._otp_slots:
+                # Planned between the cell centres, so the plan is the same whoever asked first
+                edges = await query_graphql(GRAPHQL_QUERY, cell_center(key.from_cell), cell_center(key.to_cell), departure)
+            self._store(key, edges)
+            return edges
+        finally:
+            del self._in_flight[key]
+
+    async def plan(self, coord_from: tuple[float, float], coord_to: tuple[float, float]) -> list:
+        """Itineraries from coord_from to coord_to leaving now, soonest arrival first."""
+        now = datetime.now(CYPRUS_TZ)
+        key = PlanKey(snap_to_cell(coord_from), snap_to_cell(coord_to), int(now.timestamp()) // ROUTE_CACHE_TIME_BUCKET)
+        edges = self._cached(key)
+        if edges is None:
+            task = self._in_flight.get(key)
+            if task is None:
+                route_plan_cache.labels("miss").inc()
+                task = asyncio.create_task(self._fetch(key, now))
+                task.add_done_callback(_retrieve_exception)
+                self._in_flight[key] = task
+            else:
+                route_plan_cache.labels("coalesced").inc()
+            # A caller that goes away must not cancel the request the others are waiting on
+            edges = await asyncio.shield(task)
+        else:
+            route_plan_cache.labels("hit").inc()
+        # The plan may have been made a few minutes ago
+        now = now.replace(second=0, microsecond=0)
+        return anchor_to_request([edge for edge in edges if still_catchable(edge, now)], coord_from, coord_to)
+
+
+route_planner = RoutePlanner(
+    cache_size=settings.route_cache_size,
+    ttl=settings.route_cache_ttl,
+    max_concurrency=settings.otp_max_concurrency
+)
+
 if __name__ == "__main__":
   try:
       print(get_current_time_iso_format())
-      result = query_graphql(GRAPHQL_QUERY, (33.5, 34.0), (33.6, 35.1))
+      result = asyncio.run(query_graphql(GRAPHQL_QUERY, (33.5, 34.0), (33.6, 35.1)))
       print(json.dumps(result, indent=2))
-  except requests.RequestException as e:
-      print(f"GraphQL request failed: {e}")
\ No newline at end of file
+  except httpx.HTTPError as e:
+      print(f"GraphQL request failed: {e}")
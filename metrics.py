@@ -0,0 +1,142 @@
+import inspect
+import os
+import time
+from functools import wraps
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import disable_created_metrics, generate_latest, multiprocess
+
+# Upper bounds in seconds of the latency histogram buckets, from a dict lookup to a slow OTP plan
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+# With several workers every process writes its values to files in this folder, and GET /metrics merges them, so
+# any worker answers for all of them. It has to be emptied before the app starts.
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+disable_created_metrics()
+
+
+def timed(histogram_child):
+    """Decorator observing how long every call of a sync or async function takes."""
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with histogram_child.time():
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram_child.time():
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_query(function):
+    """Decorator for the crud query functions: time per call and rows returned, labelled by function name."""
+    duration = db_query_seconds.labels(function.__name__)
+    rows = db_query_rows.labels(function.__name__)
+
+    @wraps(function)
+    async def wrapper(*args, **kwargs):
+        with duration.time():
+            result = await function(*args, **kwargs)
+        rows.inc(len(result))
+        return result
+    return wrapper
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, app):
+        """
+        ASGI middleware recording the latency of every HTTP request until its response starts, labelled by the
+        route's path template so the number of series does not grow with stop and route ids.
+        """
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_and_record(message):
+            nonlocal status, start
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                self._observe(scope, status, time.perf_counter() - start)
+                start = None
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            if start is not None:
+                self._observe(scope, status, time.perf_counter() - start)
+
+    @staticmethod
+    def _observe(scope, status: int, seconds: float):
+        route = scope.get("route")
+        path = getattr(route, "path", None) or "unmatched"
+        http_request_seconds.labels(scope["method"], path, status).observe(seconds)
+
+
+http_request_seconds = Histogram(
+    "http_request_duration_seconds", "Time until the response starts, per endpoint.", ("method", "route", "status"),
+    buckets=LATENCY_BUCKETS)
+db_query_seconds = Histogram("db_query_duration_seconds", "Time of the crud query functions.", ("function",),
+                             buckets=LATENCY_BUCKETS)
+db_query_rows = Counter("db_query_rows", "Rows returned by the crud query functions.", ("function",))
+# Per worker, as each has its own pool
+db_pool_connections = Gauge(
+    "db_pool_connections", "Connections of the SQLAlchemy pool by state; in_use at size + max_overflow is saturated.",
+    ("state",), multiprocess_mode="liveall")
+
+realtime_phase_seconds = Histogram(
+    "realtime_phase_duration_seconds", "Time of each phase of a GTFS-RT poll: fetch, parse, predictions, "
+    "positions, apply and share.", ("phase",), buckets=LATENCY_BUCKETS)
+realtime_polls = Counter("realtime_polls", "GTFS-RT polls by outcome.", ("result",))
+realtime_feed_timestamp = Gauge("realtime_feed_timestamp_seconds", "Header timestamp of the last GTFS-RT feed.",
+                                multiprocess_mode="max")
+realtime_feed_entities = Gauge("realtime_feed_entities", "Entities in the last GTFS-RT feed.",
+                               multiprocess_mode="livemostrecent")
+realtime_vehicles = Gauge("realtime_vehicles", "Buses in the published realtime snapshot.",
+                          multiprocess_mode="livemostrecent")
+realtime_predictions = Gauge("realtime_overlay_predictions", "Stop time predictions held in the delay overlay.",
+                             multiprocess_mode="livemostrecent")
+
+otp_request_seconds = Histogram("otp_request_duration_seconds", "Time of OTP planConnection requests.", ("outcome",),
+                                buckets=LATENCY_BUCKETS)
+route_plans = Counter("route_plans", "Answers of /api/make_route by the planner that gave them.", ("source",))
+route_plan_cache = Counter("route_plan_cache", "OTP plan lookups by cache outcome: hit, miss or coalesced.", ("result",))
+journey_plan_seconds = Histogram("journey_plan_duration_seconds", "Time of the built-in RAPTOR planner per request.",
+                                 buckets=LATENCY_BUCKETS)
+
+gtfs_reload_phase_seconds = Gauge(
+    "gtfs_reload_phase_duration_seconds", "Duration of each phase of the last GTFS reload that ran it.", ("phase",),
+    multiprocess_mode="mostrecent")
+gtfs_reloads = Counter("gtfs_reloads", "GTFS reloads by outcome.", ("result",))
+gtfs_reload_last_success = Gauge(
+    "gtfs_reload_last_success_timestamp_seconds", "Unix time the last GTFS reload finished without an error.",
+    multiprocess_mode="max")
+# Summed over the live workers, so 1 while one of them leads
+worker_is_leader = Gauge(
+    "worker_is_leader", "Workers that reload GTFS, poll GTFS-RT and run OTP; 1 with a leader, 0 without.",
+    multiprocess_mode="livesum")
+
+
+def render() -> bytes:
+    """Every metric in the Prometheus text format; in multiprocess mode those of all the workers."""
+    if not MULTIPROCESS:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def mark_process_dead():
+    """Drop this worker's live gauges from the merged metrics when it shuts down."""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
@@ -20,6 +20,7 @@ class Route(Base):
     route_id: Mapped[int] = mapped_column(Integer, primary_key=True, unique=True)
     route_short_name: Mapped[str] = mapped_column(String(200), nullable=False)
     route_long_name: Mapped[str] = mapped_column(String(200), nullable=False)
+    feed_id: Mapped[str] = mapped_column(String(100), nullable=True)
 
     trips: Mapped[List["Trip"]] = relationship(back_populates="route")
     shapes: Mapped[List["Shape"]] = relationship(back_populates="route")
@@ -33,6 +34,7 @@ class Trip(Base):
     service_id: Mapped[int] = mapped_column(Integer, nullable=False)
     direction_id: Mapped[int] = mapped_column(Integer, nullable=False)
     trip_headsign: Mapped[str] = mapped_column(String(200), nullable=False)
+    feed_id: Mapped[str] = mapped_column(String(100), nullable=True)
 
     stop_times: Mapped["Stop_Time"] = relationship(back_populates="trip")
     route: Mapped["Route"] = relationship(back_populates="trips")
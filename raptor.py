@@ -0,0 +1,503 @@
+import asyncio
+import math
+import time
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING, NamedTuple, Optional
+
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from constants import CYPRUS_TZ
+from crud import get_all_stops
+from delay_overlay import DelayOverlay
+from service_calendar import SECONDS_PER_DAY
+from shape_snapping import METERS_PER_DEGREE
+from stop_index import UniformGrid
+from timetable import REALTIME_DELAY_MARGIN, TimetableIndex, seconds_since_midnight
+
+if TYPE_CHECKING:
+    from timetable_snapshot import TimetableSnapshot
+
+# Walking model: straight-line distance times a detour factor for the street network, at an unhurried pace
+WALK_SPEED = 1.2
+WALK_DETOUR_FACTOR = 1.3
+# Metres walked from the origin to the first stop and from the last stop to the destination
+MAX_ACCESS_WALK = 800.0
+# Metres walked between two stops to change buses
+MAX_TRANSFER_WALK = 300.0
+# Up to this far a walk-only itinerary is offered next to the transit ones
+MAX_DIRECT_WALK = 2000.0
+# Seconds allowed to get from one bus onto the next
+TRANSFER_SLACK = 60
+# Buses ridden in one journey at most
+MAX_ROUNDS = 4
+# Itineraries returned, the frontend shows three
+MAX_ITINERARIES = 3
+# Service dates whose flattened timetable is kept
+DAY_CACHE_SIZE = 2
+
+UNREACHED = np.iinfo(np.int64).max // 4
+# Departure keys are position * KEY_STRIDE + time + KEY_TIME_OFFSET: yesterday's trips after midnight have negative
+# times and service days run past 24:00:00, the offset and stride keep every position's keys in their own range
+KEY_TIME_OFFSET = SECONDS_PER_DAY
+KEY_STRIDE = 4 * SECONDS_PER_DAY
+
+
+class DayTimetable(NamedTuple):
+    """
+    Every trip running on one service date as route patterns in flat arrays, times on that date's clock.
+    A pattern is a sequence of stops served by trips that never overtake each other; its (trip, stop) times are
+    stored trip-major from its block offset. Positions are the (pattern, index) pairs, numbered pattern by pattern.
+    """
+    pattern_lengths: np.ndarray
+    pattern_trip_counts: np.ndarray
+    pattern_blocks: np.ndarray
+    pattern_first_trips: np.ndarray
+    position_stops: np.ndarray
+    position_patterns: np.ndarray
+    position_indexes: np.ndarray
+    position_key_starts: np.ndarray
+    # Departure keys of every position, sorted: one searchsorted finds the next trip at all positions at once
+    departure_keys: np.ndarray
+    departures: np.ndarray
+    arrivals: np.ndarray
+    trip_ids: np.ndarray
+    # trip_id -> block offsets of its rows, for laying realtime predictions over the arrivals
+    trip_rows: dict[int, list[int]]
+
+
+class RoundLabels(NamedTuple):
+    """How each stop was reached in one round: by riding (position of the alighting, trip, boarding index) or by walking."""
+    ride_positions: np.ndarray
+    ride_trips: np.ndarray
+    ride_boardings: np.ndarray
+    walk_from: np.ndarray
+
+
+class JourneyPlanner:
+    def __init__(self, stops: list[dict], timetable: TimetableIndex):
+        """
+        Round-based (RAPTOR) earliest-arrival journeys over the in-memory timetable, without OTP.
+        stops: rows of get_all_stops
+        timetable: supplies the scheduled calls of every trip and the service calendar
+        """
+        self.timetable = timetable
+        self.stop_ids = [stop["stop_id"] for stop in stops]
+        self.stop_names = [stop["stop_name"] for stop in stops]
+        self._stop_indexes = {stop_id: i for i, stop_id in enumerate(self.stop_ids)}
+        self._lat = np.array([stop["stop_lat"] for stop in stops], dtype=np.float64)
+        self._lon = np.array([stop["stop_lon"] for stop in stops], dtype=np.float64)
+        # Equirectangular projection around the network's mean latitude, as in shape_snapping
+        mean_lat = float(self._lat.mean()) if len(stops) else 0.0
+        self._lon_scale = METERS_PER_DEGREE * math.cos(math.radians(mean_lat))
+        self._transfer_from, self._transfer_to, self._transfer_seconds = self._build_transfers()
+
+        # Trips with the same route and stop sequence, the same pattern on every date
+        self._patterns: dict[tuple[int, tuple[int, ...]], list[int]] = {}
+        for trip_id, calls in timetable.trips.items():
+            if all(stop_id in self._stop_indexes for stop_id in calls.stop_ids):
+                self._patterns.setdefault((calls.route_id, tuple(calls.stop_ids)), []).append(trip_id)
+        self._days: dict[date, DayTimetable] = {}
+        # (service date, overlay version, arrivals with realtime predictions)
+        self._predicted: Optional[tuple[date, int, np.ndarray]] = None
+
+    @classmethod
+    async def load(cls, session: AsyncSession, timetable: TimetableIndex) -> "JourneyPlanner":
+        return await cls.build(await get_all_stops(session), timetable)
+
+    @classmethod
+    async def from_snapshot(cls, snapshot: "TimetableSnapshot", timetable: TimetableIndex) -> "JourneyPlanner":
+        return await cls.build(snapshot.stops(), timetable)
+
+    @classmethod
+    async def build(cls, stops: list[dict], timetable: TimetableIndex) -> "JourneyPlanner":
+        start = time.perf_counter()
+        planner = await asyncio.to_thread(cls, stops, timetable)
+        # Today's timetable is flattened now rather than by the first request
+        await asyncio.to_thread(planner.day_timetable, datetime.now(CYPRUS_TZ).date())
+        print(f"Journey planner built: {len(planner._patterns)} patterns, {len(planner._transfer_from)} transfers "
+              f"in {time.perf_counter() - start:.3f}s")
+        return planner
+
+    def _walk_seconds(self, meters: np.ndarray) -> np.ndarray:
+        return np.ceil(meters * WALK_DETOUR_FACTOR / WALK_SPEED).astype(np.int64)
+
+    def _distances(self, lat: float, lon: float, stops: np.ndarray = None) -> np.ndarray:
+        if stops is None:
+            return np.hypot((self._lat - lat) * METERS_PER_DEGREE, (self._lon - lon) * self._lon_scale)
+        return np.hypot((self._lat[stops] - lat) * METERS_PER_DEGREE, (self._lon[stops] - lon) * self._lon_scale)
+
+    def _build_transfers(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Footpaths between every pair of distinct stops within MAX_TRANSFER_WALK, as parallel arrays."""
+        grid = UniformGrid(MAX_TRANSFER_WALK / METERS_PER_DEGREE)
+        for i in range(len(self.stop_ids)):
+            grid.add(self._lat[i], self._lon[i], i)
+        lat_radius = MAX_TRANSFER_WALK / METERS_PER_DEGREE
+        lon_radius = MAX_TRANSFER_WALK / self._lon_scale
+        sources, targets, distances = [], [], []
+        for i in range(len(self.stop_ids)):
+            lat, lon = self._lat[i], self._lon[i]
+            bbox = (lon - lon_radius, lat - lat_radius, lon + lon_radius, lat + lat_radius)
+            nearby = np.array([j for items in grid.cells_in(bbox) for j in items], dtype=np.intp)
+            meters = self._distances(lat, lon, nearby)
+            keep = (meters <= MAX_TRANSFER_WALK) & (nearby != i)
+            sources.append(np.full(int(keep.sum()), i, dtype=np.intp))
+            targets.append(nearby[keep])
+            distances.append(meters[keep])
+        if not sources:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0, dtype=np.int64)
+        return np.concatenate(sources), np.concatenate(targets), self._walk_seconds(np.concatenate(distances))
+
+    def day_timetable(self, service_date: date) -> DayTimetable:
+        """The flattened timetable of service_date, built on first use and kept for DAY_CACHE_SIZE dates."""
+        day = self._days.get(service_date)
+        if day is None:
+            day = self._build_day(service_date)
+            if len(self._days) >= DAY_CACHE_SIZE:
+                self._days.clear()
+            self._days[service_date] = day
+        return day
+
+    def _build_day(self, service_date: date) -> DayTimetable:
+        calendar = self.timetable.calendar
+        today = calendar.active_services(service_date) if calendar else None
+        yesterday = calendar.active_services(service_date - timedelta(days=1)) if calendar else frozenset()
+
+        lengths, trip_counts, stop_lists = [], [], []
+        departure_blocks, arrival_blocks, trip_id_blocks = [], [], []
+        for (_, stop_ids), trip_ids in self._patterns.items():
+            rows = []
+            for trip_id in trip_ids:
+                calls = self.timetable.trips[trip_id]
+                if today is None or calls.service_id in today:
+                    rows.append((trip_id, 0))
+                # Yesterday's trips still running after midnight, moved onto today's clock
+                if calls.service_id in yesterday and calls.arrival_times[-1] >= SECONDS_PER_DAY:
+                    rows.append((trip_id, -SECONDS_PER_DAY))
+            if not rows:
+                continue
+            shifts = np.array([shift for _, shift in rows], dtype=np.int64)[:, None]
+            departures = np.array([self.timetable.trips[trip_id].departure_times for trip_id, _ in rows], dtype=np.int64) + shifts
+            arrivals = np.array([self.timetable.trips[trip_id].arrival_times for trip_id, _ in rows], dtype=np.int64) + shifts
+            stops = np.array([self._stop_indexes[stop_id] for stop_id in stop_ids], dtype=np.intp)
+
+            # Split into groups in which no trip overtakes another, so the first catchable trip is also the first to arrive
+            groups, lasts = [], []
+            for row in np.argsort(departures[:, 0], kind="stable"):
+                for group, last in enumerate(lasts):
+                    if (departures[row] >= departures[last]).all() and (arrivals[row] >= arrivals[last]).all():
+                        groups[group].append(row)
+                        lasts[group] = row
+                        break
+                else:
+                    groups.append([row])
+                    lasts.append(row)
+            for group in groups:
+                lengths.append(len(stops))
+                trip_counts.append(len(group))
+                stop_lists.append(stops)
+                departure_blocks.append(departures[group])
+                arrival_blocks.append(arrivals[group])
+                trip_id_blocks.append([rows[row][0] for row in group])
+
+        lengths = np.array(lengths, dtype=np.int64)
+        trip_counts = np.array(trip_counts, dtype=np.int64)
+        blocks = np.concatenate(([0], np.cumsum(lengths * trip_counts)[:-1])).astype(np.int64)
+        first_trips = np.concatenate(([0], np.cumsum(trip_counts)[:-1])).astype(np.int64)
+        position_patterns = np.repeat(np.arange(len(lengths)), lengths)
+        first_positions = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        position_indexes = np.arange(int(lengths.sum())) - first_positions[position_patterns]
+        # A position's departures are its pattern's trip count long, laid out position by position
+        position_key_starts = np.concatenate(([0], np.cumsum(trip_counts[position_patterns])[:-1])).astype(np.int64)
+
+        departure_keys = []
+        trip_rows: dict[int, list[int]] = {}
+        for pattern, departures in enumerate(departure_blocks):
+            positions = first_positions[pattern] + np.arange(lengths[pattern])
+            departure_keys.append((positions * KEY_STRIDE + departures + KEY_TIME_OFFSET).T.ravel())
+            for trip, trip_id in enumerate(trip_id_blocks[pattern]):
+                trip_rows.setdefault(trip_id, []).append(int(blocks[pattern] + trip * lengths[pattern]))
+        print(f"Journey planner timetable for {service_date}: {len(lengths)} patterns, {int(trip_counts.sum())} trips")
+        return DayTimetable(
+            pattern_lengths=lengths,
+            pattern_trip_counts=trip_counts,
+            pattern_blocks=blocks,
+            pattern_first_trips=first_trips,
+            position_stops=np.concatenate(stop_lists) if stop_lists else np.empty(0, dtype=np.intp),
+            position_patterns=position_patterns,
+            position_indexes=position_indexes,
+            position_key_starts=position_key_starts,
+            departure_keys=np.concatenate(departure_keys) if departure_keys else np.empty(0, dtype=np.int64),
+            departures=np.concatenate([block.ravel() for block in departure_blocks]) if departure_blocks else np.empty(0, dtype=np.int64),
+            arrivals=np.concatenate([block.ravel() for block in arrival_blocks]) if arrival_blocks else np.empty(0, dtype=np.int64),
+            trip_ids=np.array([trip_id for trip_ids in trip_id_blocks for trip_id in trip_ids], dtype=np.int64),
+            trip_rows=trip_rows,
+        )
+
+    def _arrivals(self, service_date: date, day: DayTimetable, overlay: Optional[DelayOverlay]) -> np.ndarray:
+        """
+        Arrival times with the realtime predictions laid over them. Boarding still uses the scheduled departures,
+        which keeps the departure keys sorted and never sends anyone to a stop after the bus left.
+        """
+        if not overlay:
+            return day.arrivals
+        if self._predicted is not None and self._predicted[:2] == (service_date, overlay.version):
+            return self._predicted[2]
+        arrivals = day.arrivals.copy()
+        for (trip_id, stop_sequence), prediction in overlay.items():
+            rows = day.trip_rows.get(trip_id)
+            if rows is None:
+                continue
+            stop_sequences = self.timetable.trips[trip_id].stop_sequences
+            i = bisect_left(stop_sequences, stop_sequence)
+            if i == len(stop_sequences) or stop_sequences[i] != stop_sequence:
+                continue
+            for row in rows:
+                if abs(prediction.arrival_time - arrivals[row + i]) <= REALTIME_DELAY_MARGIN:
+                    arrivals[row + i] = prediction.arrival_time
+        self._predicted = (service_date, overlay.version, arrivals)
+        return arrivals
+
+    def _search(self, day: DayTimetable, arrivals: np.ndarray, access_stops: np.ndarray, access_times: np.ndarray,
+                egress_stops: np.ndarray, egress_seconds: np.ndarray,
+                walk_only: int) -> tuple[list[RoundLabels], list[tuple[int, int, int]]]:
+        """
+        Earliest arrival at every stop after each round of riding one more bus, then walking one footpath.
+        Returns the labels of every round and the Pareto-optimal (round, egress stop, arrival at the destination)
+        that beat walk_only, the arrival without any bus.
+        """
+        stop_count = len(self.stop_ids)
+        pattern_count = len(day.pattern_lengths)
+        max_length = int(day.pattern_lengths.max()) if pattern_count else 1
+        # Board codes sort by trip first, then by boarding index; every pattern gets its own range, decreasing
+        # along the positions, so one running minimum over all positions never crosses from one pattern into the next
+        segment = (int(day.pattern_trip_counts.max()) + 1) * max_length if pattern_count else 1
+        segment_bases = (pattern_count - day.position_patterns) * segment
+        not_boarded = segment_bases + segment - 1
+        position_trip_counts = day.pattern_trip_counts[day.position_patterns]
+        position_numbers = np.arange(len(day.position_stops), dtype=np.int64)
+        pattern_starts = day.position_indexes == 0
+
+        reached = np.full(stop_count, UNREACHED, dtype=np.int64)
+        np.minimum.at(reached, access_stops, access_times)
+        best = reached.copy()
+        rounds = [RoundLabels(*(np.full(stop_count, -1, dtype=np.int64) for _ in range(4)))]
+        journeys = []
+        best_at_destination = min(walk_only, int((reached[egress_stops] + egress_seconds).min()))
+        for round_number in range(1, MAX_ROUNDS + 1):
+            ready = reached + (TRANSFER_SLACK if round_number > 1 else 0)
+            ready_at_positions = ready[day.position_stops]
+            can_reach = ready_at_positions < UNREACHED
+            search_times = np.minimum(ready_at_positions, KEY_STRIDE - KEY_TIME_OFFSET - 1)
+            first_trips = np.searchsorted(day.departure_keys, position_numbers * KEY_STRIDE + search_times + KEY_TIME_OFFSET) \
+                - day.position_key_starts
+            codes = np.where(can_reach & (first_trips < position_trip_counts),
+                             segment_bases + first_trips * max_length + day.position_indexes, not_boarded)
+            codes = np.minimum.accumulate(codes)
+            # The trip being ridden when reaching a position was boarded at one of the positions before it
+            boarded = np.empty_like(codes)
+            boarded[0:1] = not_boarded[0:1]
+            boarded[1:] = codes[:-1]
+            boarded[pattern_starts] = not_boarded[pattern_starts]
+            riding = np.flatnonzero(boarded < not_boarded)
+            board_codes = boarded[riding] - segment_bases[riding]
+            trips, boardings = board_codes // max_length, board_codes % max_length
+            patterns = day.position_patterns[riding]
+            arrive = arrivals[day.pattern_blocks[patterns] + trips * day.pattern_lengths[patterns] + day.position_indexes[riding]]
+            stops = day.position_stops[riding]
+
+            labels = RoundLabels(*(np.full(stop_count, -1, dtype=np.int64) for _ in range(4)))
+            reached = reached.copy()
+            order = np.lexsort((arrive, stops))
+            _, firsts = np.unique(stops[order], return_index=True)
+            earliest = order[firsts]
+            improved = earliest[arrive[earliest] < best[stops[earliest]]]
+            ridden_to = stops[improved]
+            reached[ridden_to] = best[ridden_to] = arrive[improved]
+            labels.ride_positions[ridden_to] = riding[improved]
+            labels.ride_trips[ridden_to] = trips[improved]
+            labels.ride_boardings[ridden_to] = boardings[improved]
+
+            # Footpaths from the stops just reached by bus
+            ridden = np.zeros(stop_count, dtype=bool)
+            ridden[ridden_to] = True
+            walks = np.flatnonzero(ridden[self._transfer_from])
+            walk_arrive = reached[self._transfer_from[walks]] + self._transfer_seconds[walks]
+            walk_to = self._transfer_to[walks]
+            order = np.lexsort((walk_arrive, walk_to))
+            _, firsts = np.unique(walk_to[order], return_index=True)
+            earliest = order[firsts]
+            walked = earliest[walk_arrive[earliest] < best[walk_to[earliest]]]
+            walked_to = walk_to[walked]
+            reached[walked_to] = best[walked_to] = walk_arrive[walked]
+            labels.walk_from[walked_to] = self._transfer_from[walks[walked]]
+            rounds.append(labels)
+            if not len(improved):
+                break
+
+            at_destination = reached[egress_stops] + egress_seconds
+            egress = int(np.argmin(at_destination)) if len(egress_stops) else -1
+            if egress >= 0 and at_destination[egress] < best_at_destination:
+                best_at_destination = int(at_destination[egress])
+                journeys.append((round_number, int(egress_stops[egress]), best_at_destination))
+        return rounds, journeys
+
+    def _clock(self, service_date: date, seconds: int) -> str:
+        midnight = datetime(service_date.year, service_date.month, service_date.day, tzinfo=CYPRUS_TZ)
+        return (midnight + timedelta(seconds=int(seconds))).isoformat(timespec="seconds")
+
+    def _place(self, stop: int) -> dict:
+        return {"name": self.stop_names[stop], "lat": float(self._lat[stop]), "lon": float(self._lon[stop])}
+
+    def _walk_leg(self, service_date: date, start: int, end: int, origin: dict, destination: dict) -> dict:
+        return {
+            "mode": "WALK",
+            "from": {**origin, "departure": {"scheduledTime": self._clock(service_date, start), "estimated": None}},
+            "to": {**destination, "arrival": {"scheduledTime": self._clock(service_date, end), "estimated": None}},
+            "route": None,
+            "legGeometry": {"points": [[origin["lat"], origin["lon"]], [destination["lat"], destination["lon"]]]},
+        }
+
+    def _ride_leg(self, service_date: date, day: DayTimetable, arrivals: np.ndarray, overlay: Optional[DelayOverlay],
+                  position: int, trip: int, boarding: int) -> tuple[dict, int, int, int]:
+        """The bus leg ending at position, with the stop it was boarded at and its departure and arrival times."""
+        pattern = int(day.position_patterns[position])
+        alighting = int(day.position_indexes[position])
+        first_position = position - alighting
+        row = int(day.pattern_blocks[pattern] + trip * day.pattern_lengths[pattern])
+        trip_id = int(day.trip_ids[day.pattern_first_trips[pattern] + trip])
+        calls = self.timetable.trips[trip_id]
+        route_id = calls.route_id
+        short_name, long_name = self.timetable.route_names.get(route_id, ("", ""))
+        departure = int(day.departures[row + boarding])
+        scheduled_arrival = int(day.arrivals[row + alighting])
+        arrival = int(arrivals[row + alighting])
+        board_stop = int(day.position_stops[first_position + boarding])
+        alight_stop = int(day.position_stops[position])
+
+        estimated_departure = None
+        prediction = overlay.get(trip_id, calls.stop_sequences[boarding]) if overlay else None
+        if prediction is not None and abs(prediction.departure_time - departure) <= REALTIME_DELAY_MARGIN:
+            estimated_departure = {"time": self._clock(service_date, prediction.departure_time),
+                                   "delay": prediction.departure_time - departure}
+        estimated_arrival = None
+        if arrival != scheduled_arrival:
+            estimated_arrival = {"time": self._clock(service_date, arrival), "delay": arrival - scheduled_arrival}
+        stops = day.position_stops[first_position + boarding:first_position + alighting + 1]
+        leg = {
+            "mode": "BUS",
+            "from": {**self._place(board_stop),
+                     "departure": {"scheduledTime": self._clock(service_date, departure), "estimated": estimated_departure}},
+            "to": {**self._place(alight_stop),
+                   "arrival": {"scheduledTime": self._clock(service_date, scheduled_arrival), "estimated": estimated_arrival}},
+            "route": {"gtfsId": str(route_id), "longName": long_name, "shortName": short_name},
+            "legGeometry": {"points": [[float(self._lat[stop]), float(self._lon[stop])] for stop in stops]},
+        }
+        return leg, board_stop, departure, arrival
+
+    def _walk_seconds_to(self, place: dict, stop: int) -> int:
+        return int(self._walk_seconds(self._distances(place["lat"], place["lon"], np.array([stop])))[0])
+
+    def _itinerary(self, service_date: date, day: DayTimetable, arrivals: np.ndarray, overlay: Optional[DelayOverlay],
+                   rounds: list[RoundLabels], journey: tuple[int, int, int], origin: dict, destination: dict) -> tuple[dict, int]:
+        """One journey found by _search as an OTP-style edge, with the time the walk to its first bus starts."""
+        round_number, stop, at_destination = journey
+        # Followed backwards from the last stop: ("walk", from, to) footpaths and ("ride", position, trip, boarding) buses
+        steps = []
+        while round_number > 0:
+            labels = rounds[round_number]
+            walk_from = int(labels.walk_from[stop])
+            if walk_from >= 0:
+                steps.append(("walk", walk_from, stop))
+                stop = walk_from
+            position = int(labels.ride_positions[stop])
+            if position >= 0:
+                steps.append(("ride", position, int(labels.ride_trips[stop]), int(labels.ride_boardings[stop])))
+                pattern_start = position - int(day.position_indexes[position])
+                stop = int(day.position_stops[pattern_start + int(labels.ride_boardings[stop])])
+            round_number -= 1
+        steps.reverse()
+
+        legs = []
+        clock = None
+        for step in steps:
+            if step[0] == "ride":
+                leg, board_stop, departure, clock = self._ride_leg(service_date, day, arrivals, overlay, *step[1:])
+                if not legs:
+                    start = departure - self._walk_seconds_to(origin, board_stop)
+                    if start < departure:
+                        legs.append(self._walk_leg(service_date, start, departure, origin, self._place(board_stop)))
+                legs.append(leg)
+            else:
+                _, walk_from, walk_to = step
+                end = clock + self._walk_seconds_to(self._place(walk_from), walk_to)
+                legs.append(self._walk_leg(service_date, clock, end, self._place(walk_from), self._place(walk_to)))
+                clock = end
+        if clock < at_destination:
+            legs.append(self._walk_leg(service_date, clock, at_destination, self._place(stop), destination))
+        node = {
+            "start": self._clock(service_date, start),
+            "end": self._clock(service_date, at_destination),
+            "legs": legs,
+        }
+        return {"node": node}, start
+
+    def plan(self, coord_from: tuple[float, float], coord_to: tuple[float, float], departure: datetime = None,
+             overlay: Optional[DelayOverlay] = None) -> list:
+        """
+        Itineraries from coord_from to coord_to leaving at departure (default now), soonest arrival first, in the
+        shape of OTP's planConnection edges. Empty when no stop is within walking distance of either end.
+        """
+        if departure is None:
+            departure = datetime.now(CYPRUS_TZ)
+        service_date = departure.date()
+        leave = seconds_since_midnight(departure)
+        day = self.day_timetable(service_date)
+        arrivals = self._arrivals(service_date, day, overlay)
+        origin = {"name": "Origin", "lat": coord_from[0], "lon": coord_from[1]}
+        destination = {"name": "Destination", "lat": coord_to[0], "lon": coord_to[1]}
+
+        access_meters = self._distances(*coord_from)
+        access_stops = np.flatnonzero(access_meters <= MAX_ACCESS_WALK)
+        access_seconds = self._walk_seconds(access_meters[access_stops])
+        egress_meters = self._distances(*coord_to)
+        egress_stops = np.flatnonzero(egress_meters <= MAX_ACCESS_WALK)
+        egress_seconds = self._walk_seconds(egress_meters[egress_stops])
+        direct_meters = math.hypot((coord_to[0] - coord_from[0]) * METERS_PER_DEGREE, (coord_to[1] - coord_from[1]) * self._lon_scale)
+        direct_seconds = int(self._walk_seconds(np.array([direct_meters]))[0]) if direct_meters <= MAX_DIRECT_WALK else None
+
+        edges = []
+        if direct_seconds is not None:
+            leg = self._walk_leg(service_date, leave, leave + direct_seconds, origin, destination)
+            edges.append({"node": {"start": self._clock(service_date, leave),
+                                   "end": self._clock(service_date, leave + direct_seconds), "legs": [leg]}})
+        if not len(access_stops) or not len(egress_stops):
+            return edges
+
+        seen = set()
+        journeys_found = []
+        while len(journeys_found) < MAX_ITINERARIES:
+            walk_only = leave + direct_seconds if direct_seconds is not None else UNREACHED
+            rounds, journeys = self._search(day, arrivals, access_stops, leave + access_seconds,
+                                            egress_stops, egress_seconds, walk_only)
+            if not journeys:
+                break
+            latest_start = leave
+            for journey in journeys:
+                edge, start = self._itinerary(service_date, day, arrivals, overlay, rounds, journey, origin, destination)
+                latest_start = max(latest_start, start)
+                signature = tuple((leg["route"]["gtfsId"], leg["from"]["departure"]["scheduledTime"])
+                                  for leg in edge["node"]["legs"] if leg["route"])
+                if signature not in seen and len(journeys_found) < MAX_ITINERARIES:
+                    seen.add(signature)
+                    journeys_found.append(edge)
+            # Next search leaves just too late for the buses found so far
+            leave = latest_start + 1
+        # A later search can find the same arrival with an earlier start, only the later start is worth showing
+        spans = [(edge["node"]["start"], edge["node"]["end"]) for edge in journeys_found]
+        edges += [edge for edge, (start, end) in zip(journeys_found, spans) if not any(
+            other_start >= start and other_end <= end and (other_start, other_end) != (start, end)
+            for other_start, other_end in spans)]
+        edges.sort(key=lambda edge: edge["node"]["end"])
+        return edges
@@ -0,0 +1,198 @@
+import asyncio
+import time
+from types import MappingProxyType
+from typing import Awaitable, Callable, Mapping, NamedTuple, Optional
+
+import orjson
+
+from GTFS_Parsing import GTFSRealtimeParser
+from delay_overlay import DelayOverlay, delay_overlay
+from shape_snapping import ShapeSnapper
+from timetable import seconds_since_midnight
+from db_manager import DatabaseManager
+from db_manager import db_manager as Manager
+from config import settings
+from metrics import realtime_phase_seconds, realtime_polls, realtime_feed_timestamp, realtime_vehicles, realtime_predictions
+
+
+class RealtimeSnapshot(NamedTuple):
+    """Immutable result of one GTFS-RT poll, shared by every request until the next tick."""
+    buses: tuple
+    body: bytes
+    fetched_at: float
+    version: int
+    # Buses by id, and what changed since the snapshot with version - 1
+    by_id: Mapping[int, dict]
+    changed: tuple
+    removed: tuple
+
+
+class RealtimePoller:
+    def __init__(self, db_manager: DatabaseManager, gtfs_rt_url: str, interval: float, max_staleness: float,
+                 overlay: DelayOverlay, mirror_predictions: bool = False):
+        """
+        interval: Seconds between two polls of the GTFS-RT feed.
+        max_staleness: Age in seconds after which a snapshot is no longer served.
+        overlay: Where the stop time predictions of every tick are merged.
+        mirror_predictions: Also write the predictions to the stop_time_predictions table.
+        """
+        self.db_manager = db_manager
+        self.gtfs_rt_url = gtfs_rt_url
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.overlay = overlay
+        self.mirror_predictions = mirror_predictions
+        # Set once the static data is loaded; snaps buses onto their shapes for progress and ETAs
+        self.snapper: Optional[ShapeSnapper] = None
+        self._snapshot: Optional[RealtimeSnapshot] = None
+        # Header timestamp of the last feed, handed on to the followers with every tick
+        self._feed_timestamp: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._updated = asyncio.Event()
+        # Set on the leader worker: hands every tick to the followers, None when the last one is still current
+        self.share: Optional[Callable[[Optional[bytes]], Awaitable[None]]] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            print(f"Realtime poller started ({self.interval}s interval).")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        print("Realtime poller stopped.")
+
+    async def poll_once(self):
+        """Fetch the feed once, merge its predictions into the overlay and publish a new snapshot."""
+        async with self.db_manager.session_factory() as session:
+            rt_parser = GTFSRealtimeParser(session, self.gtfs_rt_url)
+            await rt_parser.fetch_gtfs_rt_data()
+            if rt_parser.not_modified and self._snapshot is not None:
+                # Upstream answered 304: the published positions are still current.
+                self._snapshot = self._snapshot._replace(fetched_at=time.monotonic())
+                realtime_polls.labels("not_modified").inc()
+                if self.share is not None:
+                    await self.share(None)
+                return
+            if rt_parser.feed is None:
+                # Keep the previous snapshot; it will age out after max_staleness.
+                realtime_polls.labels("no_feed").inc()
+                return
+            self._feed_timestamp = rt_parser.feed.header.timestamp or None
+            if self._feed_timestamp is not None:
+                realtime_feed_timestamp.set(self._feed_timestamp)
+            with realtime_phase_seconds.labels("predictions").time():
+                await rt_parser.update_predictions(self.overlay.ttl if self.mirror_predictions else None)
+            with realtime_phase_seconds.labels("positions").time():
+                buses = await rt_parser.get_bus_positions()
+        with realtime_phase_seconds.labels("apply").time():
+            predictions = rt_parser.predictions
+            snapper = self.snapper
+            if snapper is not None:
+                # Vehicles whose trip_update has no stop_time_updates still get ETAs from their position on the shape
+                along = snapper.snap(buses)
+                estimated = snapper.estimate_arrivals(buses, along, seconds_since_midnight(),
+                                                      skip_trips={trip_id for trip_id, _ in predictions})
+                predictions = {**estimated, **predictions}
+            added_trip_routes = {trip_id: route_id for (route_id, _, _), trip_id in rt_parser.added_trip_ids.items()}
+            self.overlay.update(predictions, added_trip_routes)
+            self._publish(buses)
+        realtime_polls.labels("ok").inc()
+        realtime_vehicles.set(len(self._snapshot.buses))
+        realtime_predictions.set(len(self.overlay))
+        if self.share is not None:
+            with realtime_phase_seconds.labels("share").time():
+                await self.share(self._encode_tick(buses, predictions, added_trip_routes))
+
+    def _encode_tick(self, buses: list[dict], predictions: dict, added_trip_routes: dict) -> bytes:
+        return orjson.dumps({
+            "timestamp": self._feed_timestamp,
+            "buses": buses,
+            "predictions": [[trip_id, stop_sequence, *prediction]
+                            for (trip_id, stop_sequence), prediction in predictions.items()],
+            "added_trip_routes": list(added_trip_routes.items()),
+        })
+
+    def apply_shared(self, payload: Optional[bytes]):
+        """On a follower worker: apply a tick the leader polled, or with None keep the current one fresh."""
+        if payload is None:
+            if self._snapshot is not None:
+                self._snapshot = self._snapshot._replace(fetched_at=time.monotonic())
+            return
+        tick = orjson.loads(payload)
+        self._feed_timestamp = tick["timestamp"]
+        if self._feed_timestamp is not None:
+            realtime_feed_timestamp.set(self._feed_timestamp)
+        predictions = {(trip_id, stop_sequence): tuple(prediction)
+                       for trip_id, stop_sequence, *prediction in tick["predictions"]}
+        self.overlay.update(predictions, dict(tick["added_trip_routes"]))
+        self._publish(tick["buses"])
+        realtime_vehicles.set(len(self._snapshot.buses))
+        realtime_predictions.set(len(self.overlay))
+
+    def _publish(self, buses: list[dict]):
+        # Vehicles of ADDED trips without a trip_id yet cannot be tracked by the streams, so no endpoint shows them
+        buses = [bus for bus in buses if bus["id"] is not None]
+        previous = self._snapshot
+        previous_by_id = previous.by_id if previous is not None else {}
+        by_id = {bus["id"]: bus for bus in buses}
+        self._snapshot = RealtimeSnapshot(
+            buses=tuple(buses),
+            body=orjson.dumps(buses),
+            fetched_at=time.monotonic(),
+            version=previous.version + 1 if previous is not None else 1,
+            by_id=MappingProxyType(by_id),
+            changed=tuple(bus for bus_id, bus in by_id.items() if previous_by_id.get(bus_id) != bus),
+            removed=tuple(bus_id for bus_id in previous_by_id if bus_id not in by_id)
+        )
+        # Wake every stream waiting for this tick
+        updated, self._updated = self._updated, asyncio.Event()
+        updated.set()
+
+    async def wait_for_update(self, version: int, timeout: float) -> Optional[RealtimeSnapshot]:
+        """
+        Wait until a snapshot newer than version is published. Returns None on timeout, and like get_snapshot never
+        returns one older than max_staleness.
+        """
+        snapshot = self.get_snapshot()
+        if snapshot is not None and snapshot.version > version:
+            return snapshot
+        try:
+            await asyncio.wait_for(self._updated.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self.get_snapshot()
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.poll_once()
+            except Exception as e:
+                realtime_polls.labels("error").inc()
+                print(f"Realtime poll failed: {e}")
+            elapsed = time.monotonic() - started
+            await asyncio.sleep(max(0.0, self.interval - elapsed))
+
+    def get_snapshot(self) -> Optional[RealtimeSnapshot]:
+        """Return the latest snapshot, or None if there is none younger than max_staleness."""
+        snapshot = self._snapshot
+        if snapshot is None or time.monotonic() - snapshot.fetched_at > self.max_staleness:
+            return None
+        return snapshot
+
+
+realtime_poller = RealtimePoller(
+    db_manager=Manager,
+    gtfs_rt_url=settings.gtfs_realtime_url,
+    interval=settings.realtime_poll_interval,
+    max_staleness=settings.realtime_max_staleness,
+    overlay=delay_overlay,
+    mirror_predictions=settings.realtime_mirror_predictions
+)
@@ -0,0 +1,49 @@
+import gzip
+import hashlib
+from typing import NamedTuple
+
+from fastapi import Request
+from fastapi.responses import Response
+
+
+class CachedBody(NamedTuple):
+    """A response body encoded once, with its gzipped copy and a strong ETag."""
+    body: bytes
+    gzip_body: bytes
+    etag: str
+    media_type: str
+
+
+def json_array(items: list[bytes]) -> bytes:
+    """A JSON array of items that are each JSON already, so records encoded once are not encoded per request."""
+    return b"[" + b",".join(items) + b"]"
+
+
+def make_cached_body(body: bytes, media_type: str = "application/json") -> CachedBody:
+    digest = hashlib.sha1(body).hexdigest()
+    return CachedBody(
+        body=body,
+        gzip_body=gzip.compress(body, compresslevel=9, mtime=0),
+        etag=f'"{digest}"',
+        media_type=media_type
+    )
+
+
+def cached_response(request: Request, cached: CachedBody) -> Response:
+    """Answer with 304 if the client already has this body, otherwise with the (gzipped if accepted) bytes."""
+    gzip_etag = cached.etag[:-1] + '-gz"'
+    headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match:
+        client_etags = {tag.strip() for tag in if_none_match.split(",")}
+        if cached.etag in client_etags or gzip_etag in client_etags or "*" in client_etags:
+            headers["ETag"] = cached.etag
+            return Response(status_code=304, headers=headers)
+
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["ETag"] = gzip_etag
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=cached.gzip_body, media_type=cached.media_type, headers=headers)
+    headers["ETag"] = cached.etag
+    return Response(content=cached.body, media_type=cached.media_type, headers=headers)
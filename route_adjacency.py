@@ -0,0 +1,110 @@
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterable
+
+import orjson
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from responses import CachedBody, make_cached_body
+
+if TYPE_CHECKING:
+    from timetable_snapshot import TimetableSnapshot
+
+STOP_ROUTES_QUERY = text("""
+    SELECT sr.stop_id, r.route_id, r.route_short_name
+    FROM stop_routes sr
+    JOIN routes r ON r.route_id = sr.route_id
+    ORDER BY sr.stop_id, r.route_short_name, r.route_id;
+""")
+
+ROUTE_STOP_PATTERNS_QUERY = text("""
+    SELECT p.route_id, s.stop_id, s.stop_lat, s.stop_lon
+    FROM route_stop_patterns p
+    JOIN stops s ON s.stop_id = p.stop_id
+    ORDER BY p.route_id, p.direction_id, p.stop_order;
+""")
+
+EMPTY_LIST = make_cached_body(b"[]")
+
+
+@dataclass(frozen=True, slots=True)
+class StopRoute:
+    route_id: int
+    route_short_name: str
+
+
+@dataclass(frozen=True, slots=True)
+class RouteStop:
+    stop_id: int
+    stop_lat: float
+    stop_lon: float
+
+
+class RouteAdjacency:
+    def __init__(self, routes_by_stop: dict[int, list[StopRoute]], stops_by_route: dict[int, list[RouteStop]]):
+        """
+        routes_by_stop: stop_id -> routes calling there, one per route_short_name, ordered by it
+        stops_by_route: route_id -> its stops in order, the first direction followed by the other's new stops
+        """
+        self.routes_by_stop = routes_by_stop
+        self.stops_by_route = stops_by_route
+        # The lists never change for this dataset, so each is encoded on its first request and kept
+        self._routes_at_bodies: dict[int, CachedBody] = {}
+        self._stops_on_bodies: dict[int, CachedBody] = {}
+
+    @classmethod
+    async def load(cls, session: AsyncSession) -> "RouteAdjacency":
+        start = time.perf_counter()
+        adjacency = cls.from_rows(await session.execute(STOP_ROUTES_QUERY), await session.execute(ROUTE_STOP_PATTERNS_QUERY))
+        print(f"Route adjacency loaded: {len(adjacency.routes_by_stop)} stops, {len(adjacency.stops_by_route)} routes "
+              f"in {time.perf_counter() - start:.3f}s")
+        return adjacency
+
+    @classmethod
+    def from_snapshot(cls, snapshot: "TimetableSnapshot") -> "RouteAdjacency":
+        stop_routes = zip(snapshot.column("stop_routes.stop_id"), snapshot.column("stop_routes.route_id"),
+                          snapshot.strings("stop_routes.route_short_name"))
+        patterns = zip(snapshot.column("patterns.route_id"), snapshot.column("patterns.stop_id"),
+                       snapshot.column("patterns.stop_lat"), snapshot.column("patterns.stop_lon"))
+        return cls.from_rows(stop_routes, patterns)
+
+    @classmethod
+    def from_rows(cls, stop_routes: Iterable[tuple], route_stop_patterns: Iterable[tuple]) -> "RouteAdjacency":
+        """stop_routes and route_stop_patterns: rows of STOP_ROUTES_QUERY and ROUTE_STOP_PATTERNS_QUERY, in their order."""
+        routes_by_stop = {}
+        for stop_id, route_id, route_short_name in stop_routes:
+            routes = routes_by_stop.setdefault(stop_id, [])
+            # Same short name on several route_ids (one per direction or operator): the lowest id stands for all
+            if not routes or routes[-1].route_short_name != route_short_name:
+                routes.append(StopRoute(route_id, route_short_name))
+
+        stops_by_route = {}
+        seen = set()
+        for route_id, stop_id, stop_lat, stop_lon in route_stop_patterns:
+            if (route_id, stop_id) not in seen:
+                seen.add((route_id, stop_id))
+                stops_by_route.setdefault(route_id, []).append(RouteStop(stop_id, stop_lat, stop_lon))
+        return cls(routes_by_stop, stops_by_route)
+
+    def routes_at(self, stop_id: int) -> list[StopRoute]:
+        return self.routes_by_stop.get(stop_id, [])
+
+    def stops_on(self, route_id: int) -> list[RouteStop]:
+        return self.stops_by_route.get(route_id, [])
+
+    def routes_at_body(self, stop_id: int) -> CachedBody:
+        return self._body(self._routes_at_bodies, self.routes_by_stop, stop_id)
+
+    def stops_on_body(self, route_id: int) -> CachedBody:
+        return self._body(self._stops_on_bodies, self.stops_by_route, route_id)
+
+    @staticmethod
+    def _body(bodies: dict[int, CachedBody], lists: dict[int, list], key: int) -> CachedBody:
+        body = bodies.get(key)
+        if body is None:
+            if key not in lists:
+                # Unknown ids are not kept, so requests for made-up ones cannot grow the cache
+                return EMPTY_LIST
+            body = bodies[key] = make_cached_body(orjson.dumps(lists[key]))
+        return body
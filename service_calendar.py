@@ -0,0 +1,73 @@
+import time
+from datetime import date, timedelta
+from typing import TYPE_CHECKING
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+if TYPE_CHECKING:
+    from timetable_snapshot import TimetableSnapshot
+
+SERVICE_CALENDAR_QUERY = text("""
+    SELECT service_id, start_date, active_days
+    FROM service_calendar;
+""")
+
+SECONDS_PER_DAY = 86400
+# Service days a lookup at one moment has to look at, as (days from the current date, seconds to add to the clock):
+# yesterday's trips still run after midnight with times past 24:00:00, and a window ending after midnight reaches
+# into tomorrow's first trips
+SERVICE_DAY_OFFSETS = ((-1, SECONDS_PER_DAY), (0, 0), (1, -SECONDS_PER_DAY))
+# Dates whose set of active services is kept; lookups only ever ask for a few around today
+ACTIVE_SERVICES_CACHE_SIZE = 8
+
+
+class ServiceCalendar:
+    def __init__(self, services: dict[int, tuple[date, int]]):
+        """
+        services: service_id -> (start_date, bitmap), bit i of bitmap is set when the service runs start_date + i days
+        """
+        self.services = services
+        self._active: dict[date, frozenset[int]] = {}
+
+    @classmethod
+    async def load(cls, session: AsyncSession) -> "ServiceCalendar":
+        start = time.perf_counter()
+        services = {
+            service_id: (start_date, active_days.to_int("little"))
+            for service_id, start_date, active_days in await session.execute(SERVICE_CALENDAR_QUERY)
+        }
+        print(f"Service calendar loaded: {len(services)} services in {time.perf_counter() - start:.3f}s")
+        return cls(services)
+
+    @classmethod
+    def from_snapshot(cls, snapshot: "TimetableSnapshot") -> "ServiceCalendar":
+        services = {
+            service_id: (date.fromordinal(start_date), int.from_bytes(active_days, "little"))
+            for service_id, start_date, active_days in zip(
+                snapshot.column("calendar.service_id"), snapshot.column("calendar.start_date"),
+                snapshot.blobs("calendar.active_days"))
+        }
+        return cls(services)
+
+    def is_active(self, service_id: int, day: date) -> bool:
+        service = self.services.get(service_id)
+        if service is None:
+            return False
+        start_date, bitmap = service
+        offset = (day - start_date).days
+        return offset >= 0 and bool(bitmap >> offset & 1)
+
+    def active_services(self, day: date) -> frozenset[int]:
+        """service_ids running on day. Computed once per date, so moving to the next day is a dict lookup."""
+        active = self._active.get(day)
+        if active is None:
+            active = frozenset(service_id for service_id in self.services if self.is_active(service_id, day))
+            if len(self._active) >= ACTIVE_SERVICES_CACHE_SIZE:
+                self._active.clear()
+            self._active[day] = active
+        return active
+
+    def service_days(self, day: date) -> list[tuple[int, frozenset[int]]]:
+        """(seconds to add to a time of day, active services) for every service day a lookup on day has to cover."""
+        return [(shift, self.active_services(day + timedelta(days=days))) for days, shift in SERVICE_DAY_OFFSETS]
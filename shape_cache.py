@@ -0,0 +1,116 @@
+import asyncio
+import time
+from typing import TYPE_CHECKING, Optional
+
+import orjson
+import polyline
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from constants import SHAPE_SIMPLIFY_TOLERANCES
+from responses import CachedBody, make_cached_body
+
+if TYPE_CHECKING:
+    from timetable_snapshot import TimetableSnapshot
+
+# max_zoom a snapshot stores the full, unsimplified shape body under
+FULL_SHAPE = -1
+
+SHAPES_QUERY = text("""
+    SELECT shape_id, shape_pt_lat, shape_pt_lon
+    FROM shapes
+    ORDER BY shape_id, shape_pt_sequence;
+""")
+
+
+def _distance_to_segment(point, start, end) -> float:
+    """Distance in degrees from point to the segment start-end, treating lat/lon as planar."""
+    (y, x), (y1, x1), (y2, x2) = point, start, end
+    dx, dy = x2 - x1, y2 - y1
+    if dx == 0 and dy == 0:
+        return ((x - x1) ** 2 + (y - y1) ** 2) ** 0.5
+    t = max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / (dx * dx + dy * dy)))
+    return ((x - x1 - t * dx) ** 2 + (y - y1 - t * dy) ** 2) ** 0.5
+
+
+def simplify(points: list[tuple[float, float]], tolerance: float) -> list[tuple[float, float]]:
+    """Douglas-Peucker simplification, iterative so long shapes do not hit the recursion limit."""
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        max_distance = 0.0
+        index = first
+        for i in range(first + 1, last):
+            distance = _distance_to_segment(points[i], points[first], points[last])
+            if distance > max_distance:
+                max_distance = distance
+                index = i
+        if max_distance > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+async def load_shape_points(session: AsyncSession) -> dict[int, list[tuple[float, float]]]:
+    """route_id -> ordered (lat, lon) points of its shape."""
+    shapes = {}
+    for shape_id, lat, lon in await session.execute(SHAPES_QUERY):
+        shapes.setdefault(shape_id, []).append((lat, lon))
+    return shapes
+
+
+def encode_shape(route_id: int, points: list[tuple[float, float]]) -> CachedBody:
+    body = orjson.dumps({"route_id": route_id, "points": polyline.encode(points)})
+    return make_cached_body(body)
+
+
+class ShapeCache:
+    def __init__(self, shapes: dict[int, list[tuple[float, float]]], tolerances: list[tuple[int, float]] = SHAPE_SIMPLIFY_TOLERANCES):
+        """
+        shapes: route_id -> ordered (lat, lon) points
+        tolerances: (max_zoom, tolerance in degrees) pairs; zoom levels above the last one get the full shape
+        """
+        self.tolerances = sorted(tolerances)
+        self._full = {}
+        self._simplified = {}
+        for route_id, points in shapes.items():
+            self._full[route_id] = encode_shape(route_id, points)
+            for max_zoom, tolerance in self.tolerances:
+                self._simplified[(route_id, max_zoom)] = encode_shape(route_id, simplify(points, tolerance))
+
+    @classmethod
+    async def load(cls, session: AsyncSession, shapes: dict[int, list[tuple[float, float]]] = None) -> "ShapeCache":
+        start = time.perf_counter()
+        if shapes is None:
+            shapes = await load_shape_points(session)
+        # Simplifying every shape is CPU work, keep it off the event loop
+        cache = await asyncio.to_thread(cls, shapes)
+        print(f"Shape cache built: {len(shapes)} routes in {time.perf_counter() - start:.3f}s")
+        return cache
+
+    @classmethod
+    def from_snapshot(cls, snapshot: "TimetableSnapshot") -> "ShapeCache":
+        """The bodies encoded when the snapshot was written, served straight from its pages."""
+        cache = cls({})
+        for route_id, max_zoom, etag, body, gzip_body in zip(
+                snapshot.column("shape_bodies.route_id"), snapshot.column("shape_bodies.max_zoom"),
+                snapshot.strings("shape_bodies.etag"), snapshot.blobs("shape_bodies.body"),
+                snapshot.blobs("shape_bodies.gzip_body")):
+            cached = CachedBody(body=body, gzip_body=gzip_body, etag=etag, media_type="application/json")
+            if max_zoom == FULL_SHAPE:
+                cache._full[route_id] = cached
+            else:
+                cache._simplified[(route_id, max_zoom)] = cached
+        return cache
+
+    def get(self, route_id: int, zoom: Optional[int] = None) -> Optional[CachedBody]:
+        if zoom is not None:
+            for max_zoom, _ in self.tolerances:
+                if zoom <= max_zoom:
+                    return self._simplified.get((route_id, max_zoom))
+        return self._full.get(route_id)
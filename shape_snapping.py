@@ -0,0 +1,221 @@
+import asyncio
+import math
+import time
+from typing import TYPE_CHECKING, NamedTuple, Optional
+
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from crud import get_all_stops
+from shape_cache import load_shape_points
+from timetable import TimetableIndex
+
+if TYPE_CHECKING:
+    from timetable_snapshot import TimetableSnapshot
+
+METERS_PER_DEGREE = 111_320.0
+# Vehicles or stops further than this from their route's shape are not snapped
+MAX_SNAP_OFFSET = 150.0
+# Consecutive segments grouped under one bounding box, so most of a shape can be ruled out cheaply
+SEGMENTS_PER_BLOCK = 16
+
+
+class TripProgress(NamedTuple):
+    """A trip's calls with the distance of each stop along the route shape, in stop_sequence order."""
+    stop_sequences: np.ndarray
+    stop_ids: np.ndarray
+    arrival_times: np.ndarray
+    distances: np.ndarray
+
+
+class ShapeSnapper:
+    def __init__(self, shapes: dict[int, list[tuple[float, float]]], stops: dict[int, tuple[float, float]],
+                 timetable: TimetableIndex):
+        """
+        shapes: route_id -> ordered (lat, lon) points
+        stops: stop_id -> (lat, lon)
+        timetable: supplies the scheduled calls of every trip
+        """
+        # Equirectangular projection around the network's mean latitude: metres, accurate enough for an island
+        all_points = [point for points in shapes.values() for point in points]
+        mean_lat = sum(lat for lat, _ in all_points) / len(all_points) if all_points else 0.0
+        self._scale = np.array([METERS_PER_DEGREE, METERS_PER_DEGREE * math.cos(math.radians(mean_lat))])
+
+        # Every segment of every shape in flat arrays, grouped in blocks of SEGMENTS_PER_BLOCK with a bounding box.
+        # A route owns the blocks [first, first + count).
+        starts, vectors, cumulative = [], [], []
+        block_firsts, block_counts, block_boxes = [], [], []
+        self._ranges: dict[int, tuple[int, int]] = {}
+        self.route_lengths: dict[int, float] = {}
+        first_segment = 0
+        for route_id, points in shapes.items():
+            if len(points) < 2:
+                continue
+            xy = self._to_xy(np.asarray(points, dtype=np.float64))
+            segment_vectors = np.diff(xy, axis=0)
+            segment_lengths = np.hypot(segment_vectors[:, 0], segment_vectors[:, 1])
+            starts.append(xy[:-1])
+            vectors.append(segment_vectors)
+            cumulative.append(np.concatenate(([0.0], np.cumsum(segment_lengths)[:-1])))
+            self._ranges[route_id] = (len(block_firsts), -(-len(segment_vectors) // SEGMENTS_PER_BLOCK))
+            for block_start in range(0, len(segment_vectors), SEGMENTS_PER_BLOCK):
+                block_points = xy[block_start:block_start + SEGMENTS_PER_BLOCK + 1]
+                block_firsts.append(first_segment + block_start)
+                block_counts.append(len(block_points) - 1)
+                block_boxes.append((*block_points.min(axis=0), *block_points.max(axis=0)))
+            self.route_lengths[route_id] = float(segment_lengths.sum())
+            first_segment += len(segment_vectors)
+        self._block_firsts = np.array(block_firsts, dtype=np.intp)
+        self._block_counts = np.array(block_counts, dtype=np.intp)
+        boxes = np.array(block_boxes, dtype=np.float64).reshape(-1, 4)
+        self._box_min_x, self._box_min_y, self._box_max_x, self._box_max_y = (np.ascontiguousarray(column) for column in boxes.T)
+        # Kept as separate contiguous columns: gathering and combining 1-D arrays is much faster than (n, 2) rows
+        starts = np.concatenate(starts) if starts else np.empty((0, 2))
+        vectors = np.concatenate(vectors) if vectors else np.empty((0, 2))
+        self._start_x, self._start_y = np.ascontiguousarray(starts[:, 0]), np.ascontiguousarray(starts[:, 1])
+        self._vector_x, self._vector_y = np.ascontiguousarray(vectors[:, 0]), np.ascontiguousarray(vectors[:, 1])
+        self._cumulative = np.concatenate(cumulative) if cumulative else np.empty(0)
+        squared_lengths = self._vector_x ** 2 + self._vector_y ** 2
+        # Repeated shape points give zero-length segments; any factor works there since the dot product is 0 too
+        self._inverse_squared_lengths = 1.0 / np.where(squared_lengths > 0, squared_lengths, 1.0)
+        self._lengths = np.sqrt(squared_lengths)
+
+        self.trips = self._trip_progress(stops, timetable)
+
+    @classmethod
+    async def load(cls, session: AsyncSession, timetable: TimetableIndex,
+                   shapes: dict[int, list[tuple[float, float]]] = None) -> "ShapeSnapper":
+        start = time.perf_counter()
+        if shapes is None:
+            shapes = await load_shape_points(session)
+        stops = {stop["stop_id"]: (stop["stop_lat"], stop["stop_lon"]) for stop in await get_all_stops(session)}
+        snapper = await asyncio.to_thread(cls, shapes, stops, timetable)
+        print(f"Shape snapper built: {len(snapper._ranges)} shapes, {len(snapper.trips)} trips in {time.perf_counter() - start:.3f}s")
+        return snapper
+
+    @classmethod
+    async def from_snapshot(cls, snapshot: "TimetableSnapshot", timetable: TimetableIndex) -> "ShapeSnapper":
+        start = time.perf_counter()
+        stops = {stop["stop_id"]: (stop["stop_lat"], stop["stop_lon"]) for stop in snapshot.stops()}
+        snapper = await asyncio.to_thread(cls, snapshot.shape_points(), stops, timetable)
+        print(f"Shape snapper built: {len(snapper._ranges)} shapes, {len(snapper.trips)} trips in {time.perf_counter() - start:.3f}s")
+        return snapper
+
+    def _to_xy(self, lat_lon: np.ndarray) -> np.ndarray:
+        return lat_lon * self._scale
+
+    def project(self, route_ids: list[int], lat_lon: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Snap every point onto the shape of its route in one vectorized pass.
+        Returns (distance along the shape, distance from the shape) in metres; NaN for routes without a shape.
+        """
+        along = np.full(len(route_ids), np.nan)
+        offset = np.full(len(route_ids), np.nan)
+        known = np.array([i for i, route_id in enumerate(route_ids) if route_id in self._ranges], dtype=np.intp)
+        if not len(known):
+            return along, offset
+        firsts, counts = np.array([self._ranges[route_ids[i]] for i in known], dtype=np.intp).T
+        xy = self._to_xy(lat_lon[known])
+
+        # Pass 1, one row per (point, block of its route): the distance to a block's first vertex bounds the
+        # nearest distance from above, the distance to its bounding box bounds what the block can offer from below
+        blocks = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - firsts, counts)
+        owners = np.repeat(np.arange(len(known)), counts)
+        x, y = xy[owners, 0], xy[owners, 1]
+        segment_firsts = self._block_firsts[blocks]
+        upper = (x - self._start_x[segment_firsts]) ** 2 + (y - self._start_y[segment_firsts]) ** 2
+        upper = np.repeat(np.minimum.reduceat(upper, np.cumsum(counts) - counts), counts)
+        gap_x = np.maximum(np.maximum(self._box_min_x[blocks] - x, x - self._box_max_x[blocks]), 0.0)
+        gap_y = np.maximum(np.maximum(self._box_min_y[blocks] - y, y - self._box_max_y[blocks]), 0.0)
+        candidates = gap_x * gap_x + gap_y * gap_y <= upper
+        blocks, owners = blocks[candidates], owners[candidates]
+
+        # Pass 2, one row per (point, segment of a candidate block); rows stay grouped by point
+        counts = self._block_counts[blocks]
+        segments = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - self._block_firsts[blocks], counts)
+        owners = np.repeat(owners, counts)
+        group_starts = np.flatnonzero(np.concatenate(([True], owners[1:] != owners[:-1])))
+        counts = np.diff(np.append(group_starts, len(owners)))
+
+        dx = xy[owners, 0] - self._start_x[segments]
+        dy = xy[owners, 1] - self._start_y[segments]
+        vector_x = self._vector_x[segments]
+        vector_y = self._vector_y[segments]
+        t = (dx * vector_x + dy * vector_y) * self._inverse_squared_lengths[segments]
+        np.clip(t, 0.0, 1.0, out=t)
+        dx -= t * vector_x
+        dy -= t * vector_y
+        squared_distances = dx * dx + dy * dy
+
+        # Nearest segment per point: the first row of each group that reaches the group's minimum
+        minimums = np.minimum.reduceat(squared_distances, group_starts)
+        rows = np.flatnonzero(squared_distances == np.repeat(minimums, counts))
+        groups = owners[rows]
+        nearest = rows[np.concatenate(([True], groups[1:] != groups[:-1]))]
+
+        nearest_segments = segments[nearest]
+        along[known] = self._cumulative[nearest_segments] + t[nearest] * self._lengths[nearest_segments]
+        offset[known] = np.sqrt(minimums)
+        return along, offset
+
+    def _trip_progress(self, stops: dict[int, tuple[float, float]], timetable: TimetableIndex) -> dict[int, TripProgress]:
+        # Snap each (route, stop) pair once, however many trips share it
+        pairs = sorted({
+            (calls.route_id, stop_id)
+            for calls in timetable.trips.values()
+            for stop_id in calls.stop_ids
+            if stop_id in stops and calls.route_id in self._ranges
+        })
+        if not pairs:
+            return {}
+        along, offset = self.project([route_id for route_id, _ in pairs],
+                                     np.array([stops[stop_id] for _, stop_id in pairs]))
+        stop_distances = {pair: distance for pair, distance, off in zip(pairs, along, offset) if off <= MAX_SNAP_OFFSET}
+
+        trips = {}
+        for trip_id, calls in timetable.trips.items():
+            distances = np.array([stop_distances.get((calls.route_id, stop_id), np.nan) for stop_id in calls.stop_ids])
+            snapped = ~np.isnan(distances)
+            if snapped.sum() < 2:
+                continue
+            # A stop snapped onto an earlier part of a looping shape must not move the trip backwards
+            trips[trip_id] = TripProgress(
+                stop_sequences=np.asarray(calls.stop_sequences)[snapped],
+                stop_ids=np.asarray(calls.stop_ids)[snapped],
+                arrival_times=np.asarray(calls.arrival_times, dtype=np.float64)[snapped],
+                distances=np.maximum.accumulate(distances[snapped])
+            )
+        return trips
+
+    def snap(self, buses: list[dict]) -> np.ndarray:
+        """Distance of every bus along its route shape (NaN when it cannot be snapped); sets bus["progress"] in 0..1."""
+        if not buses:
+            return np.empty(0)
+        along, offset = self.project([bus["route_id"] for bus in buses],
+                                     np.array([(bus["lat"], bus["lon"]) for bus in buses], dtype=np.float64))
+        along[~(offset <= MAX_SNAP_OFFSET)] = np.nan
+        for bus, distance in zip(buses, along):
+            length = self.route_lengths.get(bus["route_id"])
+            bus["progress"] = None if np.isnan(distance) or not length else round(float(distance) / length, 3)
+        return along
+
+    def estimate_arrivals(self, buses: list[dict], along: np.ndarray, now_seconds: int,
+                          skip_trips: Optional[set[int]] = None) -> dict[tuple[int, int], tuple[int, int, int]]:
+        """
+        Predict the downstream stops of every snapped bus by shifting its schedule by its current delay,
+        where the delay compares now with the time the schedule passes the bus's position.
+        skip_trips: trips that already have predictions from the feed.
+        Returns (trip_id, stop_sequence) -> (stop_id, arrival, departure), like GTFSRealtimeParser.predictions.
+        """
+        predictions = {}
+        for bus, distance in zip(buses, along):
+            trip = self.trips.get(bus["id"])
+            if trip is None or np.isnan(distance) or (skip_trips and bus["id"] in skip_trips):
+                continue
+            delay = now_seconds - np.interp(distance, trip.distances, trip.arrival_times)
+            downstream = np.searchsorted(trip.distances, distance, side="right")
+            estimates = (trip.arrival_times[downstream:] + delay).round().astype(int).tolist()
+            for stop_sequence, stop_id, estimate in zip(trip.stop_sequences[downstream:].tolist(),
+                                                        trip.stop_ids[downstream:].tolist(), estimates):
+                predictions[(bus["id"], stop_sequence)] = (stop_id, estimate, estimate)
+        return predictions
@@ -1,4 +1,4 @@
-import { busMarkers, busMarkersLayer, busMarkersMap, busPathsLayer, map, BusStopIcon, BusIcon, currentBusPath, setCurrentBusPath } from './map_logic.js'
+import { busMarkers, busMarkersLayer, busMarkersMap, busPathsLayer, map, BusStopIcon, BusIcon, currentBusPath, setCurrentBusPath, visibleBBox } from './map_logic.js'
 
 export function updateBusMarkerVisibility() {
     var bounds = map.getBounds();
@@ -48,46 +48,57 @@ export function binarySearch(arr, target) {
     return false;
 }
 
-export function createOrUpdateBusMarkers(buses) {
-    const seenBusIds = [];
-
-    buses.forEach(bus => {
-        const latLng = [bus.lat, bus.lon];
-        const busId = bus.id;
-
-        seenBusIds.push(busId);  // Collect existing buses for sorting later
-        // console.log("Bus ID:", busId, "LatLng:", latLng);
-        if (busMarkersMap[busId]) {
-            // Update existing marker's position
-            const iconEl = busMarkersMap[busId].getElement();
-            if (iconEl) {
-                const inner = iconEl.querySelector('.bus-icon-inner');
-                if (inner) {
-                    inner.style.transform = `rotate(${bus.bearing}deg)`;
-                }
+function upsertBusMarker(bus) {
+    const latLng = [bus.lat, bus.lon];
+    const busId = bus.id;
+
+    // console.log("Bus ID:", busId, "LatLng:", latLng);
+    if (busMarkersMap[busId]) {
+        // Update existing marker's position
+        const iconEl = busMarkersMap[busId].getElement();
+        if (iconEl) {
+            const inner = iconEl.querySelector('.bus-icon-inner');
+            if (inner) {
+                inner.style.transform = `rotate(${bus.bearing}deg)`;
             }
-            smoothMoveMarker(busMarkersMap[busId], latLng);
-        } else {
-            // Create new marker
-            const marker = L.marker(latLng, { icon: BusIcon(bus.bearing) });
-
-            const tooltipContent = `<b>${bus.route_short_name}</b>`;
-            marker.bindTooltip(tooltipContent, { 
-                permanent: true, 
-                direction: 'top', 
-                className: 'bus-tooltip' // custom class
+        }
+        smoothMoveMarker(busMarkersMap[busId], latLng);
+    } else {
+        // Create new marker
+        const marker = L.marker(latLng, { icon: BusIcon(bus.bearing) });
+
+        const tooltipContent = `<b>${bus.route_short_name}</b>`;
+        marker.bindTooltip(tooltipContent, { 
+            permanent: true, 
+            direction: 'top', 
+            className: 'bus-tooltip' // custom class
+        });
+
+        marker.on('click', () => drawBusPath(bus.route_id));
+        marker.on('tooltipopen', () => {
+            marker.getTooltip().getElement().addEventListener('click', () => {
+                drawBusPath(bus.route_id);
             });
+        });
 
-            marker.on('click', () => drawBusPath(bus.route_id));
-            marker.on('tooltipopen', () => {
-                marker.getTooltip().getElement().addEventListener('click', () => {
-                    drawBusPath(bus.route_id);
-                });
-            });
+        marker.addTo(busMarkersLayer);
+        busMarkersMap[busId] = marker;
+    }
+}
 
-            marker.addTo(busMarkersLayer);
-            busMarkersMap[busId] = marker;
-        }
+function removeBusMarker(busId) {
+    if (busMarkersMap[busId]) {
+        busMarkersLayer.removeLayer(busMarkersMap[busId]);
+        delete busMarkersMap[busId];
+    }
+}
+
+export function createOrUpdateBusMarkers(buses) {
+    const seenBusIds = [];
+
+    buses.forEach(bus => {
+        seenBusIds.push(bus.id);  // Collect existing buses for sorting later
+        upsertBusMarker(bus);
     });
 
     // Sort the IDs to prepare for binary search
@@ -96,15 +107,71 @@ export function createOrUpdateBusMarkers(buses) {
     Object.keys(busMarkersMap).forEach(busId => {
         const numericBusId = Number(busId);
         if (!binarySearch(seenBusIds, numericBusId)) {
-            busMarkersLayer.removeLayer(busMarkersMap[busId]);
-            delete busMarkersMap[busId];
+            removeBusMarker(busId);
         }
     });
     // console.log("BusMarkerMap: ", busMarkersMap);
 }
 
+// Applies one delta event from /api/buses/stream
+export function applyBusDelta(delta) {
+    delta.changed.forEach(upsertBusMarker);
+    delta.removed.forEach(removeBusMarker);
+}
+
 
 
+// Decodes a Google encoded polyline (precision 5) into [[lat, lon], ...]
+export function decodePolyline(encoded) {
+    const points = [];
+    let index = 0, lat = 0, lng = 0;
+    while (index < encoded.length) {
+        let shift = 0, result = 0, byte;
+        do {
+            byte = encoded.charCodeAt(index++) - 63;
+            result |= (byte & 0x1f) << shift;
+            shift += 5;
+        } while (byte >= 0x20);
+        lat += (result & 1) ? ~(result >> 1) : (result >> 1);
+
+        shift = 0;
+        result = 0;
+        do {
+            byte = encoded.charCodeAt(index++) - 63;
+            result |= (byte & 0x1f) << shift;
+            shift += 5;
+        } while (byte >= 0x20);
+        lng += (result & 1) ? ~(result >> 1) : (result >> 1);
+
+        points.push([lat / 1e5, lng / 1e5]);
+    }
+    return points;
+}
+
+// The route's shape simplified for the current zoom, as [[lat, lon], ...]
+function fetchShape(route_id) {
+    return fetch(`/api/get_shape/${route_id}?zoom=${map.getZoom()}`)
+        .then(response => response.json())
+        // The shape arrives as an encoded polyline
+        .then(shape => decodePolyline(shape.points));
+}
+
+// Swaps the drawn path for the shape simplified for the new zoom, keeping its stops
+export function refreshBusPathShape() {
+    const path = currentBusPath;
+    if (!path) {
+        return;
+    }
+    fetchShape(path.routeId)
+        .then(latLngs => {
+            // Skip if the path was removed or replaced meanwhile
+            if (currentBusPath === path && latLngs.length) {
+                path.setLatLngs(latLngs);
+            }
+        })
+        .catch(error => console.error('Error fetching shape points:', error));
+}
+
 export function drawBusPath(route_id) {
     console.log("Before clearing, busPathsLayer has:", busPathsLayer.getLayers().length, "layers");
     busPathsLayer.clearLayers();
@@ -112,17 +179,15 @@ export function drawBusPath(route_id) {
     console.log("After clearing, busPathsLayer has:", busPathsLayer.getLayers().length, "layers");
     console.log("Drawing bus path for route:", route_id);
     // Fetch the bus route shape points
-    fetch(`/api/get_shape/${route_id}`)
-        .then(response => response.json())
-        .then(shapePoints => {
-            if (!shapePoints.length) {
+    fetchShape(route_id)
+        .then(latLngs => {
+            if (!latLngs.length) {
                 console.warn("No shape points returned for route:", route_id);
                 return;
             }
-            // Convert shape points into an array of latLng arrays
-            var latLngs = shapePoints.map(point => [point.lat, point.lon]);
             // Draw the polyline for the bus route
             var polyline = L.polyline(latLngs, { color: 'green' }).addTo(busPathsLayer);
+            polyline.routeId = route_id;
             setCurrentBusPath(polyline);
             console.log("Bus path drawn. Current bus path:", currentBusPath);
             map.fitBounds(polyline.getBounds());
@@ -153,6 +218,27 @@ export function drawBusPath(route_id) {
 }
 
 
+let busStream = null;
+
+// Subscribes to bus positions for the visible area: a snapshot first, then only the buses that changed
+export function streamBuses() {
+    if (!window.EventSource) {
+        refreshBuses();
+        return;
+    }
+    if (busStream) {
+        busStream.close();
+    }
+    busStream = new EventSource(`/api/buses/stream?bbox=${visibleBBox()}`);
+    busStream.addEventListener('snapshot', event => {
+        buses = JSON.parse(event.data);
+        createOrUpdateBusMarkers(buses);
+    });
+    busStream.addEventListener('delta', event => {
+        applyBusDelta(JSON.parse(event.data));
+    });
+}
+
 export function refreshBuses() {
     setInterval(() => {
         fetch('/api/get_buses')
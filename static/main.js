@@ -2,8 +2,8 @@
 
 import { map, busPathsLayer, currentBusPath, setCurrentBusPath, restoreMapState, saveMapState, initMap, showMyLocation } from './map_logic.js'; // Import map and layers
 
-import { updateStopMarkers, createStopMarkers, fetchStopDetails } from './stops.js';
-import { createOrUpdateBusMarkers, updateBusMarkerVisibility, refreshBuses } from './buses.js';
+import { updateStopMarkers, fetchStopDetails } from './stops.js';
+import { createOrUpdateBusMarkers, updateBusMarkerVisibility, streamBuses, refreshBusPathShape } from './buses.js';
 import { initRouteMaking } from './route_making.js';
 
 // Call initMap when the page loads
@@ -27,24 +27,20 @@ document.getElementById('show-location-btn').addEventListener('click', function(
 });
 
 // Initial marker updates
-createStopMarkers();  
-fetch('/api/get_buses')
-  .then(response => response.json())
-  .then(data => {
-      buses = data;
-      createOrUpdateBusMarkers(buses); // Update locations but not visibility logic
-});
+updateStopMarkers();
 updateBusMarkerVisibility();
 
 // Attach zoom & move event listeners
 map.on('moveend', updateBusMarkerVisibility);
 map.on('zoomend', updateBusMarkerVisibility);
+// A drawn bus path is refetched at the detail of the new zoom
+map.on('zoomend', refreshBusPathShape);
 
 window.addEventListener('beforeunload', saveMapState);
 
-// Update markers when the map is moved or zoomed
+// Fetch the stops for the new view when the map is moved or zoomed (zooming also fires moveend)
 map.on('moveend', updateStopMarkers);
-map.on('zoomend', updateStopMarkers);
 
-// Refreshes buses every 8 seconds
-refreshBuses();
+// Bus positions are pushed by the server; resubscribe when the visible area changes
+streamBuses();
+map.on('moveend', streamBuses);
@@ -1,15 +1,21 @@
 export var map;
 
-export var stopMarkersLayer, busMarkersLayer, busPathsLayer;
+export var stopMarkersLayer, stopClustersLayer, busMarkersLayer, busPathsLayer;
 var userLocationMarker; // Start with an empty marke
 export var busMarkers = []; // Store all bus markers
-export var stopMarkers = []; // Store all stop markers
+export const stopMarkers = {}; // Stop markers currently on the map, by stop_id
 export var currentBusPath = null; // Reference to the current bus path
 export const busMarkersMap = {}; 
 export function setCurrentBusPath(path) {
     currentBusPath = path;
 }
 
+// "min_lon,min_lat,max_lon,max_lat" of the map view, padded so markers just outside the screen are already there when the map is panned
+export function visibleBBox() {
+    const bounds = map.getBounds().pad(0.2);
+    return [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()].join(',');
+}
+
 
 
 export var BusStopIcon = L.icon({
@@ -42,6 +48,7 @@ function initMap() {
 
     // Initialize layers
     stopMarkersLayer = L.layerGroup().addTo(map); // Layer for bus stops
+    stopClustersLayer = L.layerGroup().addTo(map); // Layer for stop clusters at low zoom
     busMarkersLayer = L.layerGroup().addTo(map);  // Layer for buses
     busPathsLayer = L.layerGroup().addTo(map);    // Layer for bus paths
 
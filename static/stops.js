@@ -1,83 +1,118 @@
-import { stopMarkersLayer, map, BusStopIcon, BusIcon, stopMarkers } from './map_logic.js'
-export function updateStopMarkers() {
-    const bounds = map.getBounds();
-    const currentZoom = map.getZoom();
-    const minZoomToShowMarkers = 16;
+import { stopMarkersLayer, stopClustersLayer, map, BusStopIcon, stopMarkers, visibleBBox } from './map_logic.js'
 
-    let openPopupMarker = null;
+let stopsRequest = null;
 
-    // Find the currently open popup marker, if any
-    stopMarkers.forEach(marker => {
-        if (marker.isPopupOpen && marker.isPopupOpen()) {
-            openPopupMarker = marker;
-        }
-    });
+// Fetches the stops (or, zoomed out, clusters of stops) for the visible area and redraws them
+export function updateStopMarkers() {
+    if (stopsRequest) {
+        stopsRequest.abort();
+    }
+    stopsRequest = new AbortController();
 
-    stopMarkers.forEach(marker => {
-        const latLng = marker.getLatLng();
-        const shouldBeVisible = currentZoom >= minZoomToShowMarkers && bounds.contains(latLng);
+    fetch(`/api/stops?bbox=${visibleBBox()}&zoom=${map.getZoom()}`, { signal: stopsRequest.signal })
+        .then(response => response.json())
+        .then(data => {
+            const visible = new Set();
+            data.stops.forEach(stop => {
+                visible.add(String(stop.stop_id));
+                if (!stopMarkers[stop.stop_id]) {
+                    stopMarkers[stop.stop_id] = createStopMarker(stop).addTo(stopMarkersLayer);
+                }
+            });
 
-        if (shouldBeVisible || marker === openPopupMarker) {
-            marker.addTo(stopMarkersLayer);
-        } else  {
-            marker.remove();
-        }
-    });
+            // Drop markers that left the view, but never the one whose popup is open
+            Object.keys(stopMarkers).forEach(stop_id => {
+                const marker = stopMarkers[stop_id];
+                if (!visible.has(stop_id) && !marker.isPopupOpen()) {
+                    marker.remove();
+                    delete stopMarkers[stop_id];
+                }
+            });
+
+            stopClustersLayer.clearLayers();
+            data.clusters.forEach(cluster => {
+                L.marker([cluster.lat, cluster.lon], {
+                    icon: L.divIcon({
+                        className: 'stop-cluster',
+                        html: `<div>${cluster.count}</div>`,
+                        iconSize: [28, 28],
+                        iconAnchor: [14, 14]
+                    })
+                })
+                    .on('click', () => map.setView([cluster.lat, cluster.lon], map.getZoom() + 2))
+                    .addTo(stopClustersLayer);
+            });
+        })
+        .catch(error => {
+            if (error.name !== 'AbortError') {
+                console.error('Error fetching stops:', error);
+            }
+        });
 }
-export function createStopMarkers() {
-    stops.forEach(stop => {
-        const latLng = [stop.stop_lat, stop.stop_lon];
-        const marker = L.marker(latLng, { icon: BusStopIcon });
-
-        // Bind the popup with a function that generates the content on the fly
-        marker.bindPopup(() => {
-            return `
-                <div class="stop-popup">
-                    <div class="stop-header">
-                        <div>
-                            <div class="stop-name">${stop.stop_name}</div>
-                            <div class="stop-id">#${stop.stop_id}</div>
-                        </div>
-                        <button class="refresh-btn" onclick="window.refreshStopDetails('${stop.stop_id}')" title="Refresh">🔄</button>
+
+function createStopMarker(stop) {
+    const marker = L.marker([stop.stop_lat, stop.stop_lon], { icon: BusStopIcon });
+
+    // Bind the popup with a function that generates the content on the fly
+    marker.bindPopup(() => {
+        return `
+            <div class="stop-popup">
+                <div class="stop-header">
+                    <div>
+                        <div class="stop-name">${stop.stop_name}</div>
+                        <div class="stop-id">#${stop.stop_id}</div>
                     </div>
-                    <div id="route-list-${stop.stop_id}" class="route-list"><i>Fetching routes...</i></div>
-                    <div id="stop-details-container-${stop.stop_id}" class="stop-details"><b>Loading upcoming arrivals...</b></div>
+                    <button class="refresh-btn" onclick="window.refreshStopDetails('${stop.stop_id}')" title="Refresh">🔄</button>
                 </div>
-            `;
-        });
+                <div id="route-list-${stop.stop_id}" class="route-list"><i>Fetching routes...</i></div>
+                <div id="stop-details-container-${stop.stop_id}" class="stop-details"><b>Loading upcoming arrivals...</b></div>
+            </div>
+        `;
+    });
 
-        // When the popup is opened, update its dynamic content
-        marker.on('popupopen', () => {
-            fetch(`/stops/routes_stopping_at/${stop.stop_id}`)
-                .then(response => response.json())
-                .then(routes => {
-                    const container = document.getElementById(`route-list-${stop.stop_id}`);
-                    if (container) {
-                        const names = routes.map(r => r.route_short_name);
-                        container.innerHTML = routes.length
-                            ? `<b>Routes:</b> ${names.join(' | ')}`
-                            : `<b>No route data available for this stop.</b>`;
-                    }
-                })
-                .catch(err => {
-                    console.error("Error fetching routes:", err);
-                    const container = document.getElementById(`route-list-${stop.stop_id}`);
-                    if (container) {
-                        container.innerHTML = "Error loading routes.";
-                    }
-                });
+    // When the popup is opened, update its dynamic content
+    marker.on('popupopen', () => {
+        fetch(`/stops/routes_stopping_at/${stop.stop_id}`)
+            .then(response => response.json())
+            .then(routes => {
+                const container = document.getElementById(`route-list-${stop.stop_id}`);
+                if (container) {
+                    const names = routes.map(r => r.route_short_name);
+                    container.innerHTML = routes.length
+                        ? `<b>Routes:</b> ${names.join(' | ')}`
+                        : `<b>No route data available for this stop.</b>`;
+                }
+            })
+            .catch(err => {
+                console.error("Error fetching routes:", err);
+                const container = document.getElementById(`route-list-${stop.stop_id}`);
+                if (container) {
+                    container.innerHTML = "Error loading routes.";
+                }
+            });
 
-            fetchStopDetails(stop.stop_id);
-        });
-
-        stopMarkers.push(marker);
+        fetchStopDetails(stop.stop_id);
     });
 
-    updateStopMarkers(); // Maintain marker visibility
+    return marker;
 }
 
 
 
+// "(scheduled 12 min)" when the realtime estimate differs from the timetable, "(live)" for unscheduled trips
+function delayLabel(route) {
+    if (route.estimated_arrival_time === null || route.estimated_arrival_time === undefined) {
+        return '';
+    }
+    if (route.scheduled_arrival_time === null) {
+        return ' <span class="route-scheduled">(live)</span>';
+    }
+    if (route.scheduled_arrival_time !== route.estimated_arrival_time) {
+        return ` <span class="route-scheduled">(scheduled ${route.scheduled_arrival_time} min)</span>`;
+    }
+    return '';
+}
+
 export function fetchStopDetails(stop_id) {
     const popupElement = document.querySelector(`#stop-details-container-${stop_id}`);
     if (!popupElement) return;
@@ -93,7 +128,7 @@ export function fetchStopDetails(stop_id) {
                         <div class="arrival-item">
                             <span class="route-code">${route.route_short_name}</span>
                             <span class="route-desc">${route.route_long_name}</span>
-                            <span class="route-time">${route.arrival_time} min</span>
+                            <span class="route-time">${route.arrival_time} min${delayLabel(route)}</span>
                         </div>
                     `;
                 });
@@ -0,0 +1,109 @@
+import math
+import time
+from typing import TYPE_CHECKING, NamedTuple, Optional
+
+import orjson
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from crud import get_all_stops
+from geo import BBox
+from constants import STOP_GRID_CELL_SIZE, STOP_MIN_ZOOM, STOP_CLUSTER_MIN_ZOOM, STOP_CLUSTER_PIXELS
+from responses import json_array
+
+if TYPE_CHECKING:
+    from timetable_snapshot import TimetableSnapshot
+
+
+def cluster_cell_size(zoom: int) -> float:
+    """Degrees covered by STOP_CLUSTER_PIXELS screen pixels at the given web-mercator zoom."""
+    return STOP_CLUSTER_PIXELS * 360.0 / (256 * 2 ** zoom)
+
+
+class UniformGrid:
+    """Buckets items by (lat, lon) into square cells of cell_size degrees."""
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.cells: dict[tuple[int, int], list] = {}
+
+    def cell_of(self, lat: float, lon: float) -> tuple[int, int]:
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def add(self, lat: float, lon: float, item):
+        self.cells.setdefault(self.cell_of(lat, lon), []).append(item)
+
+    def cells_in(self, bbox: BBox):
+        min_lon, min_lat, max_lon, max_lat = bbox
+        low_row, low_col = self.cell_of(min_lat, min_lon)
+        high_row, high_col = self.cell_of(max_lat, max_lon)
+        if (high_row - low_row + 1) * (high_col - low_col + 1) > len(self.cells):
+            # The bbox covers more cells than exist, walking the occupied ones is cheaper
+            for (row, col), items in self.cells.items():
+                if low_row <= row <= high_row and low_col <= col <= high_col:
+                    yield items
+            return
+        for row in range(low_row, high_row + 1):
+            for col in range(low_col, high_col + 1):
+                items = self.cells.get((row, col))
+                if items:
+                    yield items
+
+
+class EncodedPoint(NamedTuple):
+    """A stop or cluster in the grid with its JSON, encoded once when the index is built."""
+    lat: float
+    lon: float
+    body: bytes
+
+
+class StopGridIndex:
+    def __init__(self, stops: list[dict]):
+        self.stops = UniformGrid(STOP_GRID_CELL_SIZE)
+        for stop in stops:
+            self.stops.add(stop["stop_lat"], stop["stop_lon"],
+                           EncodedPoint(stop["stop_lat"], stop["stop_lon"], orjson.dumps(stop)))
+
+        # One grid of precomputed clusters per zoom level that is too far out to show single stops
+        self.clusters: dict[int, UniformGrid] = {}
+        for zoom in range(STOP_CLUSTER_MIN_ZOOM, STOP_MIN_ZOOM):
+            sums = {}
+            grid = UniformGrid(cluster_cell_size(zoom))
+            for stop in stops:
+                cell = grid.cell_of(stop["stop_lat"], stop["stop_lon"])
+                count, lat_sum, lon_sum = sums.get(cell, (0, 0.0, 0.0))
+                sums[cell] = (count + 1, lat_sum + stop["stop_lat"], lon_sum + stop["stop_lon"])
+            for count, lat_sum, lon_sum in sums.values():
+                lat, lon = lat_sum / count, lon_sum / count
+                grid.add(lat, lon, EncodedPoint(lat, lon, orjson.dumps({"lat": lat, "lon": lon, "count": count})))
+            self.clusters[zoom] = grid
+
+    @classmethod
+    async def load(cls, session: AsyncSession) -> "StopGridIndex":
+        start = time.perf_counter()
+        stops = await get_all_stops(session)
+        index = cls(stops)
+        print(f"Stop grid index built: {len(stops)} stops in {time.perf_counter() - start:.3f}s")
+        return index
+
+    @classmethod
+    def from_snapshot(cls, snapshot: "TimetableSnapshot") -> "StopGridIndex":
+        return cls(snapshot.stops())
+
+    def query(self, bbox: BBox, zoom: Optional[int] = None) -> bytes:
+        """Stops inside bbox, or clusters of them when zoom is below STOP_MIN_ZOOM, as a JSON body."""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        if zoom is not None and zoom < STOP_MIN_ZOOM:
+            grid = self.clusters[max(zoom, STOP_CLUSTER_MIN_ZOOM)]
+            clusters = [
+                cluster.body
+                for cell in grid.cells_in(bbox)
+                for cluster in cell
+                if min_lat <= cluster.lat <= max_lat and min_lon <= cluster.lon <= max_lon
+            ]
+            return b'{"stops":[],"clusters":' + json_array(clusters) + b"}"
+        stops = [
+            stop.body
+            for cell in self.stops.cells_in(bbox)
+            for stop in cell
+            if min_lat <= stop.lat <= max_lat and min_lon <= stop.lon <= max_lon
+        ]
+        return b'{"stops":' + json_array(stops) + b',"clusters":[]}'
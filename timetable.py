@@ -0,0 +1,197 @@
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import TYPE_CHECKING, Mapping, NamedTuple, Optional, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from constants import CYPRUS_TZ
+from delay_overlay import DelayOverlay
+from service_calendar import ServiceCalendar
+
+if TYPE_CHECKING:
+    from timetable_snapshot import TimetableSnapshot
+
+# How far a realtime prediction may move a trip away from its schedule and still be found
+REALTIME_DELAY_MARGIN = 1800
+
+TIMETABLE_QUERY = text("""
+    SELECT st.stop_id, st.arrival_time, st.departure_time, st.stop_sequence, st.trip_id, t.route_id, t.service_id
+    FROM stop_times st
+    JOIN trips t ON t.trip_id = st.trip_id
+    ORDER BY st.stop_id, st.arrival_time;
+""")
+
+ROUTE_NAMES_QUERY = text("""
+    SELECT route_id, route_short_name, route_long_name
+    FROM routes;
+""")
+
+
+def seconds_since_midnight(now: datetime = None) -> int:
+    if now is None:
+        now = datetime.now(CYPRUS_TZ)
+    return now.hour * 3600 + now.minute * 60 + now.second
+
+
+class StopDepartures(NamedTuple):
+    """
+    Parallel arrays of every scheduled call at one stop, on any service day, sorted by arrival time.
+    Loaded from the database they are arrays, from a snapshot memoryviews of its columns.
+    """
+    arrival_times: Sequence[int]
+    stop_sequences: Sequence[int]
+    trip_ids: Sequence[int]
+    route_ids: Sequence[int]
+    service_ids: Sequence[int]
+
+
+@dataclass(frozen=True, slots=True)
+class Departure:
+    """One arrival answered by next_departures; times are in minutes from now."""
+    arrival_time: int
+    scheduled_arrival_time: Optional[int]
+    estimated_arrival_time: Optional[int]
+    route_id: int
+    route_short_name: str
+    route_long_name: str
+    trip_id: int
+
+
+class TripCalls(NamedTuple):
+    """Parallel arrays of the stops one trip calls at, in stop_sequence order."""
+    route_id: int
+    service_id: int
+    stop_sequences: Sequence[int]
+    stop_ids: Sequence[int]
+    arrival_times: Sequence[int]
+    departure_times: Sequence[int]
+
+
+class TimetableIndex:
+    def __init__(self, departures: Mapping[int, StopDepartures], route_names: dict[int, tuple[str, str]],
+                 trips: Mapping[int, TripCalls] = None, calendar: ServiceCalendar = None):
+        """
+        departures: stop_id -> StopDepartures
+        route_names: route_id -> (route_short_name, last part of route_long_name), interned
+        trips: trip_id -> TripCalls
+        calendar: which services run on which date; without it every trip is taken to run every day
+        """
+        self.departures = departures
+        self.route_names = route_names
+        self.trips = trips if trips is not None else {}
+        self.calendar = calendar
+
+    @classmethod
+    async def load(cls, session: AsyncSession) -> "TimetableIndex":
+        start = time.perf_counter()
+        calendar = await ServiceCalendar.load(session)
+        route_names = {}
+        for route_id, short_name, long_name in await session.execute(ROUTE_NAMES_QUERY):
+            route_names[route_id] = (sys.intern(short_name), sys.intern(long_name.split(" - ")[-1]))
+
+        departures = {}
+        calls = {}
+        current_stop = None
+        columns = None
+        rows = 0
+        for stop_id, arrival_time, departure_time, stop_sequence, trip_id, route_id, service_id in await session.execute(TIMETABLE_QUERY):
+            if stop_id != current_stop:
+                current_stop = stop_id
+                columns = StopDepartures(array('i'), array('i'), array('q'), array('q'), array('i'))
+                departures[stop_id] = columns
+            columns.arrival_times.append(arrival_time)
+            columns.stop_sequences.append(stop_sequence)
+            columns.trip_ids.append(trip_id)
+            columns.route_ids.append(route_id)
+            columns.service_ids.append(service_id)
+            calls.setdefault(trip_id, (route_id, service_id, []))[2].append((stop_sequence, stop_id, arrival_time, departure_time))
+            rows += 1
+
+        trips = {}
+        for trip_id, (route_id, service_id, trip_calls) in calls.items():
+            trip_calls.sort()
+            trips[trip_id] = TripCalls(
+                route_id,
+                service_id,
+                array('i', (stop_sequence for stop_sequence, _, _, _ in trip_calls)),
+                array('q', (stop_id for _, stop_id, _, _ in trip_calls)),
+                array('i', (arrival_time for _, _, arrival_time, _ in trip_calls)),
+                array('i', (departure_time for _, _, _, departure_time in trip_calls))
+            )
+        print(f"Timetable index built: {rows} stop times at {len(departures)} stops in {time.perf_counter() - start:.3f}s")
+        return cls(departures, route_names, trips, calendar)
+
+    @classmethod
+    def from_snapshot(cls, snapshot: "TimetableSnapshot") -> "TimetableIndex":
+        """The same index over the snapshot's columns; the calls of a stop or trip are looked up when asked for."""
+        route_names = {
+            route_id: (sys.intern(short_name), sys.intern(long_name.split(" - ")[-1]))
+            for route_id, short_name, long_name in zip(
+                snapshot.column("routes.route_id"), snapshot.strings("routes.route_short_name"),
+                snapshot.strings("routes.route_long_name"))
+        }
+        return cls(
+            departures=snapshot.call_table("departures", "stop_id", StopDepartures),
+            route_names=route_names,
+            trips=snapshot.call_table("trips", "trip_id", TripCalls, scalars=2),
+            calendar=ServiceCalendar.from_snapshot(snapshot)
+        )
+
+    def next_departures(self, stop_id: int, now_seconds: int, range_within: int = 3600,
+                        overlay: Optional[DelayOverlay] = None, service_date: date = None) -> list[Departure]:
+        """
+        Arrivals at the stop within range_within seconds of now_seconds on service_date (default today), soonest first.
+        Trips of the previous day still running after midnight and of the next day once the window passes midnight are included.
+        overlay supplies realtime predictions, which are reported next to the scheduled times and decide the order.
+        """
+        columns = self.departures.get(stop_id)
+        end_seconds = now_seconds + range_within
+        margin = REALTIME_DELAY_MARGIN if overlay else 0
+        if self.calendar is None:
+            service_days = [(0, None)]
+        else:
+            if service_date is None:
+                service_date = datetime.now(CYPRUS_TZ).date()
+            service_days = self.calendar.service_days(service_date)
+
+        arrivals = []
+        if columns is not None:
+            # shift moves the clock of this lookup onto the clock of the service day, whose times can pass 24:00:00
+            for shift, active_services in service_days:
+                low = bisect_left(columns.arrival_times, now_seconds + shift - margin)
+                high = bisect_right(columns.arrival_times, end_seconds + shift + margin)
+                for i in range(low, high):
+                    if active_services is not None and columns.service_ids[i] not in active_services:
+                        continue
+                    trip_id = columns.trip_ids[i]
+                    scheduled_time = columns.arrival_times[i] - shift
+                    prediction = overlay.get(trip_id, columns.stop_sequences[i]) if overlay else None
+                    estimated_time = prediction.arrival_time if prediction is not None else None
+                    arrival_time = scheduled_time if estimated_time is None else estimated_time
+                    if now_seconds <= arrival_time <= end_seconds:
+                        arrivals.append((arrival_time, columns.route_ids[i], trip_id, scheduled_time, estimated_time))
+        if overlay:
+            # ADDED trips only exist in the realtime feed
+            for trip_id, prediction in overlay.added_at_stop(stop_id):
+                if now_seconds <= prediction.arrival_time <= end_seconds:
+                    arrivals.append((prediction.arrival_time, prediction.route_id, trip_id, None, prediction.arrival_time))
+        arrivals.sort(key=lambda arrival: arrival[0])
+
+        departures = []
+        for arrival_time, route_id, trip_id, scheduled_time, estimated_time in arrivals:
+            route_short_name, route_long_name = self.route_names.get(route_id, ("", ""))
+            departures.append(Departure(
+                arrival_time=round((arrival_time - now_seconds) / 60),
+                scheduled_arrival_time=None if scheduled_time is None else round((scheduled_time - now_seconds) / 60),
+                estimated_arrival_time=None if estimated_time is None else round((estimated_time - now_seconds) / 60),
+                route_id=route_id,
+                route_short_name=route_short_name,
+                route_long_name=route_long_name,
+                trip_id=trip_id
+            ))
+        return departures
@@ -0,0 +1,331 @@
+import asyncio
+import glob
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from bisect import bisect_left
+from collections.abc import Mapping
+from typing import BinaryIO, Optional
+
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from constants import SHAPE_SIMPLIFY_TOLERANCES
+from crud import get_all_stops
+from route_adjacency import ROUTE_STOP_PATTERNS_QUERY, STOP_ROUTES_QUERY
+from service_calendar import SERVICE_CALENDAR_QUERY
+from shape_cache import FULL_SHAPE, ShapeCache, load_shape_points
+from timetable import ROUTE_NAMES_QUERY, TIMETABLE_QUERY
+
+MAGIC = b"GTFSSNAP"
+# Bumped whenever the columns below change, so files of an older layout are rebuilt rather than misread
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+FILE_PATTERN = "timetable-{version}.snap"
+
+MANIFEST_QUERY = text("""
+    SELECT feed_id, file_hashes
+    FROM gtfs_manifest
+    ORDER BY feed_id;
+""")
+
+# numpy dtype -> memoryview format, the same typecodes as the array('i') / array('q') columns built from the database
+FORMATS = {"int32": "i", "int64": "q", "float64": "d", "uint8": "B"}
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _data_offset(header_length: int) -> int:
+    """The columns start at the first aligned offset after the magic, the header length and the header."""
+    return _aligned(len(MAGIC) + 4 + header_length)
+
+
+def _encode_strings(values: list[bytes]) -> tuple[np.ndarray, np.ndarray]:
+    """A string table: offsets (one more than values) into the concatenated bytes."""
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in values], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(values), dtype=np.uint8)
+
+
+def _groups(keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """The distinct keys of a sorted column and the offsets of their runs, one more than keys."""
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1]))) if len(keys) else np.empty(0, dtype=np.intp)
+    return keys[starts], np.append(starts, len(keys)).astype(np.int64)
+
+
+async def dataset_version(session: AsyncSession) -> Optional[str]:
+    """
+    Hash of the live dataset's feed manifest, the snapshot layout and what is precomputed into it.
+    None when the dataset was loaded without a manifest, and so has nothing to tell its versions apart.
+    """
+    try:
+        rows = (await session.execute(MANIFEST_QUERY)).all()
+    except DBAPIError:
+        await session.rollback()
+        return None
+    if not rows:
+        return None
+    key = json.dumps([FORMAT_VERSION, SHAPE_SIMPLIFY_TOLERANCES, [list(row) for row in rows]])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+class CallTable(Mapping):
+    def __init__(self, keys: memoryview, offsets: memoryview, row_type: type, scalars: list[memoryview],
+                 columns: list[memoryview]):
+        """
+        Read-only key -> row_type mapping over grouped snapshot columns, built per lookup, so the calls of every
+        stop or trip stay in the shared pages instead of one Python object per stop or trip in every worker.
+        keys: the sorted group keys; offsets: start of every group in columns, one more than keys
+        scalars: one value per group, the first fields of row_type; columns: sliced per group, the remaining fields
+        """
+        self._keys = keys
+        self._offsets = offsets
+        self._row_type = row_type
+        self._scalars = scalars
+        self._columns = columns
+
+    def __getitem__(self, key):
+        i = bisect_left(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            raise KeyError(key)
+        low, high = self._offsets[i], self._offsets[i + 1]
+        return self._row_type(*(scalar[i] for scalar in self._scalars), *(column[low:high] for column in self._columns))
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+class TimetableSnapshot:
+    def __init__(self, buffer, header: dict, path: Optional[str] = None):
+        """
+        Columnar copy of the static data the app keeps in memory: stops, routes, service calendar, stop_times by
+        stop and by trip, shapes, route adjacency and the encoded shape bodies. Fixed-width columns and string
+        tables at aligned offsets of one file, which every worker maps read-only so they share its pages.
+        buffer: the mapped file, or the bytes of a snapshot that was only built in memory
+        """
+        self.header = header
+        self.version = header["version"]
+        self.path = path
+        self._data = memoryview(buffer)[header["data_offset"]:]
+
+    @classmethod
+    async def load(cls, session: AsyncSession, folder: str) -> "TimetableSnapshot":
+        """The snapshot of the live dataset: mapped from folder, or built from the database and saved there first."""
+        start = time.perf_counter()
+        version = await dataset_version(session)
+        if version is None:
+            snapshot = cls.from_bytes(await cls.build(session, "unversioned"))
+            print(f"Timetable snapshot built in memory in {time.perf_counter() - start:.3f}s (no manifest)")
+            return snapshot
+        path = os.path.join(folder, FILE_PATTERN.format(version=version))
+        snapshot = cls.open(path, version)
+        if snapshot is None:
+            await cls.write(session, folder)
+            snapshot = cls.open(path, version)
+        print(f"Timetable snapshot {version} mapped in {time.perf_counter() - start:.3f}s")
+        return snapshot
+
+    @classmethod
+    def open(cls, path: str, version: str) -> Optional["TimetableSnapshot"]:
+        """Map the file at path; None if it is missing, truncated, of another layout or not of version."""
+        try:
+            with open(path, "rb") as file:
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        header = cls._read_header(buffer)
+        if header is None or header["version"] != version:
+            return None
+        return cls(buffer, header, path)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "TimetableSnapshot":
+        return cls(data, cls._read_header(data))
+
+    @staticmethod
+    def _read_header(buffer) -> Optional[dict]:
+        if len(buffer) < len(MAGIC) + 4 or buffer[:len(MAGIC)] != MAGIC:
+            return None
+        (length,) = struct.unpack_from("<I", buffer, len(MAGIC))
+        try:
+            header = json.loads(bytes(buffer[len(MAGIC) + 4:len(MAGIC) + 4 + length]))
+        except ValueError:
+            return None
+        if header.get("format") != FORMAT_VERSION or header.get("byteorder") != sys.byteorder:
+            return None
+        header["data_offset"] = _data_offset(length)
+        if len(buffer) < header["data_offset"] + header["data_length"]:
+            return None
+        return header
+
+    @classmethod
+    async def write(cls, session: AsyncSession, folder: str) -> Optional[str]:
+        """
+        Build the snapshot of the live dataset into folder and remove the ones of other versions.
+        Returns its path, or None when the dataset has no manifest to version it by.
+        """
+        version = await dataset_version(session)
+        if version is None:
+            return None
+        data = await cls.build(session, version)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, FILE_PATTERN.format(version=version))
+        # Written aside and renamed, so a worker mapping the file never sees it half written
+        partial = f"{path}.{os.getpid()}.partial"
+        with open(partial, "wb") as file:
+            file.write(data)
+        os.replace(partial, path)
+        for stale in glob.glob(os.path.join(folder, FILE_PATTERN.format(version="*"))):
+            if stale != path:
+                try:
+                    os.remove(stale)
+                except OSError:
+                    # Still mapped by a process on Windows; the next write removes it
+                    pass
+        return path
+
+    @classmethod
+    async def build(cls, session: AsyncSession, version: str) -> bytes:
+        start = time.perf_counter()
+        stops = await get_all_stops(session)
+        routes = (await session.execute(ROUTE_NAMES_QUERY)).all()
+        services = (await session.execute(SERVICE_CALENDAR_QUERY)).all()
+        stop_times = (await session.execute(TIMETABLE_QUERY)).all()
+        stop_routes = (await session.execute(STOP_ROUTES_QUERY)).all()
+        patterns = (await session.execute(ROUTE_STOP_PATTERNS_QUERY)).all()
+        shapes = await load_shape_points(session)
+        # Sorting, simplifying and encoding every shape is CPU work, keep it off the event loop
+        columns = await asyncio.to_thread(cls._columns, stops, routes, services, stop_times, stop_routes, patterns, shapes)
+        output = io.BytesIO()
+        cls._write_columns(output, version, columns)
+        print(f"Timetable snapshot {version} built: {len(stop_times)} stop times in {time.perf_counter() - start:.3f}s")
+        return output.getvalue()
+
+    @staticmethod
+    def _columns(stops, routes, services, stop_times, stop_routes, patterns, shapes) -> dict[str, np.ndarray]:
+        columns = {}
+
+        def strings(name: str, values: list[bytes]):
+            columns[f"{name}.offsets"], columns[f"{name}.data"] = _encode_strings(values)
+
+        def table(prefix: str, rows: list, names_and_types: list[tuple[str, str]]):
+            values = list(zip(*rows)) if rows else [()] * len(names_and_types)
+            for (name, dtype), column in zip(names_and_types, values):
+                if dtype == "str":
+                    strings(f"{prefix}.{name}", [(value or "").encode("utf-8") for value in column])
+                else:
+                    columns[f"{prefix}.{name}"] = np.array(column, dtype=dtype)
+
+        table("stops", [(stop["stop_id"], stop["stop_lat"], stop["stop_lon"], stop["stop_name"]) for stop in stops],
+              [("stop_id", "int64"), ("stop_lat", "float64"), ("stop_lon", "float64"), ("stop_name", "str")])
+        table("routes", routes, [("route_id", "int64"), ("route_short_name", "str"), ("route_long_name", "str")])
+        table("calendar", [(service_id, start_date.toordinal()) for service_id, start_date, _ in services],
+              [("service_id", "int64"), ("start_date", "int64")])
+        bitmaps = [active_days.to_int("little") for _, _, active_days in services]
+        strings("calendar.active_days", [bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little") for bitmap in bitmaps])
+        table("stop_routes", stop_routes, [("stop_id", "int64"), ("route_id", "int64"), ("route_short_name", "str")])
+        table("patterns", patterns, [("route_id", "int64"), ("stop_id", "int64"), ("stop_lat", "float64"),
+                                     ("stop_lon", "float64")])
+
+        # stop_times twice: by stop in arrival order (StopDepartures) and by trip in stop_sequence order (TripCalls)
+        table("departures", stop_times, [("stop_ids", "int64"), ("arrival_times", "int32"), ("departure_times", "int32"),
+                                         ("stop_sequences", "int32"), ("trip_ids", "int64"), ("route_ids", "int64"),
+                                         ("service_ids", "int32")])
+        stop_ids, departure_times = columns.pop("departures.stop_ids"), columns.pop("departures.departure_times")
+        columns["departures.stop_id"], columns["departures.offsets"] = _groups(stop_ids)
+        by_trip = np.lexsort((columns["departures.stop_sequences"], columns["departures.trip_ids"]))
+        columns["trips.trip_id"], columns["trips.offsets"] = _groups(columns["departures.trip_ids"][by_trip])
+        firsts = by_trip[columns["trips.offsets"][:-1]]
+        columns["trips.route_id"] = columns["departures.route_ids"][firsts]
+        columns["trips.service_id"] = columns["departures.service_ids"][firsts]
+        columns["trips.stop_sequences"] = columns["departures.stop_sequences"][by_trip]
+        columns["trips.stop_ids"] = stop_ids[by_trip]
+        columns["trips.arrival_times"] = columns["departures.arrival_times"][by_trip]
+        columns["trips.departure_times"] = departure_times[by_trip]
+
+        shape_ids = sorted(shapes)
+        columns["shapes.route_id"] = np.array(shape_ids, dtype=np.int64)
+        columns["shapes.offsets"] = np.zeros(len(shape_ids) + 1, dtype=np.int64)
+        np.cumsum([len(shapes[route_id]) for route_id in shape_ids], out=columns["shapes.offsets"][1:])
+        points = np.array([point for route_id in shape_ids for point in shapes[route_id]], dtype=np.float64).reshape(-1, 2)
+        columns["shapes.lat"], columns["shapes.lon"] = np.ascontiguousarray(points[:, 0]), np.ascontiguousarray(points[:, 1])
+
+        # The encoded bodies of GET /api/get_shape, the slowest part of loading from the database
+        cache = ShapeCache(shapes)
+        bodies = [(route_id, FULL_SHAPE, body) for route_id, body in cache._full.items()]
+        bodies += [(route_id, max_zoom, body) for (route_id, max_zoom), body in cache._simplified.items()]
+        table("shape_bodies", [(route_id, max_zoom, body.etag) for route_id, max_zoom, body in bodies],
+              [("route_id", "int64"), ("max_zoom", "int32"), ("etag", "str")])
+        strings("shape_bodies.body", [body.body for _, _, body in bodies])
+        strings("shape_bodies.gzip_body", [body.gzip_body for _, _, body in bodies])
+        return columns
+
+    @staticmethod
+    def _write_columns(output: BinaryIO, version: str, columns: dict[str, np.ndarray]):
+        layout, length = {}, 0
+        for name, column in columns.items():
+            layout[name] = [FORMATS[column.dtype.name], length, len(column)]
+            length = _aligned(length + column.nbytes)
+        header = json.dumps({"format": FORMAT_VERSION, "version": version, "byteorder": sys.byteorder,
+                             "created": time.time(), "data_length": length, "columns": layout}).encode("utf-8")
+        output.write(MAGIC + struct.pack("<I", len(header)) + header)
+        data_offset = _data_offset(len(header))
+        for name, column in columns.items():
+            output.seek(data_offset + layout[name][1])
+            output.write(column.tobytes())
+        # Pad the last column up to data_length
+        output.seek(0, io.SEEK_END)
+        output.write(bytes(data_offset + length - output.tell()))
+
+    def column(self, name: str) -> memoryview:
+        """A fixed-width column as a memoryview of Python ints or floats, without copying it out of the file."""
+        format_, offset, length = self.header["columns"][name]
+        itemsize = struct.calcsize(format_)
+        return self._data[offset:offset + length * itemsize].cast(format_)
+
+    def array(self, name: str) -> np.ndarray:
+        column = self.column(name)
+        return np.frombuffer(column, dtype=np.dtype(column.format))
+
+    def blobs(self, name: str) -> list[memoryview]:
+        offsets, data = self.column(f"{name}.offsets"), self.column(f"{name}.data")
+        return [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+    def strings(self, name: str) -> list[str]:
+        return [str(blob, "utf-8") for blob in self.blobs(name)]
+
+    def call_table(self, group: str, key: str, row_type: type, scalars: int = 0) -> CallTable:
+        """The grouped columns of group as key -> row_type; its first scalars fields hold one value per group."""
+        return CallTable(self.column(f"{group}.{key}"), self.column(f"{group}.offsets"), row_type,
+                         [self.column(f"{group}.{name}") for name in row_type._fields[:scalars]],
+                         [self.column(f"{group}.{name}") for name in row_type._fields[scalars:]])
+
+    def stops(self) -> list[dict]:
+        """Rows as get_all_stops returns them."""
+        return [
+            {"stop_id": stop_id, "stop_name": stop_name, "stop_lat": stop_lat, "stop_lon": stop_lon}
+            for stop_id, stop_name, stop_lat, stop_lon in zip(
+                self.column("stops.stop_id"), self.strings("stops.stop_name"),
+                self.column("stops.stop_lat"), self.column("stops.stop_lon"))
+        ]
+
+    def shape_points(self) -> dict[int, list[tuple[float, float]]]:
+        """route_id -> ordered (lat, lon) points, as load_shape_points returns them."""
+        offsets = self.column("shapes.offsets")
+        lats, lons = self.array("shapes.lat"), self.array("shapes.lon")
+        return {
+            route_id: list(zip(lats[offsets[i]:offsets[i + 1]].tolist(), lons[offsets[i]:offsets[i + 1]].tolist()))
+            for i, route_id in enumerate(self.column("shapes.route_id"))
+        }